@@ -144,13 +144,17 @@ def get_wsgi_app(instance_folder):
 
 
 def override_environ_config(pool_size=None, pool_recycle=None,
-                            pool_timeout=None, behind_proxy=None):
+                            pool_timeout=None, max_overflow=None,
+                            behind_proxy=None):
     """Some configuration parameters are not stored in the zine.ini but
     in the os environment.  These are process wide configuration settings
-    used for different deployments.
+    used for different deployments.  The pool settings override the pool
+    settings from the instance configuration.
     """
     for key, value in locals().items():
         if value is not None:
             if key == 'behind_proxy':
                 value = int(bool(value))
-            os.environ['ZINE_' + key.upper()] = str(value)
+                os.environ['ZINE_BEHIND_PROXY'] = str(value)
+            else:
+                os.environ['ZINE_DATABASE_' + key.upper()] = str(value)
@@ -17,6 +17,7 @@ from itertools import izip
 from datetime import datetime, timedelta
 from urlparse import urlparse, urljoin
 from collections import deque
+from threading import Lock
 from inspect import getdoc
 
 from babel import Locale
@@ -25,7 +26,7 @@ from jinja2 import Environment, BaseLoader, TemplateNotFound
 
 from werkzeug import Request as RequestBase, Response as ResponseBase, \
      SharedDataMiddleware, url_quote, routing, redirect as _redirect, \
-     escape, cached_property, url_encode
+     escape, cached_property, url_encode, import_string
 from werkzeug.exceptions import HTTPException, Forbidden, \
      NotFound
 from werkzeug.contrib.securecookie import SecureCookie
@@ -35,6 +36,7 @@ from zine.environment import SHARED_DATA, BUILTIN_TEMPLATE_PATH, \
      BUILTIN_PLUGIN_FOLDER
 from zine.database import db, cleanup_session
 from zine.cache import get_cache
+from zine.scheduling import PublicationSchedule
 from zine.utils import ClosingIterator, local, local_manager, dump_json, \
      htmlhelpers
 from zine.utils.mail import split_email
@@ -42,6 +44,16 @@ from zine.utils.datastructures import ReadOnlyMultiMapping
 from zine.utils.exceptions import UserException
 
 
+#: the settings of the default theme.  The builtin templates only use the
+#: attributes of post rows, so the overview pages can use them.
+BUILTIN_THEME_SETTINGS = {
+    'sql.index.rows':               True,
+    'sql.author.rows':              True,
+    'sql.archive.rows':             True,
+    'sql.category.rows':            True,
+    'sql.tag.rows':                 True
+}
+
 #: the default theme settings
 DEFAULT_THEME_SETTINGS = {
     # pagination defaults
@@ -82,11 +94,23 @@ DEFAULT_THEME_SETTINGS = {
     # example a theme that wants to load a headline-overview of all the
     # posts in a specific tag but no text at all it makes no sense to
     # load the text and more just to throw away the information.
-    # for more information have a look at PostQuery.lightweight
+    # for more information have a look at PostQuery.lightweight.
+    # If the rows are enabled the overview pages use read-only post rows
+    # instead which are a lot cheaper than post objects but only have the
+    # attributes documented on zine.models.PostRow.  They are disabled by
+    # default because the templates of many themes use more of the post
+    # API, themes enable them in their settings.
+    'sql.index.rows':               False,
+    'sql.author.rows':              False,
+    'sql.archive.rows':             False,
+    'sql.category.rows':            False,
+    'sql.tag.rows':                 False,
+    'sql.index.lazy':               frozenset(),
     'sql.author.lazy':              frozenset(['comments']),
     'sql.archive.lazy':             frozenset(['comments']),
     'sql.category.lazy':            frozenset(['comments']),
     'sql.tag.lazy':                 frozenset(['comments']),
+    'sql.index.deferred':           frozenset(),
     'sql.author.deferred':          frozenset(),
     'sql.archive.deferred':         frozenset(),
     'sql.category.deferred':        frozenset(),
@@ -152,13 +176,16 @@ def emit_event(event, *args, **kwargs):
         for listener in iter_listeners(event):
             result.append(listener(*args, **kwargs))
     """
-    return [x(*args, **kwargs) for x in
-            get_application()._event_manager.iter(event)]
+    # most events have no listeners, return early for them
+    listeners = _core._application._event_manager.listeners.get(event)
+    if not listeners:
+        return []
+    return [x(*args, **kwargs) for x in listeners]
 
 
 def iter_listeners(event):
     """Return an iterator for all the listeners for the event provided."""
-    return get_application()._event_manager.iter(event)
+    return iter(_core._application._event_manager.listeners.get(event, ()))
 
 
 def add_link(rel, href, type, title=None, charset=None, media=None):
@@ -327,50 +354,162 @@ class EventManager(object):
     This is *not* a public interface. Always use the `emit_event` or
     `iter_listeners` functions to access it or the `connect_event` or
     `disconnect_event` methods on the application.
+
+    The listeners of every event are kept as tuple in `listeners` that is
+    rebuilt whenever a listener is connected or removed, so emitting an
+    event does not have to copy anything.  If profiling is enabled the
+    tuples hold wrappers that count the calls of each listener and the
+    time spent in it.
+
+    Listeners are called in the order they were connected, unless they
+    are connected with ``position='before'``:
+
+    >>> events = EventManager(app)
+    >>> a = events.connect('test', lambda: 'a')
+    >>> b = events.connect('test', lambda: 'b')
+    >>> c = events.connect('test', lambda: 'c', position='before')
+    >>> [f() for f in events.iter('test')]
+    ['c', 'a', 'b']
+
+    The id returned by `connect` removes the listener again.  Events
+    without listeners are not kept:
+
+    >>> events.remove(a)
+    >>> [f() for f in events.iter('test')]
+    ['c', 'b']
+    >>> events.remove(b); events.remove(c)
+    >>> events.listeners
+    {}
+
+    With profiling enabled the calls of every listener are counted:
+
+    >>> def listener():
+    ...     pass
+    >>> events.enable_profiling()
+    >>> listener_id = events.connect('test', listener)
+    >>> for x in xrange(3):
+    ...     for f in events.iter('test'):
+    ...         f()
+    >>> [(x.event, x.callback is listener, x.calls)
+    ...  for x in events.get_profile()]
+    [('test', True, 3)]
     """
 
     def __init__(self, app):
         self.app = app
+        self.listeners = {}
         self._listeners = {}
         self._last_listener = 0
+        self._profile = None
+        self._profile_lock = Lock()
+
+    def _freeze(self, event):
+        listeners = self._listeners.get(event)
+        if not listeners:
+            self.listeners.pop(event, None)
+        elif self._profile is None:
+            self.listeners[event] = tuple(x[1] for x in listeners)
+        else:
+            self.listeners[event] = tuple(self._make_profiled(event, *x)
+                                          for x in listeners)
+
+    def _make_profiled(self, event, listener_id, callback):
+        profile = self._profile.get(listener_id)
+        if profile is None:
+            profile = self._profile[listener_id] = \
+                ListenerProfile(event, callback)
+        lock = self._profile_lock
+        def listener(*args, **kwargs):
+            start = time()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                elapsed = time() - start
+                lock.acquire()
+                try:
+                    profile.calls += 1
+                    profile.time += elapsed
+                finally:
+                    lock.release()
+        return listener
 
     def connect(self, event, callback, position='after'):
-        """Connect a callback to an event."""
+        """Connect a callback to an event and return the listener id."""
         assert position in ('before', 'after'), 'invalid position'
         listener_id = self._last_listener
         event = intern(event)
         if event not in self._listeners:
-            self._listeners[event] = deque([callback])
+            self._listeners[event] = deque([(listener_id, callback)])
         elif position == 'after':
-            self._listeners[event].append(callback)
+            self._listeners[event].append((listener_id, callback))
         elif position == 'before':
-            self._listeners[event].appendleft(callback)
+            self._listeners[event].appendleft((listener_id, callback))
+        self._freeze(event)
         self._last_listener += 1
         return listener_id
 
     def remove(self, listener_id):
         """Remove a callback again."""
-        for event in self._listeners:
-            try:
-                event.remove(listener_id)
-            except ValueError:
-                pass
+        for event, listeners in self._listeners.iteritems():
+            for item in listeners:
+                if item[0] == listener_id:
+                    listeners.remove(item)
+                    self._freeze(event)
+                    return
 
     def iter(self, event):
         """Return an iterator for all listeners of a given name."""
-        if event not in self._listeners:
-            return iter(())
-        return iter(self._listeners[event])
+        return iter(self.listeners.get(event, ()))
 
     def template_emit(self, event, *args, **kwargs):
         """Emits events for the template context."""
         results = []
-        for f in self.iter(event):
+        for f in self.listeners.get(event, ()):
             rv = f(*args, **kwargs)
             if rv is not None:
                 results.append(rv)
         return TemplateEventResult(results)
 
+    def enable_profiling(self):
+        """Record the calls and the time of all listeners from now on."""
+        if self._profile is None:
+            self._profile = {}
+            for event in self._listeners:
+                self._freeze(event)
+
+    def get_profile(self):
+        """Return the :class:`ListenerProfile` objects of all listeners
+        that were called, the slowest first.  If profiling is not enabled
+        `None` is returned.
+        """
+        if self._profile is None:
+            return
+        return sorted([x for x in self._profile.itervalues() if x.calls],
+                      key=lambda x: -x.time)
+
+
+class ListenerProfile(object):
+    """The calls and the cumulative time of one event listener."""
+
+    def __init__(self, event, callback):
+        self.event = event
+        self.callback = callback
+        self.calls = 0
+        self.time = 0.0
+
+    @property
+    def average(self):
+        """The average time of a call."""
+        return self.calls and self.time / self.calls or 0.0
+
+    def __repr__(self):
+        return '<%s %r: %d calls, %.4fs>' % (
+            self.__class__.__name__,
+            self.event,
+            self.calls,
+            self.time
+        )
+
 
 class TemplateEventResult(list):
     """A list subclass for results returned by the event listener that
@@ -648,18 +787,55 @@ class Zine(object):
         self.log = log.Logger(path.join(instance_folder, self.cfg['log_file']),
                               self.cfg['log_level'])
 
+        # the listeners connected from now on are profiled as well
+        if self.cfg['profile_events']:
+            self._event_manager.enable_profiling()
+
         # the iid of the application
         self.iid = self.cfg['iid'].encode('utf-8')
         if not self.iid:
             self.iid = '%x' % id(self)
 
         # connect to the database
+        sqlite_options = None
+        if self.cfg['sqlite_production_mode']:
+            sqlite_options = dict((key, self.cfg['sqlite_' + key]) for key in
+                                  ('synchronous', 'cache_size', 'mmap_size',
+                                   'busy_timeout', 'pool_size'))
+        pool_options = {
+            'pool_size':        self.cfg['database_pool_size'],
+            'max_overflow':     self.cfg['database_max_overflow'],
+            'pool_timeout':     self.cfg['database_pool_timeout'],
+            'pool_recycle':     self.cfg['database_pool_recycle'] or -1,
+            'pre_ping':         self.cfg['database_pool_pre_ping']
+        }
         self.database_engine = db.create_engine(self.cfg['database_uri'],
-                                                self.instance_folder)
+                                                self.instance_folder,
+                                                sqlite_options=sqlite_options,
+                                                pool_options=pool_options)
 
         # now setup the cache system
         self.cache = get_cache(self)
 
+        # and the tracking of scheduled posts
+        self.publication_schedule = PublicationSchedule(self)
+
+        # the second level cache for users, groups, categories and tags
+        from zine.entitycache import EntityCache
+        self.entity_cache = EntityCache(self)
+
+        # the job queue with the core job handlers
+        from zine.jobs import JobQueue
+        from zine.pingback import pingback_job
+        from zine.importers import import_job
+        from zine.utils.mail import send_email_job
+        from zine.rerender import rerender_job
+        self.jobs = JobQueue(self)
+        self.jobs.add_handler('zine/pingback', pingback_job)
+        self.jobs.add_handler('zine/import', import_job)
+        self.jobs.add_handler('zine/send_email', send_email_job)
+        self.jobs.add_handler('zine/rerender', rerender_job)
+
         # setup core package urls and shared stuff
         import zine
         from zine.urls import make_urls
@@ -692,7 +868,7 @@ class Zine(object):
             'description':  _(u'Simple default theme that doesn\'t '
                               'contain any style information.'),
             'preview':      'core::default_preview.png'
-        })
+        }, BUILTIN_THEME_SETTINGS)
         default_theme.app = self
         self.themes = {'default': default_theme}
 
@@ -821,6 +997,11 @@ class Zine(object):
 
         self.initialized = True
 
+        # start the in-process job worker if wanted
+        if self.cfg['use_job_queue'] and self.cfg['job_worker_thread']:
+            from zine.jobs import WorkerThread
+            WorkerThread(self).start()
+
         #! called after the application and all plugins are initialized
         emit_event('application-setup-done')
 
@@ -1006,6 +1187,8 @@ class Zine(object):
 
             app.add_url_rule(..., endpoint='bar')
             app.add_view('bar', bar)
+
+        Like for :meth:`add_view` the view can be an import string.
         """
         prefix = kwargs.pop('prefix', None)
         if prefix is not None:
@@ -1034,6 +1217,10 @@ class Zine(object):
         """Add a callback as view.  The endpoint is the endpoint for the URL
         rule and has to be equivalent to the endpoint passed to
         :meth:`add_url_rule`.
+
+        The callback can also be an import string (``'module:function'``),
+        then the module is imported when the view is requested the first
+        time.  Plugins should do that for views that need heavy imports.
         """
         self.views[endpoint] = callback
 
@@ -1054,19 +1241,64 @@ class Zine(object):
     @setuponly
     def add_parser(self, name, class_):
         """Add a new parser class.  This parser has to be a subclass of
-        :class:`zine.parsers.BaseParser`.
+        :class:`zine.parsers.BaseParser`.  If the class is given as import
+        string (``'module:Class'``) it's imported when the parser is used
+        the first time.
         """
-        self.parsers[name] = class_(self)
+        if isinstance(class_, basestring):
+            from zine.parsers import LazyParser
+            self.parsers[name] = LazyParser(self, class_)
+        else:
+            self.parsers[name] = class_(self)
 
     @setuponly
-    def add_zeml_element_handler(self, element_handler):
-        """Register a new ZEML element handler."""
-        self.zeml_element_handlers.append(element_handler(self))
+    def add_zeml_element_handler(self, element_handler, **options):
+        """Register a new ZEML element handler.  If the handler is given as
+        import string (``'module:Class'``) it's imported when the first
+        element is processed.  In that case the tag and the flags of the
+        handler have to be passed as keyword arguments::
+
+            app.add_zeml_element_handler('zine.plugins.foo.handlers:Bar',
+                                         tag='bar', is_isolated=True)
+        """
+        if isinstance(element_handler, basestring):
+            from zine.utils.zeml import LazyElementHandler
+            element_handler = LazyElementHandler(self, element_handler,
+                                                 **options)
+        else:
+            element_handler = element_handler(self)
+        self.zeml_element_handlers.append(element_handler)
+
+    @setuponly
+    def add_job_handler(self, name, callback):
+        """Register a handler for background jobs.  The name should be
+        prefixed with the name of the plugin (``my_plugin/job_name``).  The
+        callback is called with a :class:`~zine.jobs.Job` as argument.  If
+        it raises an exception the job is retried later.
+        """
+        self.jobs.add_handler(name, callback)
+
+    def enqueue_job(self, name, payload=None, delay=0, max_attempts=None):
+        """Enqueue a background job.  The payload must be a JSON
+        serializable dict and is available as `job.payload` in the handler.
+        The job is added to the current database transaction, so don't
+        forget to commit.  If the job queue is disabled in the configuration
+        the job is executed right away.
+        """
+        return self.jobs.enqueue(name, payload, delay, max_attempts)
 
     @setuponly
-    def add_widget(self, widget):
-        """Add a widget."""
-        self.widgets[widget.name] = widget
+    def add_widget(self, widget, name=None):
+        """Add a widget.  If the widget class is given as import string
+        (``'module:Class'``) it's imported when the widget is used the first
+        time and the `name` of the widget has to be given.
+        """
+        if isinstance(widget, basestring):
+            if name is None:
+                raise TypeError('lazy widgets require a name')
+            from zine.widgets import LazyWidget
+            widget = LazyWidget(widget, name)
+        self.widgets[name or widget.name] = widget
 
     @setuponly
     def add_servicepoint(self, identifier, callback):
@@ -1096,8 +1328,15 @@ class Zine(object):
             def setup(app):
                 app.connect_event('before-metadata-assembled',
                                   on_before_metadata_assembled)
+
+        Returns the id of the listener that can be passed to
+        :meth:`disconnect_event`.
         """
-        self._event_manager.connect(event, callback, position)
+        return self._event_manager.connect(event, callback, position)
+
+    def disconnect_event(self, listener_id):
+        """Remove a listener connected with :meth:`connect_event` again."""
+        self._event_manager.remove(listener_id)
 
     def list_parsers(self):
         """Return a sorted list of parsers (parser_id, parser_name)."""
@@ -1204,7 +1443,10 @@ class Zine(object):
         try:
             try:
                 endpoint, args = self.url_adapter.match(request.path)
-                response = self.views[endpoint](request, **args)
+                view = self.views[endpoint]
+                if isinstance(view, basestring):
+                    view = self.views[endpoint] = import_string(view)
+                response = view(request, **args)
             except NotFound, e:
                 response = self.handle_not_found(request, e)
             except Forbidden, e:
@@ -108,6 +108,9 @@ def response(vary=(), timeout=None, cache_key=None):
     key to keep them cached properly.  If the response is not 200 no caching
     is performed.
 
+    The generation of the publication schedule is added to the key as well
+    so that cached listings are dropped once a scheduled post goes live.
+
     This method doesn't do anything if eager caching is disabled (by default).
     """
     from zine.application import Response
@@ -120,8 +123,12 @@ def response(vary=(), timeout=None, cache_key=None):
             use_cache = get_cache_context(vary, True, request)[1]
             response = None
             if use_cache:
-                cache_key = key + request.path.encode('utf-8')
-                response = request.app.cache.get(key)
+                cache_key = '%s:%s:%s' % (
+                    key,
+                    request.app.publication_schedule.get_generation(),
+                    request.path.encode('utf-8')
+                )
+                response = request.app.cache.get(cache_key)
 
             if response is None:
                 response = f(request, *args, **kwargs)
@@ -132,7 +139,7 @@ def response(vary=(), timeout=None, cache_key=None):
 
             if use_cache and response.status_code == 200:
                 response.freeze()
-                request.app.cache.set(key, response, timeout)
+                request.app.cache.set(cache_key, response, timeout)
                 response.make_conditional(request)
             return response
         oncall.__name__ = f.__name__
@@ -31,6 +31,32 @@ _dev_mode = environment.MODE == 'development'
 DEFAULT_VARS = {
     # general settings
     'database_uri':             TextField(default=u''),
+
+    # sqlite production mode.  Enables the write-ahead log, sets the pragmas
+    # below on every new connection and keeps one connection per thread in
+    # a pool of the given size.  The cache and mmap sizes are in KiB, the
+    # busy timeout in milliseconds.
+    'sqlite_production_mode':   BooleanField(default=False),
+    'sqlite_synchronous':       ChoiceField(choices=[
+        (u'off', lazy_gettext(u'Off')),
+        (u'normal', lazy_gettext(u'Normal')),
+        (u'full', lazy_gettext(u'Full'))
+                                            ], default=u'normal'),
+    'sqlite_cache_size':        IntegerField(default=8192, min_value=0),
+    'sqlite_mmap_size':         IntegerField(default=65536, min_value=0),
+    'sqlite_busy_timeout':      IntegerField(default=5000, min_value=0),
+    'sqlite_pool_size':         IntegerField(default=10, min_value=1),
+
+    # connection pool of other databases.  A recycle time of zero disables
+    # recycling.  The ZINE_DATABASE_POOL_* environment variables override
+    # these values.  In advisory mode the system information page suggests
+    # pool sizes based on the observed concurrency.
+    'database_pool_size':       IntegerField(default=5, min_value=1),
+    'database_max_overflow':    IntegerField(default=10, min_value=0),
+    'database_pool_timeout':    IntegerField(default=30, min_value=1),
+    'database_pool_recycle':    IntegerField(default=0, min_value=0),
+    'database_pool_pre_ping':   BooleanField(default=False),
+    'database_pool_advisor':    BooleanField(default=False),
     'blog_title':               TextField(default=lazy_gettext(u'My Zine Blog')),
     'blog_tagline':             TextField(default=lazy_gettext(u'just another Zine blog')),
     'blog_url':                 TextField(default=u''),
@@ -105,6 +131,24 @@ DEFAULT_VARS = {
                                                default=list),
     'filesystem_cache_path':    TextField(default=u'cache'),
 
+    # the current time used to find visible posts is rounded to this
+    # many seconds (or the next scheduled post) so that the queries and
+    # cached pages stay valid until something changes.  If the timer is
+    # enabled a thread invalidates the listings when a post goes live.
+    'publication_quantum':      IntegerField(default=60, min_value=1),
+    'publication_timer':        BooleanField(default=False),
+
+    # keep snapshots of users, groups, categories and tags in memory and
+    # in the cache.  Changes from other processes are only visible after
+    # the timeout if the processes don't share the cache.
+    'use_entity_cache':         BooleanField(default=False),
+    'entity_cache_timeout':     IntegerField(default=300, min_value=1),
+
+    # count the calls of the event listeners and the time spent in them.
+    # The numbers are shown on the system information page.  This slows
+    # down every event a bit, so only enable it to find slow plugins.
+    'profile_events':           BooleanField(default=False),
+
     # the default markup parser. Don't ever change this value! The
     # htmlprocessor module bypasses this test when falling back to
     # the default parser. If there plans to change the default parser
@@ -138,6 +182,16 @@ DEFAULT_VARS = {
     'smtp_password':            TextField(default=u''),
     'smtp_use_tls':             BooleanField(default=False),
 
+    # job queue settings.  If the queue is disabled jobs are executed
+    # right away, otherwise the job-worker script or the worker thread
+    # processes them.
+    'use_job_queue':            BooleanField(default=False),
+    'job_worker_thread':        BooleanField(default=False),
+    'job_poll_interval':        IntegerField(default=5, min_value=1),
+    'job_lease_time':           IntegerField(default=300, min_value=10),
+    'job_max_attempts':         IntegerField(default=5, min_value=1),
+    'job_retry_delay':          IntegerField(default=60, min_value=1),
+
     # plugin settings
     'plugin_guard':             BooleanField(default=True),
     'plugins':                  CommaSeparated(TextField(), default=list),
@@ -29,6 +29,9 @@ from sqlalchemy.exc import ArgumentError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.util import to_list
 from sqlalchemy.engine.url import make_url, URL
+from sqlalchemy.orm.interfaces import SessionExtension
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.pool import SingletonThreadPool
 from sqlalchemy.types import MutableType, TypeDecorator
 from sqlalchemy.ext.associationproxy import association_proxy
 
@@ -36,6 +39,8 @@ from werkzeug import url_decode
 from werkzeug.exceptions import NotFound
 
 from zine.utils import local_manager, load_json, dump_json
+from zine.utils.datastructures import MutationDict, RawMutationDict
+from zine.poolmetrics import PoolMetrics, MeteredQueuePool
 
 
 _sqlite_re = re.compile(r'sqlite:(?:(?://(.*?))|memory)(?:\?(.*))?$')
@@ -52,13 +57,49 @@ def get_engine():
     return get_application().database_engine
 
 
-def create_engine(uri, relative_to=None, echo=False):
+class SQLitePragmaListener(PoolListener):
+    """Switches new SQLite connections to the write-ahead log and sets the
+    pragmas of the SQLite production mode.
+    """
+
+    def __init__(self, synchronous='normal', cache_size=8192, mmap_size=0,
+                 busy_timeout=5000):
+        self.pragmas = [
+            'journal_mode=WAL',
+            'synchronous=%s' % {'off': 0, 'normal': 1,
+                                'full': 2}[synchronous],
+            # negative values are in KiB instead of pages
+            'cache_size=-%d' % cache_size,
+            'mmap_size=%d' % (mmap_size * 1024),
+            'busy_timeout=%d' % busy_timeout
+        ]
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        try:
+            for pragma in self.pragmas:
+                cursor.execute('pragma ' + pragma)
+        finally:
+            cursor.close()
+
+
+def create_engine(uri, relative_to=None, echo=False, sqlite_options=None,
+                  pool_options=None):
     """Create a new engine.  This works a bit like SQLAlchemy's
     `create_engine` with the difference that it automaticaly set's MySQL
     engines to 'utf-8', and paths for SQLite are relative to the path
     provided as `relative_to`.
 
     Furthermore the engine is created with `convert_unicode` by default.
+
+    If `sqlite_options` is given and the database is a SQLite file, the
+    engine uses the SQLite production mode.  The options are the pragma
+    values of :class:`SQLitePragmaListener` and the `pool_size`.
+
+    `pool_options` are the `pool_size`, `max_overflow`, `pool_timeout` and
+    `pool_recycle` arguments for the queue pool of other databases and a
+    `pre_ping` flag.  The pool metrics are available as `pool_metrics` on
+    the engine returned.
     """
     # special case sqlite.  We want nicer urls for that one.
     if uri.startswith('sqlite:'):
@@ -84,21 +125,42 @@ def create_engine(uri, relative_to=None, echo=False):
         if info.drivername == 'mysql':
             info.query.setdefault('charset', 'utf8')
 
-    options = {'convert_unicode': True, 'echo': echo}
+    pool_options = dict(pool_options or ())
+    metrics = PoolMetrics(pool_options.pop('pre_ping', False))
+    options = {'convert_unicode': True, 'echo': echo, 'listeners': [metrics]}
+    environ_options = 'pool_size', 'pool_recycle', 'pool_timeout'
+
+    if info.drivername == 'sqlite':
+        if info.database != ':memory:' and sqlite_options:
+            sqlite_options = dict(sqlite_options)
+            options['poolclass'] = SingletonThreadPool
+            options['pool_size'] = sqlite_options.pop('pool_size', 10)
+            options['listeners'].append(SQLitePragmaListener(
+                **sqlite_options))
+            options['connect_args'] = {'timeout': sqlite_options.get(
+                'busy_timeout', 5000) / 1000.0}
+            # the per-thread pool never waits for a connection
+            environ_options = 'pool_size', 'pool_recycle'
+    else:
+        options['poolclass'] = MeteredQueuePool
+        options.update(pool_options)
+        environ_options += ('max_overflow',)
 
     # alternative pool sizes / recycle settings and more.  These are
-    # interpreter wide and not from the config for the following reasons:
+    # interpreter wide and override the config for the following reasons:
     #
     # - system administrators can set it independently from the webserver
     #   configuration via SetEnv and friends.
     # - this setting is deployment dependent should not affect a development
     #   server for the same instance or a development shell
-    for key in 'pool_size', 'pool_recycle', 'pool_timeout':
+    for key in environ_options:
         value = os.environ.get('ZINE_DATABASE_' + key.upper())
         if value is not None:
             options[key] = int(value)
 
-    return sqlalchemy.create_engine(info, **options)
+    engine = sqlalchemy.create_engine(info, **options)
+    engine.pool_metrics = metrics
+    return engine
 
 
 def secure_database_uri(uri):
@@ -116,65 +178,105 @@ def attribute_loaded(model, attribute):
     return attribute in model.__dict__
 
 
-class ZEMLParserData(MutableType, TypeDecorator):
-    """Holds parser data."""
+class _ChangeTrackedType(MutableType, TypeDecorator):
+    """Baseclass for the types that load into a
+    :class:`~zine.utils.datastructures.MutationDict` or another mapping
+    with a `changed` flag.  Instead of copying the value when it's loaded
+    and comparing the copy with the value on every flush the mapping
+    itself tracks if it was changed.  Other values (new values from the
+    application for example) are still copied and compared.
+    """
 
     impl = sqlalchemy.Binary
 
+    def is_tracked(self, value):
+        """Check if the value tracks its changes."""
+        return isinstance(value, MutationDict)
+
+    def copy_value(self, value):
+        if self.is_tracked(value):
+            # called after loading and committing.  The value becomes the
+            # new unchanged state.
+            value.changed = False
+            return value
+        from copy import deepcopy
+        return deepcopy(value)
+
+    def compare_values(self, x, y):
+        if self.is_tracked(x):
+            return x is y and not x.changed
+        return x == y
+
+
+class ZEMLParserData(_ChangeTrackedType):
+    """Holds parser data."""
+
+    def is_tracked(self, value):
+        from zine.utils.zeml import ParserData
+        return isinstance(value, ParserData)
+
     def process_bind_param(self, value, dialect):
         if value is None:
             return
+        raw = getattr(value, 'raw', None)
+        if raw is not None:
+            return raw
         from zine.utils.zeml import dump_parser_data
         return dump_parser_data(value)
 
     def process_result_value(self, value, dialect):
-        from zine.utils.zeml import load_parser_data
+        from zine.utils.zeml import load_parser_data, ParserData
         try:
-            return load_parser_data(value)
+            value = load_parser_data(value)
         except (ValueError, error): # Parser data invalid. Database corruption?
             from zine.i18n import _
             from zine.utils import log
             log.exception(_(u'Error when loading parsed data from database. '
                             u'Maybe the database was manually edited and got '
                             u'corrupted? The system returned an empty value.'))
-            return {}
+            return ParserData()
+        return value
 
-    def copy_value(self, value):
-        from copy import deepcopy
-        return deepcopy(value)
 
+def _decode_extra(raw):
+    """Decode the value of an extra column.  Legacy values are pickled."""
+    try:
+        value = load_json(raw)
+    except ValueError:
+        try:
+            value = load_pickle(raw)
+        except Exception:
+            # Database corrupted? Return raw data
+            value = {'dump': raw}
+    if not isinstance(value, dict):
+        value = {'dump': raw}
+    return value
 
-class JsonDictPickleFallback(MutableType, TypeDecorator):
+
+class JsonDictPickleFallback(_ChangeTrackedType):
     """
     Stores as JSON and loads from JSON, with pickle fallback for compatibility
-    with older Zine installations."""
+    with older Zine installations.  Values that were not changed are
+    stored as they were loaded, without encoding them again.
+
+    The user and post mappers defer the extra columns, so the values are
+    only loaded and decoded when they are accessed the first time.
+    """
 
-    impl = sqlalchemy.Binary
-    
     def process_result_value(self, value, dialect):
         if value is None:
             return None
-        else:
-            try:
-                # the extra str() call is for databases like postgres that
-                # insist on using buffers for binary data.
-                return load_json(str(value))
-            except ValueError:
-                try:
-                    return load_pickle(str(value))
-                except ValueError:
-                    # Database corrupted? Return raw data
-                    return {'dump': str(value)}
+        # the extra str() call is for databases like postgres that
+        # insist on using buffers for binary data.
+        raw = str(value)
+        return RawMutationDict(_decode_extra(raw), raw)
 
     def process_bind_param(self, value, dialect):
         if value is None:
             return None
-        else:
-            return dump_json(value)
-
-    def copy_value(self, value):
-        from copy import deepcopy
-        return deepcopy(value)
+        elif isinstance(value, RawMutationDict) and value.raw is not None:
+            return value.raw
+        return dump_json(value)
 
 
 class Query(orm.Query):
@@ -191,8 +293,13 @@ class Query(orm.Query):
         return rv
 
 
+#: session extensions for all new sessions.  Modules that have to know
+#: about flushes and commits add their extensions here.
+session_extensions = []
+
 session = orm.scoped_session(lambda: orm.create_session(get_engine(),
-                             autoflush=True, autocommit=False),
+                             autoflush=True, autocommit=False,
+                             extension=session_extensions),
                              local_manager.get_ident)
 
 
@@ -229,6 +336,7 @@ db.ZEMLParserData = ZEMLParserData
 db.JsonDictPickleFallback = JsonDictPickleFallback
 db.mapper = session.mapper
 db.association_proxy = association_proxy
+db.SessionExtension = SessionExtension
 db.attribute_loaded = attribute_loaded
 
 #: called at the end of a request
@@ -352,6 +460,20 @@ redirects = db.Table('redirects', metadata,
     db.Column('new', db.String(200))
 )
 
+jobs = db.Table('jobs', metadata,
+    db.Column('job_id', db.Integer, primary_key=True),
+    db.Column('name', db.String(100), nullable=False),
+    db.Column('payload', db.Text),
+    db.Column('status', db.Integer, nullable=False),
+    db.Column('attempts', db.Integer, nullable=False),
+    db.Column('max_attempts', db.Integer, nullable=False),
+    db.Column('created', db.DateTime),
+    db.Column('run_at', db.DateTime, index=True),
+    db.Column('locked_by', db.String(100)),
+    db.Column('locked_until', db.DateTime),
+    db.Column('last_error', db.Text)
+)
+
 
 def init_database(engine):
     """This is called from the websetup which explains why it takes an engine
@@ -362,3 +484,65 @@ def init_database(engine):
     #   cx.execute('set storage_engine=innodb')
     #   metadata.create_all(cx)
     metadata.create_all(engine)
+
+
+def convert_pickled_extra(engine):
+    """Convert the legacy pickled extra values of users and posts to JSON
+    so that loading them never has to fall back to unpickling.  The
+    conversion is optional and only needed once, the
+    `convert-extra-to-json` script calls this.
+
+    Values that can't be unpickled (because the class of a pickled object
+    is gone for example) or that don't survive the conversion to JSON
+    unchanged are left as they are.  Returns the number of converted
+    values and a list of ``(table, id)`` tuples for the skipped values.
+    """
+    converted = 0
+    skipped = []
+    for table in users, posts:
+        pk = list(table.primary_key)[0]
+        for row in engine.execute(db.select([pk, table.c.extra],
+                                  table.c.extra != None)).fetchall():
+            raw = row[1].raw
+            try:
+                load_json(raw)
+            except ValueError:
+                pass
+            else:
+                continue
+            try:
+                value = load_pickle(raw)
+                encoded = dump_json(value)
+                if not isinstance(value, dict) or load_json(encoded) != value:
+                    raise ValueError('value changes in JSON')
+            except Exception:
+                skipped.append((table.name, row[0]))
+                continue
+            engine.execute(table.update(pk == row[0]),
+                           extra=RawMutationDict(value, encoded))
+            converted += 1
+    return converted, skipped
+
+
+def sqlite_maintenance(engine, analyze=True, vacuum=False, checkpoint=True):
+    """Run the maintenance commands for SQLite databases.  `ANALYZE`
+    updates the statistics of the query planner, `VACUUM` rebuilds the
+    database file and the checkpoint moves the write-ahead log into the
+    database and truncates it.  Yields the commands as they are executed.
+    """
+    if engine.name != 'sqlite':
+        raise TypeError('maintenance is only available for SQLite')
+    commands = []
+    if analyze:
+        commands.append('analyze')
+    if vacuum:
+        commands.append('vacuum')
+    if checkpoint:
+        commands.append('pragma wal_checkpoint(truncate)')
+    con = engine.connect()
+    try:
+        for command in commands:
+            yield command
+            con.execute(command)
+    finally:
+        con.close()
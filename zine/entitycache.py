@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.entitycache
+    ~~~~~~~~~~~~~~~~
+
+    A second level cache for the entities that rarely change: users,
+    groups, categories and tags.  The cache keeps read-only snapshots of
+    the complete tables (the row objects from :mod:`zine.models`) indexed
+    by primary key and by slug or username, both in process memory and in
+    the application cache.
+
+    The cache is opt-in (``use_entity_cache``).  If it's disabled the
+    lookups still return the same row objects but every lookup queries
+    the database.  The views pass entities to the templates with
+    :meth:`EntityCache.lookup` which returns the mapped objects instead
+    if the cache is disabled, so templates that use more than the
+    attributes of the rows keep working unless the cache is enabled.  Whenever the session flushes changes to one of the
+    cached entities the table is invalidated.  Other processes only see
+    that invalidation if they share the application cache; otherwise their
+    snapshots expire after ``entity_cache_timeout`` seconds.
+
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from time import time
+from itertools import chain
+from threading import Lock
+
+from zine.database import db, users, groups, categories, tags, \
+     session_extensions
+
+
+class _Kind(object):
+    """Describes how the snapshots of one entity type are loaded."""
+
+    def __init__(self, name, table, columns, key, order_by, row_class,
+                 model):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.key = key
+        self.order_by = order_by
+        self.row_class = row_class
+        self.model = model
+
+    def select(self, whereclause=None):
+        return db.select(self.columns, whereclause, order_by=self.order_by)
+
+
+class _Snapshot(object):
+    """All rows of one table with the indexes for the lookups."""
+
+    def __init__(self, kind, values):
+        self.all = [kind.row_class(*x) for x in values]
+        self.by_id = {}
+        self.by_key = {}
+        for row in self.all:
+            self.by_id[row.id] = row
+            self.by_key[getattr(row, kind.key.name)] = row
+
+
+_kinds = None
+
+
+def _get_kinds():
+    global _kinds
+    if _kinds is None:
+        from zine.models import User, Group, Category, Tag, UserRow, \
+             GroupRow, CategoryRow, TagRow
+        _kinds = dict((x.name, x) for x in [
+            _Kind('user', users, [users.c.user_id, users.c.username,
+                  users.c.real_name, users.c.display_name, users.c.www,
+                  users.c.is_author, users.c.description], users.c.username,
+                  [users.c.username], UserRow, User),
+            _Kind('group', groups, [groups.c.group_id, groups.c.name],
+                  groups.c.name, [groups.c.name], GroupRow, Group),
+            _Kind('category', categories, [categories.c.category_id,
+                  categories.c.name, categories.c.slug,
+                  categories.c.description], categories.c.slug,
+                  [categories.c.name], CategoryRow, Category),
+            _Kind('tag', tags, [tags.c.tag_id, tags.c.name, tags.c.slug],
+                  tags.c.slug, [tags.c.name], TagRow, Tag)
+        ])
+    return _kinds
+
+
+def _get_kind_for_instance(instance):
+    for kind in _get_kinds().itervalues():
+        if isinstance(instance, kind.model):
+            return kind.name
+
+
+class EntityCache(object):
+    """The entity cache of an application.  Available as
+    `app.entity_cache`.  The `kind` arguments are one of ``'user'``,
+    ``'group'``, ``'category'`` and ``'tag'``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.timeout = app.cfg['entity_cache_timeout']
+        self._lock = Lock()
+        self._snapshots = {}
+
+    @property
+    def enabled(self):
+        """`True` if snapshots are cached."""
+        return self.app.cfg['use_entity_cache']
+
+    def _get_cache_key(self, kind):
+        return 'zine/entities/' + kind
+
+    def get_snapshot(self, kind):
+        """Return the snapshot for a kind.  Only works if the cache is
+        enabled.
+        """
+        rv = self._snapshots.get(kind)
+        if rv is not None and rv[0] > time():
+            return rv[1]
+        kind = _get_kinds()[kind]
+        cache_key = self._get_cache_key(kind.name)
+        values = self.app.cache.get(cache_key)
+        if values is None:
+            values = [tuple(x) for x in db.execute(kind.select())]
+            self.app.cache.set(cache_key, values, timeout=self.timeout)
+        snapshot = _Snapshot(kind, values)
+        self._lock.acquire()
+        try:
+            self._snapshots[kind.name] = (time() + self.timeout, snapshot)
+        finally:
+            self._lock.release()
+        return snapshot
+
+    def _query(self, kind, whereclause=None):
+        kind = _get_kinds()[kind]
+        return [kind.row_class(*x) for x in
+                db.execute(kind.select(whereclause))]
+
+    def get(self, kind, id):
+        """Return the row with the given primary key or `None`."""
+        if self.enabled:
+            return self.get_snapshot(kind).by_id.get(id)
+        table = _get_kinds()[kind].table
+        rv = self._query(kind, table.primary_key.columns.values()[0] == id)
+        if rv:
+            return rv[0]
+
+    def get_many(self, kind, ids):
+        """Return a dict of rows for the given primary keys."""
+        ids = set(ids)
+        if not ids:
+            return {}
+        if self.enabled:
+            by_id = self.get_snapshot(kind).by_id
+            return dict((x, by_id[x]) for x in ids if x in by_id)
+        table = _get_kinds()[kind].table
+        return dict((x.id, x) for x in self._query(kind,
+                    table.primary_key.columns.values()[0].in_(ids)))
+
+    def get_by_key(self, kind, key):
+        """Return the row with the given slug (or username for users and
+        name for groups) or `None`.
+        """
+        if self.enabled:
+            return self.get_snapshot(kind).by_key.get(key)
+        rv = self._query(kind, _get_kinds()[kind].key == key)
+        if rv:
+            return rv[0]
+
+    def get_all(self, kind):
+        """Return a list of all rows."""
+        if self.enabled:
+            return list(self.get_snapshot(kind).all)
+        return self._query(kind)
+
+    def lookup(self, kind, key):
+        """Like :meth:`get_by_key` but if the cache is disabled the mapped
+        object is returned instead of a row.  Used for the entities that
+        are passed to templates.
+        """
+        if self.enabled:
+            return self.get_by_key(kind, key)
+        kind = _get_kinds()[kind]
+        return kind.model.query.filter(kind.key == key).first()
+
+    def lookup_all(self, kind):
+        """Like :meth:`get_all` but if the cache is disabled the mapped
+        objects are returned instead of rows.
+        """
+        if self.enabled:
+            return self.get_all(kind)
+        kind = _get_kinds()[kind]
+        return kind.model.query.order_by(*kind.order_by).all()
+
+    def get_related(self, kind, secondary, post_ids):
+        """Return a dict with lists of rows for the given post ids.  The
+        `secondary` table is the table that connects the posts with the
+        entities.
+        """
+        if not post_ids:
+            return {}
+        kind = _get_kinds()[kind]
+        pk = kind.table.primary_key.columns.values()[0]
+        fk = secondary.c[pk.name]
+        result = {}
+        if self.enabled:
+            by_id = self.get_snapshot(kind.name).by_id
+            for post_id, id in db.execute(db.select([secondary.c.post_id, fk],
+                    secondary.c.post_id.in_(post_ids))):
+                if id in by_id:
+                    result.setdefault(post_id, []).append(by_id[id])
+            sort_key = kind.order_by[0].name
+            for rows in result.itervalues():
+                rows.sort(key=lambda x: getattr(x, sort_key))
+        else:
+            for values in db.execute(db.select([secondary.c.post_id] +
+                    kind.columns, (fk == pk) &
+                    secondary.c.post_id.in_(post_ids),
+                    order_by=kind.order_by)):
+                result.setdefault(values[0], []).append(
+                    kind.row_class(*values[1:]))
+        return result
+
+    def invalidate(self, kind=None):
+        """Invalidate the snapshot of a kind or all snapshots."""
+        if kind is None:
+            kinds = _get_kinds().keys()
+        else:
+            kinds = [kind]
+        self._lock.acquire()
+        try:
+            for kind in kinds:
+                self._snapshots.pop(kind, None)
+        finally:
+            self._lock.release()
+        for kind in kinds:
+            self.app.cache.delete(self._get_cache_key(kind))
+
+
+class EntityCacheSessionExtension(db.SessionExtension):
+    """Invalidates the entity cache if cached entities are flushed.  The
+    snapshots are invalidated after the flush and again after the commit
+    so that another request can't store the old values in between.
+    """
+
+    def after_flush(self, session, flush_context):
+        kinds = set()
+        for instance in chain(session.new, session.dirty, session.deleted):
+            kind = _get_kind_for_instance(instance)
+            if kind is not None:
+                kinds.add(kind)
+        if kinds:
+            session.__dict__.setdefault('_zine_flushed_entities',
+                                        set()).update(kinds)
+            self._invalidate(kinds)
+
+    def after_commit(self, session):
+        kinds = session.__dict__.pop('_zine_flushed_entities', None)
+        if kinds:
+            self._invalidate(kinds)
+
+    def after_rollback(self, session):
+        session.__dict__.pop('_zine_flushed_entities', None)
+
+    def _invalidate(self, kinds):
+        from zine.application import get_application
+        app = get_application()
+        if app is None:
+            return
+        for kind in kinds:
+            app.entity_cache.invalidate(kind)
+
+
+session_extensions.append(EntityCacheSessionExtension())
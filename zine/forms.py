@@ -289,19 +289,20 @@ class PostForm(forms.Form):
 
         forms.Form.__init__(self, initial)
 
-        # if we have have an old post and the parser is not missing and
-        # it was published when the form was created we collect the old
-        # posts so that we don't have to ping them another time.
+        # if we have have an old post and it was published when the form
+        # was created we collect the old links so that we don't have to
+        # ping them another time.  the links are stored with the post, if
+        # they are not the parser must be available to find them.
         self._old_links = set()
-        if self.post is not None and not self.post.parser_missing and \
-           self.post.is_published:
+        if self.post is not None and self.post.is_published and \
+           (not self.post.parser_missing or
+            (self.post.parser_data or {}).get('links') is not None):
             self._old_links.update(self.post.find_urls())
 
     def find_new_links(self):
         """Return a list of all new links."""
-        for link in self.post.find_urls():
-            if not link in self._old_links:
-                yield link
+        return [link for link in self.post.find_urls()
+                if link not in self._old_links]
 
     def validate_slug(self, value):
         """Make sure the slug is unique."""
@@ -1040,6 +1041,10 @@ class MaintenanceModeForm(forms.Form):
     """yet a dummy form, but could be extended later."""
 
 
+class JobQueueForm(forms.Form):
+    """The form for retrying and removing jobs in the job queue."""
+
+
 class WordPressImportForm(forms.Form):
     """This form is used in the WordPress importer."""
     download_url = forms.TextField(lazy_gettext(u'Dump Download URL'),
@@ -113,21 +113,13 @@ def _perform_import(app, blog, d):
             author_mapping[author.id] = user
         return author_mapping[author.id]
 
-    def prepare_tag(tag):
-        """Get a tag for a tag."""
-        t = tag_mapping.get(tag.slug)
-        if t is not None:
-            return t
-        t = Tag.query.filter_by(slug=tag.slug).first()
-        if t is not None:
-            tag_mapping[tag.slug] = t
-            return t
-        t = Tag.query.filter_by(name=tag.name).first()
-        if t is not None:
-            tag_mapping[tag.slug] = t
-            return t
-        t = tag_mapping[tag.id] = Tag(tag.name, tag.slug)
-        return t
+    def prepare_tags(posts):
+        """Get the tags for all the posts in one go."""
+        wanted = {}
+        for post in posts:
+            for tag in post.tags:
+                wanted.setdefault(tag.name, tag.slug)
+        tag_mapping.update(Tag.query.get_or_create_many(wanted, wanted))
 
     def prepare_category(category):
         """Get a category for a category."""
@@ -158,15 +150,17 @@ def _perform_import(app, blog, d):
         app.cfg.change_single('blog_tagline', blog.description)
         yield u'<li>%s</li>\n' % _('set blog tagline from dump')
 
-    # convert the posts now
-    for old_post in blog.posts:
-        # in theory that will never happen because there are no
-        # checkboxes for already imported posts on the form, but
-        # who knows what users manage to do and also skip posts
-        # we don't want converted
-        if old_post.already_imported or not d['posts'][old_post.id]:
-            continue
+    # in theory already imported posts will never be selected because
+    # there are no checkboxes for them on the form, but who knows what
+    # users manage to do and also skip posts we don't want converted
+    selected_posts = [x for x in blog.posts if not x.already_imported
+                      and d['posts'][x.id]]
 
+    # look up or create all the tags we need at once
+    prepare_tags(selected_posts)
+
+    # convert the posts now
+    for old_post in selected_posts:
         slug = old_post.slug
         while Post.query.autoflush(False).filter_by(slug=slug) \
                   .limit(1).count():
@@ -183,7 +177,7 @@ def _perform_import(app, blog, d):
         yield u'<li><strong>%s</strong>' % escape(post.title)
 
         for tag in old_post.tags:
-            post.tags.append(prepare_tag(tag))
+            post.tags.append(tag_mapping[tag.name])
             yield u'.'
 
         for category in old_post.categories:
@@ -254,6 +248,18 @@ def perform_import(app, blog, data, stream=False):
         return generator
 
 
+def import_job(job):
+    """Job handler that imports the dump ``job.payload['dump_id']`` with
+    the form data in ``job.payload['data']``.
+    """
+    from zine.application import get_application
+    app = get_application()
+    blog = load_import_dump(app, job.payload['dump_id'])
+    if blog is None:
+        return
+    perform_import(app, blog, job.payload['data'])
+
+
 def rewrite_import(app, id, callback, title='Modified Import'):
     """Calls a callback with the blog from the dump `id` for rewriting.  The
     callback can modify the blog in place (it's passed as first argument) and
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.jobs
+    ~~~~~~~~~
+
+    A small database backed job queue for slow side effects like sending
+    pingbacks, talking to remote spam checkers or sending mails.  Jobs are
+    rows in the `jobs` table.  Workers claim jobs by setting a lease on
+    them, so a worker that dies in the middle of a job doesn't lose it:
+    once the lease expired another worker picks it up again.
+
+    Failing jobs are retried with an exponential backoff until they run
+    out of attempts, then they are marked as failed and show up in the
+    admin panel.
+
+    Jobs are processed either by the `job-worker` script or by a worker
+    thread inside the application process if ``job_worker_thread`` is
+    enabled.  If the queue is disabled in the configuration, jobs are
+    executed right away when they are enqueued.
+
+    Plugins register handlers during setup and enqueue jobs through the
+    application object::
+
+        def send_notification(job):
+            send_email(job.payload['subject'], job.payload['text'],
+                       job.payload['to'], quiet=False)
+
+        def setup(app, plugin):
+            app.add_job_handler('my_plugin/notify', send_notification)
+
+        get_application().enqueue_job('my_plugin/notify', {
+            'subject': ..., 'text': ..., 'to': ...})
+
+    The payload must be JSON serializable.
+
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import socket
+from time import sleep
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from traceback import format_exc
+
+from zine import _core
+from zine.database import db, jobs, cleanup_session
+from zine.utils import dump_json, load_json
+
+
+#: job states
+JOB_PENDING = 0
+JOB_RUNNING = 1
+JOB_FAILED = 2
+
+#: the retry delay is never longer than that
+MAX_RETRY_DELAY = 60 * 60 * 24
+
+
+class Job(object):
+    """A claimed job.  This is what job handlers get as argument."""
+
+    def __init__(self, id, name, payload, attempts, max_attempts):
+        self.id = id
+        self.name = name
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+    @property
+    def last_attempt(self):
+        """`True` if the job won't be retried if this attempt fails."""
+        return self.attempts >= self.max_attempts
+
+    def __repr__(self):
+        return '<%s %r #%d>' % (
+            self.__class__.__name__,
+            self.name,
+            self.id
+        )
+
+
+def _now():
+    return datetime.utcnow()
+
+
+def _claimable(now):
+    j = jobs.c
+    return ((j.status == JOB_PENDING) & (j.run_at <= now)) | \
+           ((j.status == JOB_RUNNING) & (j.locked_until < now))
+
+
+class JobQueue(object):
+    """The job queue of an application.  Available as `app.jobs`.
+
+    The delay before the next attempt of a failed job doubles with every
+    attempt, starting with the configured ``job_retry_delay``:
+
+    >>> queue = JobQueue(app)
+    >>> [queue.get_retry_delay(x) for x in 1, 2, 3, 4]
+    [60, 120, 240, 480]
+    >>> queue.get_retry_delay(50) == MAX_RETRY_DELAY
+    True
+
+    A failing job is pending again until the delay passed.  When it fails
+    on the last attempt it's marked as failed:
+
+    >>> from sqlalchemy import create_engine
+    >>> class TestApplication(object):
+    ...     cfg = app.cfg
+    ...     database_engine = create_engine('sqlite://')
+    >>> queue = JobQueue(TestApplication())
+    >>> def fail(job):
+    ...     raise RuntimeError('failed')
+    >>> queue.add_handler('test/fail', fail)
+    >>> queue.ensure_table()
+    >>> engine = queue.app.database_engine
+    >>> job_id = engine.execute(jobs.insert(), name='test/fail',
+    ...     status=JOB_PENDING, attempts=0, max_attempts=2,
+    ...     created=_now(), run_at=_now()).last_inserted_ids()[0]
+    >>> [job] = queue.claim('worker')
+    >>> job.attempts, job.last_attempt, queue.run(job, 'worker')
+    (1, False, False)
+    >>> row = engine.execute(jobs.select()).fetchone()
+    >>> row.status == JOB_PENDING, row.run_at > _now(), queue.claim('worker')
+    (True, True, [])
+
+    Once the delay passed the job is claimed again:
+
+    >>> result = engine.execute(jobs.update(), run_at=_now())
+    >>> [job] = queue.claim('worker')
+    >>> job.attempts, job.last_attempt, queue.run(job, 'worker')
+    (2, True, False)
+    >>> engine.execute(jobs.select()).fetchone().status == JOB_FAILED
+    True
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.handlers = {}
+        self._table_checked = False
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        """`True` if jobs are queued instead of executed right away."""
+        return self.app.cfg['use_job_queue']
+
+    def ensure_table(self):
+        """Create the jobs table if it does not exist yet.  Instances set
+        up before the queue existed don't have that table.
+        """
+        if self._table_checked:
+            return
+        self._lock.acquire()
+        try:
+            if not self._table_checked:
+                jobs.create(bind=self.app.database_engine, checkfirst=True)
+                self._table_checked = True
+        finally:
+            self._lock.release()
+
+    def add_handler(self, name, callback):
+        """Register a handler for jobs with the given name."""
+        self.handlers[name] = callback
+
+    def enqueue(self, name, payload=None, delay=0, max_attempts=None):
+        """Enqueue a new job.  The job is inserted in the current database
+        transaction, so it's only visible to workers after the transaction
+        was committed.  Returns the id of the job or `None` if the queue
+        is disabled and the job was executed right away.
+        """
+        if name not in self.handlers:
+            raise LookupError('no handler for job %r' % name)
+        if payload is None:
+            payload = {}
+        if max_attempts is None:
+            max_attempts = self.app.cfg['job_max_attempts']
+
+        if not self.enabled:
+            self.execute(Job(None, name, payload, 1, 1))
+            return
+
+        self.ensure_table()
+        now = _now()
+        return db.execute(jobs.insert(), dict(
+            name=name,
+            payload=dump_json(payload),
+            status=JOB_PENDING,
+            attempts=0,
+            max_attempts=max_attempts,
+            created=now,
+            run_at=now + timedelta(seconds=delay)
+        )).last_inserted_ids()[0]
+
+    def execute(self, job):
+        """Execute a job.  Exceptions are logged and reraised."""
+        from zine.utils import log
+        try:
+            self.handlers[job.name](job)
+        except Exception:
+            log.exception('Job %r failed' % job.name, 'jobs')
+            raise
+
+    def get_retry_delay(self, attempts):
+        """Return the delay in seconds before the next attempt."""
+        delay = self.app.cfg['job_retry_delay'] * 2 ** max(attempts - 1, 0)
+        return min(delay, MAX_RETRY_DELAY)
+
+    def claim(self, worker_id, limit=10, lease=None):
+        """Claim up to `limit` jobs for a worker and return them."""
+        self.ensure_table()
+        if lease is None:
+            lease = self.app.cfg['job_lease_time']
+        engine = self.app.database_engine
+        j = jobs.c
+        now = _now()
+        candidates = engine.execute(db.select([j.job_id], _claimable(now),
+                                              order_by=[j.run_at],
+                                              limit=limit)).fetchall()
+        result = []
+        for row in candidates:
+            # another worker could have claimed the job in the meantime.
+            # the update only succeeds if the job is still claimable.
+            claimed = engine.execute(jobs.update(
+                (j.job_id == row.job_id) & _claimable(now), dict(
+                status=JOB_RUNNING,
+                locked_by=worker_id,
+                locked_until=now + timedelta(seconds=lease),
+                attempts=j.attempts + 1
+            ))).rowcount
+            if claimed != 1:
+                continue
+            job = engine.execute(jobs.select(j.job_id == row.job_id)).fetchone()
+            try:
+                payload = load_json(job.payload or '{}')
+            except ValueError:
+                payload = {}
+            result.append(Job(job.job_id, job.name, payload, job.attempts,
+                              job.max_attempts))
+        return result
+
+    def run(self, job, worker_id):
+        """Run a claimed job and update the queue afterwards."""
+        engine = self.app.database_engine
+        j = jobs.c
+        mine = (j.job_id == job.id) & (j.locked_by == worker_id)
+        try:
+            try:
+                if job.name not in self.handlers:
+                    raise LookupError('no handler for job %r' % job.name)
+                self.execute(job)
+                db.commit()
+            except Exception:
+                db.rollback()
+                error = format_exc().decode('utf-8', 'replace')
+                if job.last_attempt:
+                    values = dict(status=JOB_FAILED, locked_by=None,
+                                  locked_until=None, last_error=error)
+                else:
+                    values = dict(status=JOB_PENDING, locked_by=None,
+                                  locked_until=None, last_error=error,
+                                  run_at=_now() + timedelta(seconds=
+                                  self.get_retry_delay(job.attempts)))
+                engine.execute(jobs.update(mine), values)
+                return False
+            engine.execute(jobs.delete(mine))
+            return True
+        finally:
+            cleanup_session()
+
+    def process(self, worker_id, limit=10):
+        """Claim and run a batch of jobs.  Returns the number of jobs
+        that were processed.
+        """
+        claimed = self.claim(worker_id, limit)
+        for job in claimed:
+            self.run(job, worker_id)
+        return len(claimed)
+
+    def retry(self, job_id):
+        """Reschedule a failed job."""
+        db.execute(jobs.update(jobs.c.job_id == job_id), dict(
+            status=JOB_PENDING, attempts=0, run_at=_now(),
+            locked_by=None, locked_until=None))
+
+    def remove(self, job_id):
+        """Remove a job from the queue."""
+        db.execute(jobs.delete(jobs.c.job_id == job_id))
+
+    def get_stats(self):
+        """Return a dict with the number of pending, running and failed
+        jobs and the lists of failed and waiting jobs.
+        """
+        self.ensure_table()
+        j = jobs.c
+        counts = dict.fromkeys((JOB_PENDING, JOB_RUNNING, JOB_FAILED), 0)
+        for row in db.execute(db.select([j.status, db.func.count(j.job_id)],
+                                        group_by=[j.status])):
+            counts[row[0]] = row[1]
+        return {
+            'pending':  counts[JOB_PENDING],
+            'running':  counts[JOB_RUNNING],
+            'failed':   counts[JOB_FAILED],
+            'failures': db.execute(jobs.select(j.status == JOB_FAILED,
+                                               order_by=[j.created.desc()],
+                                               limit=50)).fetchall(),
+            'waiting':  db.execute(jobs.select(j.status != JOB_FAILED,
+                                               order_by=[j.run_at],
+                                               limit=50)).fetchall()
+        }
+
+
+def make_worker_id():
+    """Return an identifier for the current worker."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkerThread(Thread):
+    """A worker thread that processes jobs inside the application process.
+    The thread stops on its own once the application it was created for
+    is unloaded.
+    """
+
+    def __init__(self, app, interval=None):
+        Thread.__init__(self, name='zine-job-worker')
+        self.setDaemon(True)
+        self.app = app
+        self.interval = interval or app.cfg['job_poll_interval']
+        self.worker_id = '%s/thread' % make_worker_id()
+
+    def run(self):
+        from zine.utils import log
+        while _core._application is self.app:
+            try:
+                processed = self.app.jobs.process(self.worker_id)
+            except Exception:
+                log.exception('Job worker failed', 'jobs')
+                processed = 0
+            if not processed:
+                sleep(self.interval)
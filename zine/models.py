@@ -21,6 +21,7 @@ from zine.utils import zeml
 from zine.utils.text import gen_slug, gen_timestamped_slug, build_tag_uri, \
      increment_string
 from zine.utils.pagination import Pagination
+from zine.utils.datastructures import MutationDict
 from zine.utils.crypto import gen_pwhash, check_pwhash
 from zine.utils.http import make_external_url
 from zine.privileges import Privilege, _Privilege, privilege_attribute, \
@@ -29,6 +30,7 @@ from zine.privileges import Privilege, _Privilege, privilege_attribute, \
 from zine.application import get_application, get_request, url_for
 
 from zine.i18n import to_blog_timezone
+from zine.scheduling import get_cutoff as get_publication_cutoff
 
 #: all kind of states for a post
 STATUS_DRAFT = 1
@@ -73,7 +75,7 @@ class _ZEMLContainer(object):
 
     def _set_parser(self, value):
         if self.parser_data is None:
-            self.parser_data = {}
+            self.parser_data = zeml.ParserData()
         self.parser_data['parser'] = value
 
     parser = property(_get_parser, _set_parser, doc="The name of the parser.")
@@ -85,16 +87,25 @@ class _ZEMLContainer(object):
         if self.parser_data is not None:
             return self.parser_data.get('body')
 
-    def _parse_text(self, text):
+    @classmethod
+    def render_text(cls, text, parser):
+        """Parse the text with the given parser and return a dict with the
+        values for the parser data.  The parser name is not part of it.
+        """
         from zine.parsers import parse
-        self.parser_data['body'] = parse(text, self.parser, 'post')
+        return {'body': parse(text, parser, cls.parser_reason)}
+
+    def _parse_text(self, text):
+        # not update() which would load the old entries first
+        for key, value in self.render_text(text, self.parser).iteritems():
+            self.parser_data[key] = value
 
     def _get_text(self):
         return self._text
 
     def _set_text(self, value):
         if self.parser_data is None:
-            self.parser_data = {}
+            self.parser_data = zeml.ParserData()
         self._text = value
         self._parse_text(value)
 
@@ -102,30 +113,42 @@ class _ZEMLContainer(object):
     del _get_text, _set_text
 
     def find_urls(self):
-        """Iterate over all urls in the text.  This will only work if the
-        parser for this post is available, otherwise an exception is raised.
-        The URLs returned are absolute URLs.
+        """Iterate over all urls in the text.  The URLs returned are absolute
+        URLs.  If the links were stored when the text was parsed they are
+        used, otherwise the text is parsed again which only works if the
+        parser for this post is available.  In that case an exception is
+        raised if the parser is missing.
         """
-        from zine.parsers import parse
-        if self.parser_missing:
-            raise TypeError('parser is missing, urls cannot be looked up.')
+        links = None
+        if self.parser_data is not None:
+            links = self.parser_data.get('links')
+        if links is None:
+            from zine.parsers import parse
+            if self.parser_missing:
+                raise TypeError('parser is missing, urls cannot be looked up.')
+            tree = parse(self.text, self.parser, 'linksearch')
+            links = _extract_links(tree)
         found = set()
         this_url = url_for(self, _external=True)
-        tree = parse(self.text, self.parser, 'linksearch')
-        for node in tree.query('a[href]'):
-            href = urljoin(this_url, node.attributes['href'])
+        for href in links:
+            href = urljoin(this_url, href)
             if href not in found:
                 found.add(href)
                 yield href
 
 
 class _ZEMLDualContainer(_ZEMLContainer):
-    """Like the ZEML mixin but with intro and body sections."""
+    """Like the ZEML mixin but with intro and body sections.  The links in
+    the text are stored in the parser data so that :meth:`find_urls` does
+    not have to parse the text again.
+    """
 
-    def _parse_text(self, text):
+    @classmethod
+    def render_text(cls, text, parser):
         from zine.parsers import parse
-        self.parser_data['intro'], self.parser_data['body'] = \
-            zeml.split_intro(parse(text, self.parser, self.parser_reason))
+        intro, body = zeml.split_intro(parse(text, parser, cls.parser_reason))
+        return {'intro': intro, 'body': body,
+                'links': _extract_links(intro, body)}
 
     @property
     def intro(self):
@@ -134,6 +157,21 @@ class _ZEMLDualContainer(_ZEMLContainer):
             return self.parser_data.get('intro')
 
 
+def _extract_links(*trees):
+    """Return the targets of the links in the trees as list."""
+    return [node.attributes['href'] for tree in trees
+            for node in tree.query('a[href]') if node.attributes['href']]
+
+
+def _format_display_name(template, username, real_name):
+    """Fill in the display name template of an user."""
+    from string import Template
+    return Template(template or u'$username').safe_substitute(
+        username=username,
+        real_name=real_name
+    )
+
+
 class UserQuery(db.Query):
     """Add some extra query methods to the user object."""
 
@@ -167,7 +205,7 @@ class User(object):
         self.www = www
         self.real_name = real_name
         self.description = description
-        self.extra = {}
+        self.extra = MutationDict()
         self.display_name = u'$username'
         self.is_author = is_author
 
@@ -183,11 +221,8 @@ class User(object):
         self._display_name = value
 
     def _get_display_name(self):
-        from string import Template
-        return Template(self._display_name).safe_substitute(
-            username=self.username,
-            real_name=self.real_name
-        )
+        return _format_display_name(self._display_name, self.username,
+                                    self.real_name)
 
     display_name = property(_get_display_name, _set_display_name)
     own_privileges = privilege_attribute('_own_privileges')
@@ -317,6 +352,16 @@ class PostQuery(db.Query):
         """Filter all posts by a given type."""
         return self.filter_by(content_type=content_type)
 
+    def in_category(self, category):
+        """Filter all posts by a category object or row."""
+        return self.filter((post_categories.c.post_id == Post.id) &
+                           (post_categories.c.category_id == category.id))
+
+    def tagged(self, tag):
+        """Filter all posts by a tag object or row."""
+        return self.filter((post_tags.c.post_id == Post.id) &
+                           (post_tags.c.tag_id == tag.id))
+
     def for_index(self):
         """Return all the types for the index."""
         types = get_application().cfg['index_content_types']
@@ -325,16 +370,21 @@ class PostQuery(db.Query):
         return self.filter(Post.content_type.in_([x.strip() for x in types]))
 
     def published(self, ignore_privileges=None, user=None):
-        """Return a queryset for only published posts."""
+        """Return a queryset for only published posts.  Instead of the
+        current time the quantized cutoff from the publication schedule is
+        used so that the query stays the same until the next scheduled post
+        becomes visible.
+        """
         if not user:
             req = get_request()
             user = req and req.user
+        cutoff = get_publication_cutoff()
 
         if not user:
             # Anonymous. Return only public entries.
             return self.filter(
                 (Post.status == STATUS_PUBLISHED) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date < cutoff)
             )
         elif not user.has_privilege(VIEW_PROTECTED):
             # Authenticated user without protected viewing privilege
@@ -343,7 +393,7 @@ class PostQuery(db.Query):
                 ((Post.status == STATUS_PUBLISHED) |
                  ((Post.status == STATUS_PRIVATE) &
                   (Post.author_id == user.id))) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date < cutoff)
             )
         else:
             # Authenticated and can view protected.
@@ -353,7 +403,7 @@ class PostQuery(db.Query):
                  (Post.status == STATUS_PROTECTED) |
                  ((Post.status == STATUS_PRIVATE) &
                   (Post.author_id == user.id))) &
-                (Post.pub_date <= datetime.utcnow())
+                (Post.pub_date < cutoff)
             )
 
     def drafts(self, ignore_user=False, user=None):
@@ -395,6 +445,72 @@ class PostQuery(db.Query):
             'posts':            postlist
         }
 
+    def rows(self):
+        """Return the posts matched by the query as list of read-only
+        :class:`PostRow` objects.  The rows are built from a plain select
+        without the session, so there is no change tracking, no copy of
+        the parser data and no identity map involved.  Author, tags and
+        categories come from the entity cache or are loaded with one query
+        each for all the rows.
+        """
+        p = posts.c
+        result = [PostRow(*values) for values in self.values(
+            p.post_id, p.title, p.slug, p.pub_date, p.status,
+            p.content_type, p.comments_enabled, p.author_id,
+            p.parser_data, _comment_count_query)]
+        if not result:
+            return result
+
+        post_ids = [row.id for row in result]
+        cache = get_application().entity_cache
+        authors = cache.get_many('user', [row.author for row in result])
+        post_tags_map = cache.get_related('tag', post_tags, post_ids)
+        post_categories_map = cache.get_related('category', post_categories,
+                                                post_ids)
+
+        for row in result:
+            row.author = authors.get(row.author)
+            row.tags = post_tags_map.get(row.id, [])
+            row.categories = post_categories_map.get(row.id, [])
+        return result
+
+    def get_row_list(self, endpoint=None, page=1, per_page=None,
+                     url_args=None, raise_if_empty=True):
+        """Like :meth:`get_list` but the posts are :class:`PostRow`
+        objects.  Use this for overview pages that only display posts.
+        """
+        if per_page is None:
+            app = get_application()
+            per_page = app.cfg['posts_per_page']
+
+        offset = per_page * (page - 1)
+        postlist = self.order_by(Post.pub_date.desc()) \
+                       .offset(offset).limit(per_page).rows()
+
+        if raise_if_empty and (page != 1 and not postlist):
+            raise NotFound()
+
+        pagination = Pagination(endpoint, page, per_page,
+                                self.count(), url_args)
+
+        return {
+            'pagination':       pagination,
+            'posts':            postlist
+        }
+
+    def get_theme_list(self, key, **kwargs):
+        """Return the list for an overview page as configured by the
+        theme.  If the theme setting ``sql.<key>.rows`` is enabled the
+        posts are read-only rows (see :meth:`get_row_list`), otherwise
+        post objects loaded with the lightweight settings for `key`.
+        The rows are disabled by default, themes whose overview templates
+        only use the attributes of the rows can enable them.
+        """
+        theme_settings = get_application().theme.settings
+        if theme_settings.get('sql.%s.rows' % key):
+            return self.get_row_list(**kwargs)
+        return self.theme_lightweight(key).get_list(**kwargs)
+
     def get_archive_summary(self, detail='months', limit=None,
                             ignore_privileges=False):
         """Query function to get the archive of the blog. Usually used
@@ -513,10 +629,7 @@ class Post(_ZEMLDualContainer):
 
         self.parser = parser
         self.text = text or u''
-        if extra:
-            self.extra = dict(extra)
-        else:
-            self.extra = {}
+        self.extra = MutationDict(extra or ())
 
         self.comments_enabled = comments_enabled
         self.pings_enabled = pings_enabled
@@ -644,8 +757,10 @@ class Post(_ZEMLDualContainer):
             self.tags.remove(current_map[name])
 
         # add new tags
-        for name in new_tags.difference(currently_attached):
-            self.tags.append(Tag.get_or_create(name))
+        added = Tag.query.get_or_create_many(
+            new_tags.difference(currently_attached))
+        for name in sorted(added):
+            self.tags.append(added[name])
 
     def bind_categories(self, categories):
         """Rebinds the categories to the list passed.  The list of objects
@@ -740,6 +855,120 @@ class Post(_ZEMLDualContainer):
         )
 
 
+class _Row(object):
+    """Baseclass for the read-only rows returned by :meth:`PostQuery.rows`.
+    The values are passed in the order of the slots.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<%s %r>' % (
+            self.__class__.__name__,
+            getattr(self, self.__slots__[1])
+        )
+
+
+class UserRow(_Row):
+    """A read-only user.  Used for the authors of :class:`PostRow`\s and
+    by the entity cache.
+    """
+    __slots__ = ('id', 'username', 'real_name', 'display_name', 'www',
+                 'is_author', 'description')
+
+    def __init__(self, *values):
+        _Row.__init__(self, *values)
+        self.display_name = _format_display_name(self.display_name,
+                                                 self.username,
+                                                 self.real_name)
+
+    def get_url_values(self):
+        if self.is_author:
+            return 'blog/show_author', {
+                'username': self.username
+            }
+        return self.www or '#'
+
+
+class GroupRow(_Row):
+    """A read-only group."""
+    __slots__ = ('id', 'name')
+
+    def get_url_values(self):
+        return 'admin/edit_group', {'group_id': self.id}
+
+
+class CategoryRow(_Row):
+    """A read-only category."""
+    __slots__ = ('id', 'name', 'slug', 'description')
+
+    def get_url_values(self):
+        return 'blog/show_category', {
+            'slug':     self.slug
+        }
+
+
+class TagRow(_Row):
+    """A read-only tag."""
+    __slots__ = ('id', 'name', 'slug')
+
+    def get_url_values(self):
+        return 'blog/show_tag', {'slug': self.slug}
+
+
+class PostRow(_Row):
+    """A read-only post for overview pages.  It has the attributes the
+    overview templates use but the intro and body are already rendered to
+    HTML and the comment count only counts visible comments.
+    """
+    __slots__ = ('id', 'title', 'slug', 'pub_date', 'status',
+                 'content_type', 'comments_enabled', 'author', 'parser',
+                 'comment_count', 'intro', 'body', 'tags', 'categories')
+
+    def __init__(self, id, title, slug, pub_date, status, content_type,
+                 comments_enabled, author_id, parser_data, comment_count):
+        _Row.__init__(self, id, title, slug, pub_date, status,
+                      content_type, comments_enabled, author_id)
+        self.comment_count = comment_count or 0
+        self.parser = self.intro = self.body = None
+        if parser_data is not None:
+            self.parser = parser_data.get('parser')
+            self.intro = parser_data.get_html('intro')
+            self.body = parser_data.get_html('body')
+
+    @property
+    def comment_feed_url(self):
+        """The link to the comment feed."""
+        return make_external_url(self.slug.rstrip('/') + '/feed.atom')
+
+    @property
+    def is_draft(self):
+        """True if this post is unpublished."""
+        return self.status == STATUS_DRAFT
+
+    @property
+    def is_private(self):
+        """`True` if the post is marked private."""
+        return self.status == STATUS_PRIVATE
+
+    @property
+    def is_protected(self):
+        """`True` if the post is marked protected."""
+        return self.status == STATUS_PROTECTED
+
+    @property
+    def is_scheduled(self):
+        """True if the item is scheduled for appearing."""
+        return self.status == STATUS_PUBLISHED and \
+               self.pub_date > datetime.utcnow()
+
+    def get_url_values(self):
+        return self.slug
+
+
 class PostLink(object):
     """Represents a link in a post.  This can be used for podcasts or other
     resources that require ``<link>`` categories.
@@ -1025,8 +1254,86 @@ class Comment(_ZEMLContainer):
         )
 
 
+class _PostScheduleExtension(db.MapperExtension):
+    """Invalidates the publication schedule if posts change."""
+
+    def _invalidate(self, mapper, connection, instance):
+        get_application().publication_schedule.invalidate()
+        return db.EXT_CONTINUE
+
+    after_insert = after_update = after_delete = _invalidate
+
+
 class TagQuery(db.Query):
 
+    def get_or_create_many(self, names, slugs=None):
+        """Get or create the tags for all the names given and return a
+        dict mapping each name to its tag.  Existing tags are looked up
+        with a single query and the slugs for the tags that have to be
+        created are allocated in batches instead of one query per tag.
+
+        `slugs` can be a dict that maps names to preferred slugs.  If a
+        tag with one of those slugs already exists it's reused, otherwise
+        the new tag is created with that slug (or an incremented version
+        of it if it's taken).
+        """
+        names = set(names)
+        if not names:
+            return {}
+        if slugs is None:
+            slugs = {}
+
+        result = dict((tag.name, tag) for tag in
+                      self.filter(Tag.name.in_(list(names))))
+        missing = names.difference(result)
+
+        # reuse existing tags with the preferred slugs
+        preferred = dict((slugs[name], name) for name in missing
+                         if slugs.get(name))
+        if preferred:
+            for tag in self.autoflush(False) \
+                           .filter(Tag.slug.in_(preferred.keys())):
+                result[preferred[tag.slug]] = tag
+            missing.difference_update(result)
+        if not missing:
+            return result
+
+        wanted = {}
+        fallback = None
+        for name in missing:
+            slug = slugs.get(name) or gen_slug(name)
+            if not slug:
+                # if slug generation failed we select the highest tag
+                # id as base for slug generation.
+                if fallback is None:
+                    tag = self.autoflush(False).order_by(Tag.id.desc()).first()
+                    fallback = unicode(tag and tag.id or u'1')
+                slug = fallback
+            wanted[name] = slug
+
+        # allocate the slugs.  every round sends one query for all the
+        # slugs that are still in question and increments the ones that
+        # are taken, either in the database or by another new tag.
+        allocated = set()
+        pending = sorted(missing)
+        while pending:
+            taken = set(row.slug for row in db.execute(
+                db.select([tags.c.slug],
+                          tags.c.slug.in_(set(wanted[x] for x in pending)))))
+            retry = []
+            for name in pending:
+                slug = wanted[name]
+                if slug in taken or slug in allocated:
+                    wanted[name] = increment_string(slug)
+                    retry.append(name)
+                else:
+                    allocated.add(slug)
+            pending = retry
+
+        for name in missing:
+            result[name] = Tag(name, wanted[name])
+        return result
+
     def get_cloud(self, max=None, ignore_privileges=False):
         """Get a categorycloud."""
         # XXX: ignore_privileges is currently ignored and no privilege
@@ -1041,7 +1348,7 @@ class TagQuery(db.Query):
         q = ((pt.tag_id == t.tag_id) &
              (pt.post_id == p.post_id) &
              (p.status == STATUS_PUBLISHED) &
-             (p.pub_date <= datetime.utcnow()))
+             (p.pub_date < get_publication_cutoff()))
 
         s = db.select([t.slug, t.name, db.func.count(p.post_id).label('s_count')],
                       q, group_by=[t.slug, t.name]).alias('post_count_query').c
@@ -1078,10 +1385,7 @@ class Tag(object):
 
     @staticmethod
     def get_or_create(name):
-        tag = Tag.query.filter_by(name=name).first()
-        if tag is not None:
-            return tag
-        return Tag(name)
+        return Tag.query.get_or_create_many([name])[name]
 
     def set_auto_slug(self):
         full_slug = gen_slug(self.name)
@@ -1106,10 +1410,19 @@ class Tag(object):
         )
 
 
+# the number of visible comments of a post.  Used by the mapper for
+# lightweight posts and by the rows.
+_comment_count_query = db.select([db.func.count(comments.c.comment_id)],
+    (comments.c.post_id == posts.c.post_id) &
+    (comments.c.status == COMMENT_MODERATED)
+).label('comment_count')
+
+
 # connect the tables.
 db.mapper(User, users, properties={
     'id':               users.c.user_id,
     'display_name':     db.synonym('_display_name', map_column=True),
+    'extra':            db.deferred(users.c.extra),
     'posts':            db.dynamic_loader(Post,
                                           backref=db.backref('author', lazy=False),
                                           query_class=PostQuery,
@@ -1165,6 +1478,7 @@ db.mapper(Tag, tags, properties={
 db.mapper(Post, posts, properties={
     'id':               posts.c.post_id,
     'text':             db.synonym('_text', map_column=True),
+    'extra':            db.deferred(posts.c.extra),
     'comments':         db.relation(Comment, backref='post',
                                     primaryjoin=posts.c.post_id ==
                                         comments.c.post_id,
@@ -1177,9 +1491,6 @@ db.mapper(Post, posts, properties={
                                     order_by=[db.asc(categories.c.name)]),
     'tags':             db.relation(Tag, secondary=post_tags, lazy=False,
                                     order_by=[tags.c.name]),
-    '_comment_count':   db.column_property(
-        db.select([db.func.count(comments.c.comment_id)],
-                  (comments.c.post_id == posts.c.post_id) &
-                  (comments.c.status == COMMENT_MODERATED)
-        ).label('comment_count'), deferred=True)
-}, order_by=posts.c.pub_date.desc())
+    '_comment_count':   db.column_property(_comment_count_query,
+                                       deferred=True)
+}, order_by=posts.c.pub_date.desc(), extension=_PostScheduleExtension())
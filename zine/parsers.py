@@ -9,12 +9,12 @@
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from werkzeug import escape
+from werkzeug import escape, import_string
 
 from zine.i18n import lazy_gettext
-from zine.application import iter_listeners, get_application
+from zine.application import iter_listeners, get_application, emit_event
 from zine.utils.zeml import parse_html, parse_zeml, sanitize, Element, \
-     RootElement
+     RootElement, SanitizerReport
 from zine.utils.xml import replace_entities
 
 
@@ -47,15 +47,35 @@ def parse(input_data, parser=None, reason='unknown'):
 
     tree = parser.parse(input_data, reason)
 
-    #! allow plugins to alter the doctree.
+    #! allow plugins to alter the doctree.  Handlers that run many queries
+    #! can pass `indexed=True` to `tree.query`, the index is dropped after
+    #! all handlers ran.
     for callback in iter_listeners('process-doc-tree'):
         item = callback(tree, input_data, reason)
         if item is not None:
+            tree.invalidate_index()
             tree = item
+    tree.invalidate_index()
 
     return tree
 
 
+def sanitize_untrusted(tree, input_data, reason):
+    """Sanitize an untrusted tree (a comment for example) and emit the
+    `untrusted-tree-sanitized` event if something was removed.
+    """
+    report = SanitizerReport()
+    tree = sanitize(tree, report)
+    if report:
+        #! emitted if the sanitizer removed elements or attributes from an
+        #! untrusted tree.  The tree, the input data, the parsing reason and
+        #! the `SanitizerReport` that lists the removed parts are passed.
+        #! Moderation tools can use it instead of parsing the text again.
+        emit_event('untrusted-tree-sanitized', tree, input_data, reason,
+                   report)
+    return tree
+
+
 class BaseParser(object):
     """Baseclass for all kinds of parsers."""
 
@@ -69,6 +89,32 @@ class BaseParser(object):
         """Return a ZEML tree."""
 
 
+class LazyParser(BaseParser):
+    """Stands in for a parser that is imported when it's used for the first
+    time.  `import_name` is the import string of the parser class
+    (``'module:Class'``).
+    """
+
+    def __init__(self, app, import_name):
+        BaseParser.__init__(self, app)
+        self.import_name = import_name
+        self._parser = None
+
+    @property
+    def parser(self):
+        """The real parser.  The first access imports it."""
+        if self._parser is None:
+            self._parser = import_string(self.import_name)(self.app)
+        return self._parser
+
+    @property
+    def name(self):
+        return self.parser.name
+
+    def parse(self, input_data, reason):
+        return self.parser.parse(input_data, reason)
+
+
 class ZEMLParser(BaseParser):
     """The parser for the ZEML Markup language."""
 
@@ -77,7 +123,7 @@ class ZEMLParser(BaseParser):
     def parse(self, input_data, reason):
         rv = parse_zeml(input_data, self.app.zeml_element_handlers)
         if reason == 'comment':
-            rv = sanitize(rv)
+            rv = sanitize_untrusted(rv, input_data, reason)
         return rv
 
 
@@ -89,7 +135,7 @@ class HTMLParser(BaseParser):
     def parse(self, input_data, reason):
         rv = parse_html(input_data)
         if reason == 'comment':
-            rv = sanitize(rv)
+            rv = sanitize_untrusted(rv, input_data, reason)
         return rv
 
 
@@ -123,6 +123,18 @@ def pingback(source_uri, target_uri):
         raise PingbackError(32)
 
 
+def pingback_job(job):
+    """Job handler that sends a pingback from ``job.payload['source']``
+    to ``job.payload['target']``.  Errors that won't go away by trying
+    again are ignored, all others cause a retry.
+    """
+    try:
+        pingback(job.payload['source'], job.payload['target'])
+    except PingbackError, e:
+        if not e.ignore_silently:
+            raise
+
+
 def handle_pingback_request(source_uri, target_uri):
     """This method is exported via XMLRPC as `pingback.ping` by the
     pingback API.
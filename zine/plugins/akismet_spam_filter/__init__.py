@@ -16,7 +16,8 @@ import zine
 from zine.api import *
 from zine.widgets import Widget
 from zine.views.admin import flash, render_admin_response
-from zine.models import COMMENT_BLOCKED_SPAM, COMMENT_MODERATED, Comment
+from zine.models import COMMENT_BLOCKED_SPAM, COMMENT_MODERATED, \
+     COMMENT_UNMODERATED, Comment
 from zine.privileges import BLOG_ADMIN, MODERATE_COMMENTS, require_privilege
 from zine.utils.validators import ValidationError, check
 from zine.utils.http import redirect_to
@@ -30,6 +31,7 @@ AKISMET_VERSION = '1.1'
 SHARED = join(dirname(__file__), 'shared')
 TEMPLATES = join(dirname(__file__), 'templates')
 BLOCKED_MSG = _('blocked by akismet')
+PENDING_MSG = _('waiting for akismet')
 
 
 #: because we need the information about verified keys quite often
@@ -129,6 +131,21 @@ def build_akismet_data(req, comment):
     return apikey, data
 
 
+def use_background_jobs():
+    """`True` if the akismet requests are sent from the job queue."""
+    app = get_application()
+    return app.jobs.enabled and app.cfg['akismet_spam_filter/background']
+
+
+def make_job_payload(apikey, data):
+    """Convert the akismet data into a JSON serializable job payload."""
+    return {
+        'apikey':   apikey,
+        'data':     dict((key, unicode(value)) for key, value
+                         in data.iteritems() if value is not None)
+    }
+
+
 def do_spamcheck(req, comment):
     """Do spamchecking for all new comments."""
     # something blocked the comment already. no need to check for spam then.
@@ -139,39 +156,91 @@ def do_spamcheck(req, comment):
     if not (data or apikey):
         return
 
+    # the comment is hidden until the job queue checked it.  the job is
+    # enqueued once the comment is saved and has an id.
+    if use_background_jobs():
+        comment.status = COMMENT_UNMODERATED
+        comment.blocked_msg = PENDING_MSG
+        comment._akismet_payload = make_job_payload(apikey, data)
+        return
+
     resp = send_request(apikey, True, data, 'comment-check')
     if resp == 'true':
         comment.status = COMMENT_BLOCKED_SPAM
         comment.blocked_msg = BLOCKED_MSG
 
 
-def do_submit_spam(comment):
-    """Contribute to akismet; submit spam."""
-    # comment is spam, don't submit it to akismet again
-    if comment.blocked:
+def enqueue_spamcheck(req, comment):
+    """Enqueue the spam check for a comment that waits for akismet."""
+    payload = getattr(comment, '_akismet_payload', None)
+    if payload is None:
+        return
+    db.flush()
+    payload['comment_id'] = comment.id
+    get_application().enqueue_job('akismet_spam_filter/check', payload)
+
+
+def spamcheck_job(job):
+    """Job handler for the background spam check."""
+    comment = Comment.query.get(job.payload['comment_id'])
+    if comment is None or comment.blocked_msg != PENDING_MSG:
         return
+    resp = send_request(job.payload['apikey'], True, job.payload['data'],
+                        'comment-check')
+    if resp is None:
+        raise RuntimeError('akismet server not reachable')
+    if resp == 'true':
+        comment.status = COMMENT_BLOCKED_SPAM
+        comment.blocked_msg = BLOCKED_MSG
+    elif comment.requires_moderation:
+        comment.blocked_msg = _(u'Comment waiting for approval')
+    else:
+        comment.status = COMMENT_MODERATED
+        comment.blocked_msg = None
+
 
+def submit_job(job):
+    """Job handler that submits spam or ham to akismet."""
+    if send_request(job.payload['apikey'], True, job.payload['data'],
+                    job.payload['endpoint']) is None:
+        raise RuntimeError('akismet server not reachable')
+
+
+def submit_comment(comment, endpoint):
+    """Submit a comment as spam or ham, either right away or through the
+    job queue.
+    """
     apikey, data = build_akismet_data(get_request(), comment)
     if not (data or apikey):
         return
 
-    send_request(apikey, True, data, 'submit-spam')
-    # Blocking flags will be issued by the form calling this
+    if use_background_jobs():
+        payload = make_job_payload(apikey, data)
+        payload['endpoint'] = endpoint
+        get_application().enqueue_job('akismet_spam_filter/submit', payload)
+        flash(_("Comment by %s will be reported to Akismet") %
+              comment.author)
+        return
+
+    send_request(apikey, True, data, endpoint)
     flash(_("Comment by %s reported to Akismet") % comment.author)
 
 
+def do_submit_spam(comment):
+    """Contribute to akismet; submit spam."""
+    # comment is spam, don't submit it to akismet again
+    if comment.blocked:
+        return
+    # Blocking flags will be issued by the form calling this
+    submit_comment(comment, 'submit-spam')
+
+
 def do_submit_ham(comment):
     """Contribute to akismet; submit ham."""
     # comment is not spam, don't submit it to akismet
     if not comment.blocked:
         return
-
-    apikey, data = build_akismet_data(get_request(), comment)
-    if not (data or apikey):
-        return
-
-    send_request(apikey, True, data, 'submit-ham')
-    flash(_("Comment by %s reported to Akismet") % comment.author)
+    submit_comment(comment, 'submit-ham')
 
 
 def add_akismet_links(req, navigation_bar):
@@ -246,6 +315,8 @@ class AkismetBlockedCommentsCounterWidget(Widget):
 def setup(app, plugin):
     app.add_config_var('akismet_spam_filter/apikey',
                        forms.TextField(default=u''))
+    app.add_config_var('akismet_spam_filter/background',
+                       forms.BooleanField(default=False))
     app.add_url_rule('/options/akismet', prefix='admin',
                      endpoint='akismet_spam_filter/config',
                      view=show_akismet_config)
@@ -253,6 +324,9 @@ def setup(app, plugin):
                      endpoint='akismet_spam_filter/stats',
                      view=show_akismet_stats)
     app.connect_event('before-comment-saved', do_spamcheck)
+    app.connect_event('after-comment-saved', enqueue_spamcheck)
+    app.add_job_handler('akismet_spam_filter/check', spamcheck_job)
+    app.add_job_handler('akismet_spam_filter/submit', submit_job)
     app.connect_event('before-comment-mark-spam', do_submit_spam)
     app.connect_event('before-comment-mark-ham', do_submit_ham)
     app.connect_event('modify-admin-navigation-bar', add_akismet_links)
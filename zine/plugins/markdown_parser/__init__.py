@@ -5,29 +5,21 @@
 
     Use Markdown for your blog posts.
 
-    TODO: this parser does not support `<intro>` sections and has a
-          very bad implementation as it requires multiple parsing steps.
+    The parser itself is in :mod:`parser` and registered by its import
+    name, so Markdown is only imported when something is parsed with it.
 
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 import os.path
-import re
 from zine.api import *
-from zine.parsers import BaseParser
 from zine.views.admin import flash, render_admin_response
 from zine.privileges import BLOG_ADMIN, require_privilege
-from zine.utils.zeml import parse_html
 from zine.utils import forms
-try:
-    import markdown as md
-except ImportError:
-    from zine.plugins.markdown_parser import local_markdown as md
 
 TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
 CFG_EXTENSIONS='markdown_parser/extensions'
 CFG_MAKEINTRO='markdown_parser/makeintro'
-MORE_TAG = re.compile(r'\n<!--\s*more\s*-->\n(?u)')
 
 
 class ConfigurationForm(forms.Form):
@@ -68,29 +60,9 @@ def add_config_link(req, navigation_bar):
                                     _('Markdown')))
 
 
-class MarkdownParser(BaseParser):
-    """A simple markdown parser."""
-
-    name = _(u'Markdown')
-
-    def parse(self, input_data, reason):
-        cfg = get_application().cfg
-        parser = md.Markdown(safe_mode=reason == 'comment' and 'escape',
-                             extensions=cfg[CFG_EXTENSIONS],
-                             #: For compatibility with the Pygments plugin
-                             extension_configs={'codehilite':
-                                                    {'css_class': 'syntax'}})
-        html = parser.convert(input_data)
-        if cfg[CFG_MAKEINTRO]:
-            if MORE_TAG.search(html):
-                #: Crude hack, but parse_html will correct any html
-                #: closure errors we introduce
-                html = u'<intro>' + MORE_TAG.sub(u'</intro>', html, 1)
-        return parse_html(html)
-
-
 def setup(app, plugin):
-    app.add_parser('markdown', MarkdownParser)
+    app.add_parser('markdown',
+                   'zine.plugins.markdown_parser.parser:MarkdownParser')
     app.add_config_var(CFG_EXTENSIONS,
                        forms.LineSeparated(forms.TextField(), default=[]))
     app.add_config_var(CFG_MAKEINTRO, forms.BooleanField(default=False))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.plugins.markdown_parser.parser
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The Markdown parser.  It's imported when the parser is used the first
+    time, so Markdown is not loaded on startup.
+
+    The Markdown converters are expensive to create, so they are kept in a
+    pool per configuration and reset before they are used again.  With the
+    bundled Markdown version the ZEML tree is built from the document tree
+    of the converter unless raw HTML has to be inserted; in that case and
+    with other Markdown versions the HTML output is parsed again.
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+from threading import Lock
+from zine.api import *
+from zine.parsers import BaseParser
+from zine.utils.zeml import parse_html, resolve_entities, RootElement, \
+     Element
+from zine.plugins.markdown_parser import CFG_EXTENSIONS, CFG_MAKEINTRO
+try:
+    import markdown as md
+except ImportError:
+    from zine.plugins.markdown_parser import local_markdown as md
+
+MORE_TAG = re.compile(r'\n<!--\s*more\s*-->\n(?u)')
+
+#: the number of idle converters kept per configuration
+POOL_SIZE = 8
+
+#: Markdown before 2.0 keeps the state of a conversion in module globals,
+#: so only one conversion can run at a time.  It also has a document tree
+#: the ZEML tree can be built from.
+_legacy_markdown = getattr(md, 'version_info', (2,)) < (2,)
+_conversion_lock = _legacy_markdown and Lock() or None
+
+#: idle converters by ``(safe_mode, extensions)``
+_converters = {}
+_converters_lock = Lock()
+
+_placeholder_re = None
+if _legacy_markdown:
+    _placeholder_re = re.compile(r'(\d+)'.join(map(re.escape,
+                                 md.HTML_PLACEHOLDER.split('%d'))))
+_charref_re = re.compile(r'&#(?:\d+|[xX][0-9a-fA-F]+);')
+_entity_only_re = re.compile(r'^&#?\w+;$')
+_empty_tag_re = re.compile(r'^<(\w+)\s*/?>$')
+_block_elements = set(['p', 'div', 'blockquote', 'pre', 'ul', 'ol', 'li',
+                       'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'table'])
+
+
+def acquire_converter(safe_mode, extensions):
+    """Return an idle converter from the pool or a new one.  Give it back
+    with :func:`release_converter` after the conversion.
+    """
+    key = (safe_mode, tuple(extensions))
+    _converters_lock.acquire()
+    try:
+        idle = _converters.get(key)
+        if idle:
+            return idle.pop()
+    finally:
+        _converters_lock.release()
+    return md.Markdown(safe_mode=safe_mode, extensions=list(extensions),
+                       #: For compatibility with the Pygments plugin
+                       extension_configs={'codehilite':
+                                              {'css_class': 'syntax'}})
+
+
+def release_converter(converter, safe_mode, extensions):
+    """Put a converter back into the pool."""
+    key = (safe_mode, tuple(extensions))
+    _converters_lock.acquire()
+    try:
+        idle = _converters.setdefault(key, [])
+        if len(idle) < POOL_SIZE:
+            idle.append(converter)
+    finally:
+        _converters_lock.release()
+
+
+class _RawHTML(Exception):
+    """Raised if raw HTML would have to be inserted into the tree."""
+
+
+def _stashed_node(converter, index):
+    """Return the text or element for a stashed HTML block or raise
+    `_RawHTML` if the block is HTML that is inserted as it is.
+    """
+    html, safe = converter.htmlStash.rawHtmlBlocks[index]
+    if converter.safeMode and not safe:
+        safe_mode = str(converter.safeMode).lower()
+        if safe_mode == 'escape':
+            return html
+        elif safe_mode == 'remove':
+            return u''
+        return md.HTML_REMOVED_TEXT
+    if _entity_only_re.match(html):
+        return resolve_entities(html)
+    # horizontal rules are stashed as safe html by markdown itself
+    match = safe and _empty_tag_re.match(html)
+    if match:
+        return Element(match.group(1))
+    raise _RawHTML()
+
+
+def _is_placeholder(node):
+    """Check if a node is a text node with nothing but a placeholder."""
+    if node.type != 'text':
+        return False
+    match = _placeholder_re.match(node.value)
+    return match is not None and match.end() == len(node.value)
+
+
+def _nanodom_to_zeml(converter, node, element):
+    """Convert the children and attributes of a node of the bundled
+    Markdown's document tree into the ZEML element.  This follows what
+    the `toxml` method of the node does.
+    """
+    children = element.children
+    def add_text(text):
+        if children:
+            children[-1].tail += text
+        else:
+            element.text += text
+    def add_placeholders(text):
+        pos = 0
+        for match in _placeholder_re.finditer(text):
+            add_text(text[pos:match.start()])
+            node = _stashed_node(converter, int(match.group(1)))
+            if isinstance(node, basestring):
+                add_text(node)
+            else:
+                node.parent = element
+                children.append(node)
+            pos = match.end()
+        add_text(text[pos:])
+
+    if md.ENABLE_ATTRIBUTES:
+        for child in node.childNodes:
+            child.handleAttributes()
+    for child in node.childNodes:
+        if child.type == 'element':
+            # html blocks are paragraphs with just the placeholder
+            if child.nodeName == 'p' and len(child.childNodes) == 1 and \
+               _is_placeholder(child.childNodes[0]):
+                add_placeholders(child.childNodes[0].value)
+                add_text(u'\n')
+                continue
+            new_element = Element(child.nodeName.strip())
+            new_element.parent = element
+            _nanodom_to_zeml(converter, child, new_element)
+            children.append(new_element)
+            if child.nodeName in _block_elements:
+                new_element.tail = u'\n'
+        elif child.type == 'text':
+            node.setBidi(md.getBidiType(child.value))
+            add_placeholders(child.value)
+        elif child.type == 'entity_ref':
+            add_text(resolve_entities(u'&%s;' % child.entity))
+        elif child.type == 'cdata':
+            add_text(child.text)
+
+    if element.is_root:
+        return
+    if node.nodeName in ('p', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4',
+                         'h5', 'h6') and 'dir' not in node.attribute_values:
+        if (node.bidi or node.doc.bidi) == 'rtl':
+            node.setAttribute('dir', 'rtl')
+    for key in node.attributes:
+        value = node.attribute_values[key]
+        if _placeholder_re.search(value):
+            raise _RawHTML()
+        # numeric entities are kept by markdown, the others are escaped
+        element.attributes[key] = _charref_re.sub(
+            lambda m: resolve_entities(m.group(0)), value)
+
+
+def _convert(converter, source, makeintro):
+    """Convert the source with the converter and return the ZEML tree."""
+    if not _legacy_markdown or converter.docType or \
+       converter.textPostprocessors != [md.RAWHTMLTEXTPOSTPROCESSOR]:
+        return _parse_html(converter.convert(source), makeintro)
+
+    # the beginning of the `convert` method of the bundled markdown
+    converter.source = unicode(source)
+    if not converter.source:
+        return RootElement()
+    for pp in converter.textPreprocessors:
+        converter.source = pp.run(converter.source)
+    doc = converter._transform()
+
+    tree = RootElement()
+    try:
+        _nanodom_to_zeml(converter, doc.documentElement, tree)
+    except _RawHTML:
+        # the rest of the `convert` method
+        xml = doc.toxml()
+        if converter.stripTopLevelTags:
+            xml = xml.strip()[23:-7] + '\n'
+        for pp in converter.textPostprocessors:
+            xml = pp.run(xml)
+        return _parse_html(xml.strip(), makeintro)
+
+    tree.text = tree.text.lstrip()
+    if tree.children:
+        tree.children[-1].tail = tree.children[-1].tail.rstrip()
+    else:
+        tree.text = tree.text.rstrip()
+    return tree
+
+
+def _parse_html(html, makeintro):
+    if makeintro:
+        if MORE_TAG.search(html):
+            #: Crude hack, but parse_html will correct any html
+            #: closure errors we introduce
+            html = u'<intro>' + MORE_TAG.sub(u'</intro>', html, 1)
+    return parse_html(html)
+
+
+class MarkdownParser(BaseParser):
+    """A simple markdown parser."""
+
+    name = _(u'Markdown')
+
+    def parse(self, input_data, reason):
+        cfg = get_application().cfg
+        safe_mode = reason == 'comment' and 'escape' or False
+        extensions = cfg[CFG_EXTENSIONS]
+        if _conversion_lock is not None:
+            _conversion_lock.acquire()
+        try:
+            converter = acquire_converter(safe_mode, extensions)
+            converter.reset()
+            rv = _convert(converter, input_data, cfg[CFG_MAKEINTRO])
+            release_converter(converter, safe_mode, extensions)
+        finally:
+            if _conversion_lock is not None:
+                _conversion_lock.release()
+        return rv
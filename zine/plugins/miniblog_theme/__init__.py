@@ -22,7 +22,15 @@ THEME_SETTINGS = {
 
     # and ultra short date formats
     'date.datetime_format.default': 'short',
-    'date.date_format.default':     'short'
+    'date.date_format.default':     'short',
+
+    # the overview pages use the builtin templates which work with the
+    # read-only post rows
+    'sql.index.rows':               True,
+    'sql.author.rows':              True,
+    'sql.archive.rows':             True,
+    'sql.category.rows':            True,
+    'sql.tag.rows':                 True
 }
 
 def setup(app, plugin):
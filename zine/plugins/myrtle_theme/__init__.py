@@ -18,7 +18,15 @@ THEME_SETTINGS = {
     'pagination.threshold':         2,
     'pagination.next_link':         True,
     'pagination.prev_link':         True,
-    'pagination.commata':           u'<span class="commata"> ·\n</span>'
+    'pagination.commata':           u'<span class="commata"> ·\n</span>',
+
+    # the overview pages use the builtin templates which work with the
+    # read-only post rows
+    'sql.index.rows':               True,
+    'sql.author.rows':              True,
+    'sql.archive.rows':             True,
+    'sql.category.rows':            True,
+    'sql.tag.rows':                 True
 }
 
 def setup(app, plugin):
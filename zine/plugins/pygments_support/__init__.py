@@ -5,82 +5,67 @@
 
     Adds support for pygments to pre code blocks.
 
+    Importing pygments and looking up its styles is slow, so this module
+    only registers the element handler and the views by their import names.
+    The code that uses pygments lives in :mod:`highlighting` and is
+    imported when it's used the first time.  The functions of that module
+    that other plugins used from here are still available here.
+
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import sys
 from os.path import join, dirname
-from time import time, asctime, gmtime
-
-from werkzeug import escape
-from werkzeug.exceptions import NotFound
+from UserDict import DictMixin
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 try:
-    from pygments import highlight
-    from pygments.lexers import get_lexer_by_name
-    from pygments.formatters import HtmlFormatter
-    from pygments.styles import get_all_styles, get_style_by_name
+    import pygments
     have_pygments = True
 except ImportError:
     have_pygments = False
 
 from zine.api import *
-from zine.views.admin import render_admin_response, flash
 from zine.privileges import BLOG_ADMIN
 from zine.utils import forms
-from zine.utils.zeml import HTMLElement, ElementHandler
-from zine.utils.http import redirect_to
 
 
-#: cache for formatters
-_formatters = {}
+TEMPLATES = join(dirname(__file__), 'templates')
+HIGHLIGHTING = 'zine.plugins.pygments_support.highlighting'
 
-#: dict of styles
-STYLES = dict((x, None) for x in get_all_styles())
+#: the styles added with :func:`add_style` by name
+_custom_styles = {}
 
 
-TEMPLATES = join(dirname(__file__), 'templates')
-PYGMENTS_URL = 'http://pygments.org/'
-EXAMPLE = '''\
-<!DOCTYPE HTML>
-<html>
-  <head>
-    <title>{% block title %}Untitled{% endblock %}</title>
-    <style type="text/css">
-      body {
-        background-color: #333;
-        color: #eee;
-      }
-    </style>
-    <script type="text/javascript">
-      function fun() {
-        alert('This is a piece of example code');
-      }
-    </script>
-  </head>
-  <body onload="fun()">
-    {% block body %}{% endblock %}
-  </body>
-</html>\
-'''
-
-
-class SourcecodeHandler(ElementHandler):
-    """Provides a ``<sourcecode>`` tag."""
-    tag = 'sourcecode'
-    is_isolated = True
-    is_block_level = True
-
-    def process(self, element):
-        lexer_name = element.attributes.get('syntax', 'text')
-        try:
-            lexer = get_lexer_by_name(lexer_name)
-        except ValueError:
-            lexer = get_lexer_by_name('text')
-        return HTMLElement(highlight(element.text, lexer, get_formatter()))
-
-
-class ConfigurationForm(forms.Form):
-    style = forms.ChoiceField(required=True)
+def _get_highlighting():
+    from zine.plugins.pygments_support import highlighting
+    return highlighting
+
+
+class _StyleDict(DictMixin):
+    """The names of all styles mapped to the styles added with
+    :func:`add_style` or `None` for the styles of pygments.  Kept for
+    plugins that used the `STYLES` dict of older versions.
+    """
+
+    def keys(self):
+        return _get_highlighting().list_styles()
+
+    def __getitem__(self, name):
+        if name in _custom_styles:
+            return _custom_styles[name]
+        if name not in self.keys():
+            raise KeyError(name)
+
+    def __setitem__(self, name, style):
+        add_style(name, style)
+
+
+#: dict of styles
+STYLES = _StyleDict()
 
 
 def get_current_style():
@@ -90,94 +75,47 @@ def get_current_style():
     return get_application().cfg['pygments_support/style']
 
 
-def lookup_style(name):
-    """Return the style object for the given name."""
-    rv = STYLES.get(name, 'default')
-    if rv is None:
-        return get_style_by_name(name)
-    return rv
-
-
 def add_style(name, style):
     """Register a new style for pygments."""
-    STYLES[name] = style
+    _custom_styles[name] = style
+    highlighting = sys.modules.get(HIGHLIGHTING)
+    if highlighting is not None:
+        highlighting.forget_style(name)
 
 
-def get_formatter(style=None, preview=False):
-    """Helper function that returns a formatter in either preview or
-    normal mode for the style provided or the current style if not
-    further defined.
+def lookup_style(name):
+    """Return the style object for the given name."""
+    return _get_highlighting().lookup_style(name)
 
-    The formatter returned should be treated as immutable object
-    because it might be shared and cached.
-    """
-    if style is None:
-        style = get_current_style()
-    if not preview and style in _formatters:
-        return _formatters[style]
-    try:
-        if preview:
-            cls = 'highlight_preview'
-        else:
-            cls = 'syntax'
-        style_cls = lookup_style(style)
-        formatter = HtmlFormatter(style=lookup_style(style),
-                                  cssclass=cls)
-    except ValueError:
-        return None
-    if not preview:
-        _formatters[style] = formatter
-    return formatter
-
-
-def get_style(req, style):
-    """A request handler that returns the stylesheet for one of the
-    pygments styles. If a file does not exist it returns an
-    error 404.
+
+def get_formatter(style=None, preview=False):
+    """Return a formatter for the style, see
+    :func:`highlighting.get_formatter`.
     """
-    formatter = get_formatter(style)
-    if formatter is None:
-        raise NotFound()
-    resp = Response(formatter.get_style_defs('div.syntax pre'),
-                    mimetype='text/css')
-    resp.headers['Cache-Control'] = 'public'
-    resp.headers['Expires'] = asctime(gmtime(time() + 3600))
-    return resp
-
-
-@require_privilege(BLOG_ADMIN)
-def show_config(req):
-    """Request handler that provides an admin page with the configuration
-    for the pygments plugin. So far this only allows changing the style.
+    return _get_highlighting().get_formatter(style, preview)
+
+
+def get_stylesheet_version(style):
+    """Return a short version string for the stylesheet of a style.  It's
+    added to the links so that browsers can cache the stylesheets for a
+    long time.  Unlike the etag it's known without creating the stylesheet.
+    The definitions of styles added with :func:`add_style` are part of the
+    version, so replacing a style changes the links.
     """
-    active_style = get_current_style()
-    styles = sorted([(x, x.title()) for x in STYLES])
-    form = ConfigurationForm(initial=dict(style=active_style))
-    form.fields['style'].choices = styles
-
-    if req.method == 'POST' and form.validate(req.form):
-        active_style = form['style']
-        if 'apply' in req.form:
-            req.app.cfg.change_single('pygments_support/style',
-                                      active_style)
-            flash(_('Pygments theme changed successfully.'), 'configure')
-            return redirect_to('pygments_support/config')
-
-    preview_formatter = get_formatter(active_style, preview=True)
-    add_header_snippet('<style type="text/css">\n%s\n</style>' %
-                       escape(preview_formatter.get_style_defs()))
-    example = highlight(EXAMPLE, get_lexer_by_name('html+jinja'),
-                        preview_formatter)
-
-    return render_admin_response('admin/pygments_support.html',
-                                 'options.pygments_support',
-                                 example=example, form=form.as_widget())
+    key = '%s:%s' % (style, pygments.__version__)
+    custom_style = _custom_styles.get(style)
+    if custom_style is not None:
+        key += ':%r:%s:%s' % (sorted(custom_style.styles.iteritems()),
+                              custom_style.background_color,
+                              custom_style.highlight_color)
+    return sha1(key).hexdigest()[:8]
 
 
 def inject_style(req):
     """Add a link for the current pygments stylesheet to each page."""
-    add_link('stylesheet', url_for('pygments_support/style',
-                                   style=get_current_style()),
+    style = get_current_style()
+    add_link('stylesheet', url_for('pygments_support/style', style=style,
+                                   v=get_stylesheet_version(style)),
              'text/css')
 
 
@@ -199,9 +137,13 @@ def setup(app, plugin):
     app.connect_event('after-request-setup', inject_style)
     app.add_config_var('pygments_support/style',
                        forms.TextField(default=u'default'))
-    app.add_zeml_element_handler(SourcecodeHandler)
+    app.add_zeml_element_handler(HIGHLIGHTING + ':SourcecodeHandler',
+                                 tag='sourcecode', is_isolated=True,
+                                 is_block_level=True)
     app.add_url_rule('/options/pygments', prefix='admin',
-                     view=show_config, endpoint='pygments_support/config')
+                     view=HIGHLIGHTING + ':show_config',
+                     endpoint='pygments_support/config')
     app.add_url_rule('/_shared/pygments_support/<style>.css',
-                     view=get_style, endpoint='pygments_support/style')
+                     view=HIGHLIGHTING + ':get_style',
+                     endpoint='pygments_support/style')
     app.add_template_searchpath(TEMPLATES)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.plugins.pygments_support.highlighting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The parts of the pygments plugin that need pygments.  This module is
+    imported when code is highlighted or a stylesheet is requested the
+    first time, not on startup.
+
+    Highlighting is slow compared to the rest of the parsing, so the
+    highlighted code is cached by the lexer, the formatter options, the
+    style and the checksum of the code.  The cache is kept in the process
+    (least recently used blocks are forgotten first) and in the
+    application cache, so the same snippet is not highlighted again when a
+    post is previewed, parsed again or imported with other posts that
+    contain it.
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from itertools import count
+from threading import Lock
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from werkzeug import escape
+from werkzeug.exceptions import NotFound
+
+from pygments import highlight
+from pygments.lexers import get_lexer_by_name
+from pygments.formatters import HtmlFormatter
+from pygments.styles import get_all_styles, get_style_by_name
+
+from zine.api import *
+from zine.views.admin import render_admin_response, flash
+from zine.privileges import BLOG_ADMIN
+from zine.utils import forms
+from zine.utils.zeml import HTMLElement, ElementHandler
+from zine.utils.http import redirect_to
+from zine.plugins.pygments_support import get_current_style, _custom_styles
+
+
+#: cache for formatters
+_formatters = {}
+
+#: cache for lexers by name
+_lexers = {}
+
+#: cache for the stylesheets as ``(css, etag)`` tuples by style
+_stylesheets = {}
+
+#: the names of the installed styles, looking them up is slow
+_style_names = None
+
+
+PYGMENTS_URL = 'http://pygments.org/'
+EXAMPLE = '''\
+<!DOCTYPE HTML>
+<html>
+  <head>
+    <title>{% block title %}Untitled{% endblock %}</title>
+    <style type="text/css">
+      body {
+        background-color: #333;
+        color: #eee;
+      }
+    </style>
+    <script type="text/javascript">
+      function fun() {
+        alert('This is a piece of example code');
+      }
+    </script>
+  </head>
+  <body onload="fun()">
+    {% block body %}{% endblock %}
+  </body>
+</html>\
+'''
+
+
+class HighlightCache(object):
+    """A cache for highlighted code in the process memory that holds up to
+    `size` items.  If it's full, the least recently used half is dropped.
+    """
+
+    def __init__(self, size=500):
+        self.size = size
+        self._items = {}
+        self._ticks = count()
+        self._lock = Lock()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None:
+            item[0] = self._ticks.next()
+            return item[1]
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if len(self._items) >= self.size:
+                items = sorted(self._items.iteritems(),
+                               key=lambda x: x[1][0])
+                for old_key, item in items[:len(items) // 2]:
+                    del self._items[old_key]
+            self._items[key] = [self._ticks.next(), value]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self._lock.release()
+
+
+_highlight_cache = HighlightCache()
+
+
+def get_lexer(name):
+    """Return the lexer for the given name or the lexer for plain text if
+    there is no such lexer.  The lexers are shared, don't modify them.
+    """
+    rv = _lexers.get(name)
+    if rv is None:
+        try:
+            rv = get_lexer_by_name(name)
+        except ValueError:
+            rv = get_lexer(u'text')
+        # names come from the posts, don't remember too many typos
+        if len(_lexers) < 500:
+            _lexers[name] = rv
+    return rv
+
+
+def highlight_code(code, lexer_name, style=None):
+    """Highlight the code with the lexer for the given name and the
+    formatter for the style (or the current style) and return the HTML.
+    The result is cached.
+    """
+    if style is None:
+        style = get_current_style()
+    lexer = get_lexer(lexer_name)
+    formatter = get_formatter(style) or get_formatter('default')
+    key = '%s:%s:%s:%s' % (
+        lexer.aliases and lexer.aliases[0] or lexer.name,
+        formatter.cssclass,
+        style,
+        sha1(code.encode('utf-8')).hexdigest()
+    )
+    rv = _highlight_cache.get(key)
+    if rv is not None:
+        return rv
+    cache = get_application().cache
+    cache_key = 'pygments_support/highlight/' + sha1(
+        key.encode('utf-8')).hexdigest()
+    rv = cache.get(cache_key)
+    if rv is None:
+        rv = highlight(code, lexer, formatter)
+        cache.set(cache_key, rv)
+    _highlight_cache.set(key, rv)
+    return rv
+
+
+class SourcecodeHandler(ElementHandler):
+    """Provides a ``<sourcecode>`` tag."""
+    tag = 'sourcecode'
+    is_isolated = True
+    is_block_level = True
+
+    def process(self, element):
+        return HTMLElement(highlight_code(element.text,
+                           element.attributes.get('syntax', 'text')))
+
+
+class ConfigurationForm(forms.Form):
+    style = forms.ChoiceField(required=True)
+
+
+def list_styles():
+    """Return a list of the names of all styles."""
+    global _style_names
+    if _style_names is None:
+        _style_names = list(get_all_styles())
+    return sorted(set(_style_names) | set(_custom_styles))
+
+
+def lookup_style(name):
+    """Return the style object for the given name."""
+    if name in _custom_styles:
+        return _custom_styles[name]
+    try:
+        return get_style_by_name(name)
+    except ValueError:
+        return 'default'
+
+
+def forget_style(name):
+    """Forget the formatter and the stylesheet of a style.  Called if a
+    style is added with an existing name.
+    """
+    _formatters.pop(name, None)
+    _stylesheets.pop(name, None)
+
+
+def get_formatter(style=None, preview=False):
+    """Helper function that returns a formatter in either preview or
+    normal mode for the style provided or the current style if not
+    further defined.
+
+    The formatter returned should be treated as immutable object
+    because it might be shared and cached.
+    """
+    if style is None:
+        style = get_current_style()
+    if not preview and style in _formatters:
+        return _formatters[style]
+    try:
+        if preview:
+            cls = 'highlight_preview'
+        else:
+            cls = 'syntax'
+        style_cls = lookup_style(style)
+        formatter = HtmlFormatter(style=lookup_style(style),
+                                  cssclass=cls)
+    except ValueError:
+        return None
+    if not preview:
+        _formatters[style] = formatter
+    return formatter
+
+
+def get_stylesheet(style):
+    """Return the stylesheet for a style and its etag as tuple or `None`
+    if the style does not exist.  The stylesheet is only generated once.
+    """
+    rv = _stylesheets.get(style)
+    if rv is None:
+        formatter = get_formatter(style)
+        if formatter is None:
+            return
+        css = formatter.get_style_defs('div.syntax pre')
+        etag = sha1(css.encode('utf-8')).hexdigest()
+        rv = _stylesheets[style] = (css, etag)
+    return rv
+
+
+def get_style(req, style):
+    """A request handler that returns the stylesheet for one of the
+    pygments styles. If a file does not exist it returns an
+    error 404.  The links to the stylesheet contain the etag, so the
+    stylesheet can be cached for a long time.
+    """
+    stylesheet = get_stylesheet(style)
+    if stylesheet is None:
+        raise NotFound()
+    css, etag = stylesheet
+    resp = Response(css, mimetype='text/css')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000'
+    resp.make_conditional(req)
+    return resp
+
+
+@require_privilege(BLOG_ADMIN)
+def show_config(req):
+    """Request handler that provides an admin page with the configuration
+    for the pygments plugin. So far this only allows changing the style.
+    """
+    active_style = get_current_style()
+    styles = [(x, x.title()) for x in list_styles()]
+    form = ConfigurationForm(initial=dict(style=active_style))
+    form.fields['style'].choices = styles
+
+    if req.method == 'POST' and form.validate(req.form):
+        active_style = form['style']
+        if 'apply' in req.form:
+            req.app.cfg.change_single('pygments_support/style',
+                                      active_style)
+            flash(_('Pygments theme changed successfully.'), 'configure')
+            return redirect_to('pygments_support/config')
+
+    preview_formatter = get_formatter(active_style, preview=True)
+    add_header_snippet('<style type="text/css">\n%s\n</style>' %
+                       escape(preview_formatter.get_style_defs()))
+    example = highlight(EXAMPLE, get_lexer('html+jinja'),
+                        preview_formatter)
+
+    return render_admin_response('admin/pygments_support.html',
+                                 'options.pygments_support',
+                                 example=example, form=form.as_widget())
+
@@ -9,6 +9,11 @@
     are ways to tweak it a bit, but if one wants to have that functionality for
     other languages a different plugin is a better idea.
 
+    The rules are combined into one regular expression so that every text
+    is scanned only once.  The context of the replaced marks is matched
+    with lookarounds, so the single scan gives the same result as applying
+    the rules one after another.
+
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
@@ -25,23 +30,28 @@ from zine.utils import forms
 TEMPLATES = join(dirname(__file__), 'templates')
 
 _ignored_elements = set(['pre', 'code'])
+
+#: The rules in the order they apply.  If a rule has a group only the
+#: group is replaced.  Only the replaced marks may be consumed, the
+#: context goes into lookarounds.
 _rules = [
     (re.compile(r'(?<!\.)\.\.\.(?!\.)'), 'ellipsis', u'…'),
     (re.compile(r'(?<!-)---(?!-)'), 'emdash', u'—'),
     (re.compile(r'(?<!-)--(?!-)'), 'endash', u'–'),
-    (re.compile(r'(?:^|\W)\d+(")(?u)'), 'inch', u'″'),
-    (re.compile(r'(?:^|\W)\d+(\')(?u)'), 'foot', u'′'),
-    (re.compile(r'\+\-'), 'plus_minus_sign', u'±'),
+    (re.compile(r'(?:^|(?<=\W))\d+(")(?u)'), 'inch', u'″'),
+    (re.compile(r'(?:^|(?<=\W))\d+(\')(?u)'), 'foot', u'′'),
+    (re.compile(r'\+\-(?!-)'), 'plus_minus_sign', u'±'),
     (re.compile(r'\(c\)'), 'copyright', u'©'),
     (re.compile(r'\(r\)'), 'registered', u'®'),
     (re.compile(r'\(tm\)'), 'trademark', u'™'),
-    (re.compile(r'\d\s+(x)\s+\d(?u)'), 'multiplication_sign', u'×'),
-    (re.compile(r'(?:^|\s)(\')\d{2}(?u)'), 'single_abbr_quote', u'’'),
-    (re.compile(r'\w(\')\w(?u)'), 'single_abbr_quote', u'’'),
-    (re.compile(r'(?:^|\s)(\')(?u)'), 'single_opening_quote', u'‘'),
-    (re.compile(r'\S(\')(?u)'), 'single_closing_quote', u'’'),
-    (re.compile(r'(?:^|\s)(")(?u)'), 'double_opening_quote', u'“'),
-    (re.compile(r'\S(")(?u)'), 'double_closing_quote', u'”')
+    (re.compile(r'(?<=\d)\s+(x)(?=\s+\d)(?u)'), 'multiplication_sign', u'×'),
+    (re.compile(r'(?:^|(?<=\s))(\')(?=\d{2})(?u)'), 'single_abbr_quote',
+     u'’'),
+    (re.compile(r'(?<=\w)(\')(?=\w)(?u)'), 'single_abbr_quote', u'’'),
+    (re.compile(r'(?:^|(?<=\s))(\')(?u)'), 'single_opening_quote', u'‘'),
+    (re.compile(r'(?<=\S)(\')(?u)'), 'single_closing_quote', u'’'),
+    (re.compile(r'(?:^|(?<=\s))(")(?u)'), 'double_opening_quote', u'“'),
+    (re.compile(r'(?<=\S)(")(?u)'), 'double_closing_quote', u'”')
 ]
 
 _tail_test = re.compile(r'\S$(?u)')
@@ -49,11 +59,38 @@ _tail_test = re.compile(r'\S$(?u)')
 #: These rules apply on typographical marks following a tag closure.
 #: For example: This is <a href="#">something</a>'s example
 _tail_rules = [
-    (re.compile(r'^(\')\w(?u)'), 'single_abbr_quote', u'’'),
+    (re.compile(r'^(\')(?=\w)(?u)'), 'single_abbr_quote', u'’'),
     (re.compile(r'^(\')'), 'single_closing_quote', u'’'),
     (re.compile(r'^(\")'), 'double_closing_quote', u'”')
 ]
 
+#: Matches where a rule could start.  It's tested before the rules so that
+#: the positions of ordinary text are skipped quickly.
+_rule_start = r'(?=[-.\d+(\'"]|\s+x)'
+
+
+def _compile_rules(rules):
+    """Combine the rules into one regular expression.  Returns the
+    expression and a list of ``(group, target, name)`` tuples: the group
+    of a rule, the group that is replaced and the name of the sign.
+    """
+    patterns = []
+    groups = []
+    group = 1
+    for regex, name, default in rules:
+        patterns.append('(%s)' % regex.pattern.replace('(?u)', ''))
+        groups.append((group, regex.groups and group + 1 or group, name))
+        group += regex.groups + 1
+    return re.compile('%s(?:%s)' % (_rule_start, '|'.join(patterns)),
+                      re.UNICODE), groups
+
+
+_scanner, _scanner_groups = _compile_rules(_rules)
+_tail_scanner, _tail_scanner_groups = _compile_rules(_tail_rules + _rules)
+
+#: the dispatch tables for the last used signs
+_dispatch_cache = {}
+
 
 class ConfigurationForm(forms.Form):
     """The configuration form for the quotes."""
@@ -89,34 +126,56 @@ def _typography_walk(element):
             yield child
 
 
-def process_doc_tree(doctree, input_data, reason):
-    """Parse time callback function that replaces all pre blocks with a
-    'syntax' attribute the highlighted sourcecode.
+def _get_dispatch(signs):
+    """Return the functions that replace the matches of the scanners for
+    the text and the tails.  `signs` is a tuple of the configured signs
+    in the order of the rules.
     """
-    def apply_typography(text, tail=False):
+    rv = _dispatch_cache.get(signs)
+    if rv is not None:
+        return rv
+    used_signs = dict((name, sign) for (ignore, name, ignore), sign
+                      in zip(_rules, signs))
+
+    def make_replacer(groups):
+        table = dict((group, (target, used_signs[name]))
+                     for group, target, name in groups)
         def handle_match(m):
+            group = m.lastindex
+            target, sign = table[group]
+            if target == group:
+                return sign
             all = m.group()
-            if not m.groups():
-                return used_signs[sign]
             offset = m.start()
-            return all[:m.start(1) - offset] + \
-                   used_signs[sign] + \
-                   all[m.end(1) - offset:]
-        if tail:
-            for regex, sign, ignore in _tail_rules:
-                text = regex.sub(handle_match, text)
-        for regex, sign, ignore in _rules:
-            text = regex.sub(handle_match, text)
-        return text
+            return all[:m.start(target) - offset] + sign + \
+                   all[m.end(target) - offset:]
+        return handle_match
+
+    rv = (make_replacer(_scanner_groups), make_replacer(_tail_scanner_groups))
+    # the configuration rarely changes, one entry is enough
+    _dispatch_cache.clear()
+    _dispatch_cache[signs] = rv
+    return rv
 
+
+def process_doc_tree(doctree, input_data, reason):
+    """Parse time callback function that replaces typographical marks in
+    the text of the tree.
+    """
     cfg = get_application().cfg
-    used_signs = dict((k, cfg['typography/' + k]) for ignore, k, ignore in _rules)
+    handle_match, handle_tail_match = _get_dispatch(tuple(
+        cfg['typography/' + name] for ignore, name, ignore in _rules))
+    sub = _scanner.sub
+    tail_sub = _tail_scanner.sub
     for element in _typography_walk(doctree):
         if element.text:
-            element.text = apply_typography(element.text)
+            element.text = sub(handle_match, element.text)
         for child in element.children:
             if child.tail:
-                child.tail = apply_typography(child.tail, tail=_tail_test.search(child.text) and True)
+                if _tail_test.search(child.text):
+                    child.tail = tail_sub(handle_tail_match, child.tail)
+                else:
+                    child.tail = sub(handle_match, child.tail)
 
 
 def add_config_link(req, navigation_bar):
@@ -18,6 +18,15 @@ from zine.utils import forms
 
 TEMPLATE_FILES = join(dirname(__file__), 'templates')
 SHARED_FILES = join(dirname(__file__), 'shared')
+THEME_SETTINGS = {
+    # the overview pages use the builtin templates which work with the
+    # read-only post rows
+    'sql.index.rows':               True,
+    'sql.author.rows':              True,
+    'sql.archive.rows':             True,
+    'sql.category.rows':            True,
+    'sql.tag.rows':                 True
+}
 
 
 blue_variation = u'vessel_theme::blue.css'
@@ -68,7 +77,7 @@ def configure(request):
 
 
 def setup(app, plugin):
-    app.add_theme('vessel', TEMPLATE_FILES, plugin.metadata,
+    app.add_theme('vessel', TEMPLATE_FILES, plugin.metadata, THEME_SETTINGS,
                   configuration_page=configure)
     app.add_shared_exports('vessel_theme', SHARED_FILES)
     app.add_config_var('vessel_theme/variation',
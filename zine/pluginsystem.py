@@ -75,6 +75,18 @@
         Title[de]: Beispielplugin
 
 
+    Plugin Manifest
+    ---------------
+
+    Finding the plugins means listing all folders on the plugin searchpath
+    and parsing the metadata of every plugin.  To not do that on every
+    start the result is stored in a manifest in the instance folder.  It
+    holds the parsed metadata and the catalogs of the plugins in the order
+    of their dependencies together with the modification times of the
+    folders and files it was built from.  If one of them changed the
+    plugins are searched again and the manifest is rebuilt.
+
+
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
@@ -83,7 +95,8 @@ import re
 import sys
 import imp
 import inspect
-from os import path, listdir, walk, makedirs
+import cPickle as pickle
+from os import path, listdir, walk, makedirs, rename, getpid
 from types import ModuleType
 from shutil import rmtree
 from time import localtime, time
@@ -91,13 +104,15 @@ from cStringIO import StringIO
 from base64 import b64encode
 
 from urllib import quote
+from babel import Locale
 from werkzeug import cached_property, escape, find_modules, import_string
 
 from zine.application import get_application
 from zine.utils import log
 from zine.utils.mail import split_email, is_valid_email, check
 from zine.utils.exceptions import UserException, summarize_exception
-from zine.i18n import ZineTranslations as Translations, lazy_gettext, _
+from zine.i18n import ZineTranslations as Translations, \
+     ZineNullTranslations, find_catalog, lazy_gettext, _
 
 
 _py_import = __builtin__.__import__
@@ -110,42 +125,208 @@ _managed_applications = {}
 
 PACKAGE_VERSION = 1
 
+#: the version of the manifest format.  Manifests with another version
+#: are ignored and rebuilt.
+MANIFEST_VERSION = 1
+
+#: the name of the manifest file in the instance folder
+MANIFEST_FILENAME = 'plugins.manifest'
+
 
 def get_object_name(obj):
-    """Return a human readable name for the object."""
-    if inspect.isclass(obj) or inspect.isfunction(obj):
-        cls = obj
+    """Return a human readable name for the object.  The object can also
+    be given as import string.
+    """
+    if isinstance(obj, basestring):
+        module, name = obj.replace(':', '.').rsplit('.', 1)
+    elif inspect.ismethod(obj):
+        module = obj.im_class.__module__
+        name = obj.im_class.__name__ + '.' + obj.__name__
     else:
-        cls = obj.__class__
-    if cls.__module__.startswith('zine.plugins.'):
-        prefix = cls.__module__.split('.', 2)[-1]
-    elif cls.__module__.startswith('zine.'):
-        prefix = cls.__module__
+        if inspect.isclass(obj) or inspect.isfunction(obj):
+            cls = obj
+        else:
+            cls = obj.__class__
+        module, name = cls.__module__, cls.__name__
+    if module.startswith('zine.plugins.'):
+        prefix = module.split('.', 2)[-1]
+    elif module.startswith('zine.'):
+        prefix = module
     else:
-        prefix = 'external.' + cls.__module__
-    return prefix + '.' + cls.__name__
+        prefix = 'external.' + module
+    return prefix + '.' + name
 
 
 def find_plugins(app):
-    """Return an iterator over all plugins available."""
+    """Return an iterator over all plugins available.  Plugins come after
+    the plugins they depend on.  If the manifest in the instance folder is
+    up to date the plugins are created from it, otherwise the plugin
+    searchpath is scanned and the manifest is rebuilt.
+    """
     enabled_plugins = set()
-    found_plugins = set()
     for plugin in app.cfg['plugins']:
         plugin = plugin.strip()
         if plugin:
             enabled_plugins.add(plugin)
 
+    manifest = load_manifest(app)
+    if manifest is None:
+        manifest = scan_plugins(app)
+        save_manifest(app, manifest)
+
+    for entry in manifest['plugins']:
+        plugin = Plugin(app, entry['name'], entry['path'],
+                        entry['name'] in enabled_plugins,
+                        entry['instance_plugin'])
+        # fill the cached properties so that nothing has to be read again
+        plugin.__dict__.update(
+            metadata=MetaData(*entry['metadata']),
+            catalog=entry['catalog']
+        )
+        yield plugin
+
+
+def _get_mtime(filename):
+    """Return the modification time of a file or `None` if it does not
+    exist.
+    """
+    try:
+        return path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def _split_depends(value):
+    return filter(None, [x.strip() for x in value.strip().split(',')])
+
+
+def _dependency_order(plugins):
+    """Sort the manifest entries of the plugins so that plugins come after
+    the plugins they depend on.  Apart from that the order is kept, missing
+    dependencies and dependency cycles are ignored:
+
+    >>> def order(*plugins):
+    ...     return [x['name'] for x in _dependency_order(
+    ...         [{'name': name, 'depends': depends}
+    ...          for name, depends in plugins])]
+    >>> order(('a', ['b']), ('b', []), ('c', ['a']))
+    ['b', 'a', 'c']
+    >>> order(('c', []), ('a', ['missing']), ('b', []))
+    ['c', 'a', 'b']
+    >>> order(('a', ['b']), ('b', ['a']))
+    ['b', 'a']
+    """
+    by_name = dict((x['name'], x) for x in plugins)
+    result = []
+    done = set()
+    def visit(entry, pending):
+        name = entry['name']
+        if name in done or name in pending:
+            return
+        pending.add(name)
+        for dependency in entry['depends']:
+            if dependency in by_name:
+                visit(by_name[dependency], pending)
+        pending.discard(name)
+        done.add(name)
+        result.append(entry)
+    for entry in plugins:
+        visit(entry, set())
+    return result
+
+
+def scan_plugins(app):
+    """Search the plugins on the plugin searchpath and return a new
+    manifest for them.
+    """
+    language = str(Locale.parse(app.cfg['language']))
+    stamps = []
+    plugins = []
+    found_plugins = set()
     for folder in app.plugin_searchpath:
+        stamps.append((folder, _get_mtime(folder)))
         if not path.isdir(folder):
             continue
         for filename in listdir(folder):
             full_name = path.join(folder, filename)
-            if path.isdir(full_name) and \
-               path.isfile(path.join(full_name, 'metadata.txt')) and \
-               filename not in found_plugins:
-                found_plugins.add(filename)
-                yield Plugin(app, str(filename), path.abspath(full_name),
-                             filename in enabled_plugins)
+            metadata_filename = path.join(full_name, 'metadata.txt')
+            if not path.isdir(full_name) or \
+               not path.isfile(metadata_filename) or \
+               filename in found_plugins:
+                continue
+            found_plugins.add(filename)
+            plugin = Plugin(app, str(filename), path.abspath(full_name),
+                            False)
+            locale_path = path.join(plugin.path, 'i18n', language)
+            for stamped in plugin.path, metadata_filename, locale_path:
+                stamps.append((stamped, _get_mtime(stamped)))
+            metadata = plugin.metadata or MetaData({})
+            plugins.append({
+                'name':             plugin.name,
+                'path':             plugin.path,
+                'instance_plugin':  plugin.instance_plugin,
+                'metadata':         (metadata._values, metadata._i18n_values),
+                'depends':          _split_depends(metadata._values.get(
+                                        'depends', u'')),
+                'catalog':          plugin.catalog
+            })
+
+    return {
+        'version':      MANIFEST_VERSION,
+        'searchpath':   list(app.plugin_searchpath),
+        'language':     language,
+        'stamps':       stamps,
+        'plugins':      _dependency_order(plugins)
+    }
+
+
+def load_manifest(app):
+    """Load the manifest from the instance folder.  If there is no manifest
+    or it's outdated `None` is returned.
+    """
+    try:
+        f = file(path.join(app.instance_folder, MANIFEST_FILENAME), 'rb')
+    except IOError:
+        return
+    try:
+        try:
+            manifest = pickle.load(f)
+        except Exception:
+            return
+    finally:
+        f.close()
+    if not isinstance(manifest, dict) or \
+       manifest.get('version') != MANIFEST_VERSION or \
+       manifest['searchpath'] != app.plugin_searchpath or \
+       manifest['language'] != str(Locale.parse(app.cfg['language'])):
+        return
+    for filename, mtime in manifest['stamps']:
+        if _get_mtime(filename) != mtime:
+            return
+    return manifest
+
+
+def save_manifest(app, manifest):
+    """Store the manifest in the instance folder.  If the instance folder
+    is not writeable the manifest is not stored.
+    """
+    # a folder that changes within the resolution of the modification
+    # times could keep its recorded time, so such a manifest is not
+    # stored but built again on the next start.
+    mtimes = [x[1] for x in manifest['stamps'] if x[1] is not None]
+    if mtimes and max(mtimes) >= time() - 2:
+        return
+    filename = path.join(app.instance_folder, MANIFEST_FILENAME)
+    tmp = '%s.%d' % (filename, getpid())
+    try:
+        f = file(tmp, 'wb')
+        try:
+            pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        rename(tmp, filename)
+    except (IOError, OSError):
+        pass
 
 
 def install_package(app, package):
@@ -380,14 +561,16 @@ def make_setup_error(exc_info=None):
 class Plugin(object):
     """Wraps a plugin module."""
 
-    def __init__(self, app, name, path_, active):
+    def __init__(self, app, name, path_, active, instance_plugin=None):
         self.app = app
         self.name = name
         self.path = path_
         self.active = active
-        self.instance_plugin = path.commonprefix([
-            path.realpath(path_), path.realpath(app.plugin_folder)]) == \
-            app.plugin_folder
+        if instance_plugin is None:
+            instance_plugin = path.commonprefix([
+                path.realpath(path_), path.realpath(app.plugin_folder)]) == \
+                app.plugin_folder
+        self.instance_plugin = instance_plugin
         self.setup_error = None
 
     def remove(self):
@@ -439,11 +622,21 @@ class Plugin(object):
         finally:
             f.close()
 
+    @cached_property
+    def catalog(self):
+        """The filename of the translations catalog for the language of
+        the application or `None` if the plugin is not translated.
+        """
+        return find_catalog(path.join(self.path, 'i18n'), 'messages',
+                            self.app.cfg['language'])
+
     @cached_property
     def translations(self):
         """The translations for this application."""
-        locale_path = path.join(self.path, 'i18n')
-        return Translations.load(locale_path, self.app.cfg['language'])
+        locale = Locale.parse(self.app.cfg['language'])
+        if self.catalog is None:
+            return ZineNullTranslations(locale=locale)
+        return Translations(fileobj=open(self.catalog), locale=locale)
 
     @cached_property
     def is_documented(self):
@@ -572,8 +765,7 @@ class Plugin(object):
 
         Plugins listed here won't be loaded automaticly.
         """
-        depends = self.metadata.get('depends', '').strip()
-        return filter(None, [x.strip() for x in depends.split(',')])
+        return _split_depends(self.metadata.get('depends', ''))
 
     def setup(self):
         """Setup the plugin."""
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.poolmetrics
+    ~~~~~~~~~~~~~~~~
+
+    Records how the connection pool of the database engine is used.  The
+    metrics are collected by a pool listener and a queue pool that times
+    how long checkouts have to wait for a connection.  They are shown on
+    the system information page in the admin panel and available as JSON
+    for monitoring tools.
+
+    In advisory mode the metrics are used to suggest pool sizes based on
+    the observed concurrency.  The suggestions are never applied
+    automatically.
+
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from time import time
+from math import ceil
+from weakref import WeakKeyDictionary
+from threading import Lock
+
+from sqlalchemy.exc import TimeoutError, DisconnectionError
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(PoolListener):
+    """A pool listener that counts connects, checkouts and checkins.  If
+    `pre_ping` is enabled connections are tested on checkout and replaced
+    if the database went away.
+    """
+
+    def __init__(self, pre_ping=False):
+        self.pre_ping = pre_ping
+        self._lock = Lock()
+        self._records = WeakKeyDictionary()
+        self.started = time()
+        self.connects = 0
+        self.reconnects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.overflow_checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.invalidated = 0
+
+    def connect(self, dbapi_con, con_record):
+        self._lock.acquire()
+        try:
+            # a record that connects again was recycled or invalidated
+            if con_record in self._records:
+                self.reconnects += 1
+            else:
+                self._records[con_record] = True
+            self.connects += 1
+        finally:
+            self._lock.release()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        if self.pre_ping:
+            try:
+                cursor = dbapi_con.cursor()
+                try:
+                    cursor.execute('select 1')
+                finally:
+                    cursor.close()
+            except Exception:
+                self._lock.acquire()
+                try:
+                    self.invalidated += 1
+                finally:
+                    self._lock.release()
+                # tells the pool to retry with a new connection
+                raise DisconnectionError()
+        self._lock.acquire()
+        try:
+            self.checkouts += 1
+            self.checked_out += 1
+            if self.checked_out > self.peak_checked_out:
+                self.peak_checked_out = self.checked_out
+        finally:
+            self._lock.release()
+
+    def checkin(self, dbapi_con, con_record):
+        self._lock.acquire()
+        try:
+            self.checked_out = max(0, self.checked_out - 1)
+        finally:
+            self._lock.release()
+
+    def record_wait(self, seconds, overflow=False, timeout=False):
+        """Called by the :class:`MeteredQueuePool` after a checkout."""
+        self._lock.acquire()
+        try:
+            self.waits += 1
+            self.wait_time += seconds
+            if seconds > self.max_wait_time:
+                self.max_wait_time = seconds
+            if overflow:
+                self.overflow_checkouts += 1
+            if timeout:
+                self.timeouts += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self, pool):
+        """Return the metrics together with the current state of the pool
+        as dict.
+        """
+        rv = {
+            'pool_class':           pool.__class__.__name__,
+            'uptime':               int(time() - self.started),
+            'connects':             self.connects,
+            'reconnects':           self.reconnects,
+            'invalidated':          self.invalidated,
+            'checkouts':            self.checkouts,
+            'checked_out':          self.checked_out,
+            'peak_checked_out':     self.peak_checked_out,
+            'overflow_checkouts':   self.overflow_checkouts,
+            'timeouts':             self.timeouts,
+            'average_wait':         self.waits and
+                                    self.wait_time / self.waits or 0.0,
+            'max_wait':             self.max_wait_time,
+            'pool_size':            None,
+            'overflow':             None,
+            'max_overflow':         None
+        }
+        if isinstance(pool, QueuePool):
+            rv.update(pool_size=pool.size(), overflow=pool.overflow(),
+                      max_overflow=pool._max_overflow)
+        return rv
+
+    def get_advice(self, pool):
+        """Suggest pool settings from the observed concurrency.  Returns a
+        dict with the suggested `pool_size` and `max_overflow` and a list
+        of `reasons`, or `None` if there is nothing to suggest.
+        """
+        if not isinstance(pool, QueuePool) or not self.checkouts:
+            return
+        pool_size = pool.size()
+        max_overflow = pool._max_overflow
+        reasons = []
+
+        # keep the peak concurrency plus a quarter in the pool
+        wanted = max(1, int(ceil(self.peak_checked_out * 1.25)))
+        if self.overflow_checkouts > self.checkouts * 0.1 and \
+           wanted > pool_size:
+            reasons.append('overflow')
+            pool_size = wanted
+        elif wanted * 2 <= pool_size:
+            reasons.append('idle')
+            pool_size = wanted
+
+        if self.timeouts:
+            reasons.append('timeouts')
+            max_overflow = max(max_overflow * 2, pool_size)
+
+        if reasons:
+            return {
+                'pool_size':    pool_size,
+                'max_overflow': max_overflow,
+                'reasons':      reasons
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """A queue pool that reports the time checkouts wait for a connection
+    to the :class:`PoolMetrics` listener of the pool.
+    """
+
+    def _get_metrics(self):
+        for listener in self.listeners:
+            if isinstance(listener, PoolMetrics):
+                return listener
+
+    def do_get(self):
+        metrics = self._get_metrics()
+        if metrics is None:
+            return QueuePool.do_get(self)
+        start = time()
+        try:
+            rv = QueuePool.do_get(self)
+        except TimeoutError:
+            metrics.record_wait(time() - start, timeout=True)
+            raise
+        metrics.record_wait(time() - start, overflow=self.overflow() > 0)
+        return rv
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.rerender
+    ~~~~~~~~~~~~~
+
+    Parses the text of all posts and comments again and stores the new
+    parser data.  That's necessary after a parser or a plugin that changes
+    the doc trees was updated, otherwise only posts that are edited get the
+    new markup.
+
+    The rows are read in chunks ordered by primary key.  The chunks are
+    parsed in a pool of worker processes (or in the current process) and
+    the changed parser data of each chunk is written by the main process.
+    A row is only written if its text is still the text that was rendered,
+    rows that were edited in the meantime are skipped.  After each chunk the position can be saved to a
+    checkpoint file so that an interrupted run can be resumed.  In dry-run
+    mode nothing is written, instead a diff of the old and new HTML is
+    reported for each changed row.
+
+    The `rerender-posts` script uses the process pool, the admin panel
+    enqueues a job that renders a few chunks and enqueues itself again for
+    the remaining rows.
+
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+from time import time
+from difflib import unified_diff
+from collections import deque
+
+from zine.database import db, posts, comments, cleanup_session
+from zine.utils.zeml import dump_parser_data, load_parser_data
+
+
+#: the kinds of rows in the order they are rendered
+KINDS = ('posts', 'comments')
+
+
+class _Kind(object):
+    """Describes the rows of one kind."""
+
+    def __init__(self, name, table, key, model):
+        self.name = name
+        self.table = table
+        self.key = key
+        self.model = model
+
+
+_kinds = None
+
+
+def _get_kinds():
+    global _kinds
+    if _kinds is None:
+        from zine.models import Post, Comment
+        _kinds = {
+            'posts':    _Kind('posts', posts, posts.c.post_id, Post),
+            'comments': _Kind('comments', comments, comments.c.comment_id,
+                              Comment)
+        }
+    return _kinds
+
+
+class RerenderResult(object):
+    """The result for one row that was changed or failed.  `text` is the
+    text that was rendered, `data` the dumped new parser data, `diff` the
+    diff of the HTML if requested and `error` the error message if the row
+    could not be rendered.  `skipped` is set if the row was edited before
+    the new parser data could be written.
+    """
+
+    def __init__(self, id, text=None, data=None, diff=None, error=None):
+        self.id = id
+        self.text = text
+        self.data = data
+        self.diff = diff
+        self.error = error
+        self.skipped = False
+
+    def __repr__(self):
+        return '<%s #%d%s>' % (
+            self.__class__.__name__,
+            self.id,
+            self.error and ' failed' or self.skipped and ' skipped' or ''
+        )
+
+
+class RerenderProgress(object):
+    """Passed to the progress callback after every chunk."""
+
+    def __init__(self, kind, total):
+        self.kind = kind
+        self.total = total
+        self.done = 0
+        self.changed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.last_id = None
+        self.started = time()
+
+    @property
+    def rate(self):
+        """Rows per second."""
+        return self.done / max(time() - self.started, 0.001)
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 100
+        return min(100, self.done * 100 // self.total)
+
+    def __str__(self):
+        return '%s: %d/%d (%d%%), %d changed, %d skipped, %d failed, ' \
+               '%.1f rows/s' % (
+            self.kind,
+            self.done,
+            self.total,
+            self.percent,
+            self.changed,
+            self.skipped,
+            self.failed,
+            self.rate
+        )
+
+
+def count_rows(kind, after=None):
+    """Return the number of rows of a kind with a key above `after`."""
+    kind = _get_kinds()[kind]
+    whereclause = None
+    if after is not None:
+        whereclause = kind.key > after
+    return db.execute(db.select([db.func.count(kind.key)],
+                                whereclause)).scalar()
+
+
+def iter_chunks(kind, chunk_size=100, after=None):
+    """Iterate over the primary keys of a kind in lists of `chunk_size`
+    keys.  Only keys above `after` are returned.
+    """
+    kind = _get_kinds()[kind]
+    while 1:
+        whereclause = None
+        if after is not None:
+            whereclause = kind.key > after
+        ids = [row[0] for row in db.execute(db.select([kind.key],
+               whereclause, order_by=[kind.key], limit=chunk_size))]
+        if not ids:
+            break
+        yield ids
+        after = ids[-1]
+
+
+def _diff_html(kind, id, old, new):
+    result = []
+    for key in sorted(new):
+        if not hasattr(new[key], 'to_html'):
+            continue
+        old_html = old is not None and old.get_html(key) or u''
+        new_html = new[key].to_html()
+        if old_html != new_html:
+            name = '%s/%d/%s' % (kind, id, key)
+            result.extend(unified_diff(old_html.splitlines(),
+                                       new_html.splitlines(),
+                                       name, name, lineterm=''))
+    return u'\n'.join(result)
+
+
+def render_chunk(kind, ids, diff=False):
+    """Render the rows of a kind with the given primary keys again and
+    return a list of :class:`RerenderResult` objects for the rows that
+    changed or failed.  Nothing is written to the database.
+    """
+    from zine.application import get_application
+    parsers = get_application().parsers
+    kind = _get_kinds()[kind]
+    result = []
+    for id, text, old in db.execute(db.select([kind.key, kind.table.c.text,
+                                               kind.table.c.parser_data],
+                                              kind.key.in_(ids),
+                                              order_by=[kind.key])):
+        parser = old is not None and old.get('parser') or None
+        if parser not in parsers:
+            result.append(RerenderResult(id, error='parser %r is missing' %
+                                         parser))
+            continue
+        try:
+            new = kind.model.render_text(text or u'', parser)
+        except Exception, e:
+            result.append(RerenderResult(id, error='%s: %s' %
+                                         (e.__class__.__name__, e)))
+            continue
+        # keep the values that don't come from the parser
+        for key in old.keys():
+            if key not in new:
+                new[key] = old[key]
+        data = dump_parser_data(new)
+        if data == (old.raw or dump_parser_data(old)):
+            continue
+        result.append(RerenderResult(id, text, data, diff and
+                                     _diff_html(kind.name, id, old, new)
+                                     or None))
+    return result
+
+
+def write_chunk(kind, results):
+    """Store the parser data of the results.  A row is only updated if its
+    text didn't change since it was rendered, otherwise the new parser data
+    would not match the text.  The results of those rows are marked as
+    skipped.
+    """
+    from zine.application import get_application
+    engine = get_application().database_engine
+    kind = _get_kinds()[kind]
+    text = kind.table.c.text
+    for result in results:
+        if result.data is None:
+            continue
+        # the row could have been edited since it was read
+        if result.text is None:
+            whereclause = (kind.key == result.id) & (text == None)
+        else:
+            whereclause = (kind.key == result.id) & (text == result.text)
+        updated = engine.execute(kind.table.update(whereclause), dict(
+            parser_data=load_parser_data(result.data)
+        )).rowcount
+        if updated != 1:
+            result.skipped = True
+
+
+def load_checkpoint(filename):
+    """Return the ``(kind, last_id)`` tuple stored in a checkpoint file or
+    `None` if there is no checkpoint.
+    """
+    try:
+        f = file(filename)
+    except IOError:
+        return
+    try:
+        kind, last_id = f.read().split()
+        if kind not in KINDS:
+            raise ValueError('unknown kind')
+        return kind, int(last_id)
+    finally:
+        f.close()
+
+
+def save_checkpoint(filename, kind, last_id):
+    """Save the position in a checkpoint file."""
+    tmp = filename + '.tmp'
+    f = file(tmp, 'w')
+    try:
+        f.write('%s %d\n' % (kind, last_id))
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+
+def _init_worker():
+    # the worker is a fork of the main process, connections of the parent
+    # must not be used from here.
+    from zine.application import get_application
+    get_application().database_engine.dispose()
+
+
+def _render_in_worker(args):
+    try:
+        return render_chunk(*args)
+    finally:
+        cleanup_session()
+
+
+def rerender(kinds=KINDS, chunk_size=100, processes=1, dry_run=False,
+             checkpoint=None, resume=None, max_chunks=None, callback=None):
+    """Render the rows of the given kinds again.
+
+    `processes` is the number of worker processes, with one process the
+    rows are rendered in the current process.  If `checkpoint` is the name
+    of a file the position is saved there after every chunk.  `resume` is
+    a ``(kind, last_id)`` tuple as returned by :func:`load_checkpoint`, the
+    rendering continues after that row.  If `max_chunks` is given, at most
+    that many chunks are rendered.
+
+    `callback` is called with the :class:`RerenderProgress` and the list of
+    :class:`RerenderResult` objects after every chunk.  Returns the
+    position after the last chunk as ``(kind, last_id)`` tuple, or `None`
+    if all rows were rendered.
+    """
+    from zine.application import get_application
+    kinds = [x for x in KINDS if x in kinds]
+    if resume is not None:
+        kinds = kinds[kinds.index(resume[0]):]
+
+    pool = None
+    if processes > 1:
+        from multiprocessing import Pool
+        cleanup_session()
+        get_application().database_engine.dispose()
+        pool = Pool(processes, _init_worker)
+
+    chunks_left = max_chunks
+    try:
+        for kind in kinds:
+            after = None
+            if resume is not None and resume[0] == kind:
+                after = resume[1]
+            progress = RerenderProgress(kind, count_rows(kind, after))
+
+            def handle(ids, results):
+                if not dry_run:
+                    write_chunk(kind, results)
+                progress.done += len(ids)
+                progress.failed += len([x for x in results if x.error])
+                progress.skipped += len([x for x in results if x.skipped])
+                progress.changed += len([x for x in results
+                                         if not x.error and not x.skipped])
+                progress.last_id = ids[-1]
+                if checkpoint is not None and not dry_run:
+                    save_checkpoint(checkpoint, kind, ids[-1])
+                if callback is not None:
+                    callback(progress, results)
+
+            def drain():
+                while pending:
+                    ids, results = pending.popleft()
+                    handle(ids, results.get())
+
+            pending = deque()
+            for ids in iter_chunks(kind, chunk_size, after):
+                if chunks_left is not None:
+                    if not chunks_left:
+                        # the chunks handed to the workers are part of
+                        # this run, the position is after the last of them
+                        drain()
+                        return kind, progress.last_id
+                    chunks_left -= 1
+                if pool is None:
+                    handle(ids, render_chunk(kind, ids, dry_run))
+                    continue
+                pending.append((ids, pool.apply_async(_render_in_worker,
+                                [(kind, ids, dry_run)])))
+                # keep the workers busy but don't read all rows at once
+                if len(pending) >= processes * 2:
+                    ids, results = pending.popleft()
+                    handle(ids, results.get())
+            drain()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if checkpoint is not None and not dry_run and \
+       os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+
+def rerender_job(job):
+    """Job handler that renders a few chunks starting after the position
+    ``(job.payload['kind'], job.payload['after'])`` and enqueues itself for
+    the remaining rows.
+    """
+    from zine.application import get_application
+    from zine.utils import log
+    app = get_application()
+    resume = None
+    if job.payload.get('kind') in KINDS:
+        resume = job.payload['kind'], job.payload.get('after')
+
+    def callback(progress, results):
+        for result in results:
+            if result.error:
+                log.warning('Could not render %s #%d: %s' %
+                            (progress.kind, result.id, result.error),
+                            'rerender')
+            elif result.skipped:
+                log.info('Skipped %s #%d, it was edited in the meantime' %
+                         (progress.kind, result.id), 'rerender')
+
+    position = rerender(resume=resume, max_chunks=job.payload.get('chunks',
+                        10), callback=callback)
+    if position is not None:
+        app.jobs.enqueue('zine/rerender', {
+            'kind':     position[0],
+            'after':    position[1],
+            'chunks':   job.payload.get('chunks', 10)
+        })
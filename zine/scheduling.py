@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.scheduling
+    ~~~~~~~~~~~~~~~
+
+    Keeps track of the point in time when the next scheduled post becomes
+    visible.  The set of visible posts only changes when that boundary is
+    crossed (or posts are edited), so instead of filtering with the current
+    time the post queries use a cutoff that is quantized and capped at the
+    next scheduled publication date.  That keeps the generated SQL stable
+    and gives the response caches a value they can add to their keys so
+    that cached listings are valid until the next post goes live.
+
+
+    :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from time import time
+from datetime import datetime, timedelta, MAXYEAR
+from threading import Lock, Timer
+
+
+#: returned as boundary if no post is scheduled for publication.
+NOTHING_SCHEDULED = datetime(MAXYEAR, 12, 31)
+
+#: the cache key for the boundary
+_cache_key = 'zine/next_scheduled_pub_date'
+
+_epoch = datetime(1970, 1, 1)
+
+
+def quantize(dt, seconds):
+    """Round a datetime down to a multiple of `seconds` since the epoch.
+
+    >>> quantize(datetime(2009, 1, 1, 12, 30, 45, 1234), 60)
+    datetime.datetime(2009, 1, 1, 12, 30)
+    >>> quantize(datetime(2009, 1, 1, 12, 30, 45), 1)
+    datetime.datetime(2009, 1, 1, 12, 30, 45)
+    """
+    delta = dt - _epoch
+    total = delta.days * 86400 + delta.seconds
+    return _epoch + timedelta(seconds=total - total % seconds)
+
+
+class PublicationSchedule(object):
+    """Tracks the next scheduled publication date for an application.  The
+    value is stored in the application cache so that all processes share
+    it and additionally kept in process memory for the configured quantum
+    so that the null cache doesn't cause a query per request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.quantum = app.cfg['publication_quantum']
+        self._lock = Lock()
+        self._local = None
+        self._local_expires = 0
+        self._timer = None
+
+    def _query_next(self, now):
+        from zine.database import posts, db
+        from zine.models import STATUS_PUBLISHED, STATUS_PROTECTED, \
+             STATUS_PRIVATE
+        p = posts.c
+        rv = db.execute(db.select([db.func.min(p.pub_date)],
+            p.status.in_([STATUS_PUBLISHED, STATUS_PROTECTED,
+                          STATUS_PRIVATE]) &
+            (p.pub_date > now))).scalar()
+        if rv is None:
+            return NOTHING_SCHEDULED
+        return rv
+
+    def get_next(self, now=None):
+        """Return the publication date of the next scheduled post or
+        :data:`NOTHING_SCHEDULED` if there is none.
+        """
+        return self._get_next(now)[0]
+
+    def _get_next(self, now=None):
+        """Like :meth:`get_next` but returns a ``(boundary, fresh)``
+        tuple.  `fresh` is `False` if the boundary comes from process
+        memory.  Other processes don't forget that value if they change
+        posts, so it may be outdated until it expires.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        rv = self._local
+        if rv is not None and rv > now and self._local_expires > time():
+            return rv, False
+
+        rv = self.app.cache.get(_cache_key)
+        if rv is None or rv <= now:
+            rv = self._query_next(now)
+            self.app.cache.set(_cache_key, rv)
+        self._lock.acquire()
+        try:
+            changed = rv != self._local
+            self._local = rv
+            self._local_expires = time() + self.quantum
+        finally:
+            self._lock.release()
+        if changed and self.app.cfg['publication_timer']:
+            self.start_timer(rv)
+        return rv, True
+
+    def get_cutoff(self, now=None):
+        """Return the cutoff for visible posts.  All posts with a
+        publication date lower than the value returned are visible.  This
+        is the current time rounded up to the quantum, or the next scheduled
+        publication date if that comes first.
+
+        If the boundary comes from process memory another process could
+        have scheduled a post before the end of the quantum in the
+        meantime, so the current time is rounded down instead.  Posts
+        published in the current quantum may show up a bit later then, but
+        scheduled posts never show up early.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        boundary, fresh = self._get_next(now)
+        if not fresh:
+            return min(boundary, quantize(now, self.quantum))
+        return min(boundary, quantize(now, self.quantum) +
+                   timedelta(seconds=self.quantum))
+
+    def get_generation(self):
+        """Return a string that changes whenever a scheduled post becomes
+        visible or the next scheduled publication date changes.  Other
+        changes of the posts don't change it.  Useful for cache keys.
+        """
+        return self.get_next().strftime('%Y%m%d%H%M%S')
+
+    def invalidate(self):
+        """Forget the tracked boundary.  This is called automatically if
+        posts are inserted, updated or deleted.
+        """
+        self._lock.acquire()
+        try:
+            self._local = None
+            self._local_expires = 0
+        finally:
+            self._lock.release()
+        self.app.cache.delete(_cache_key)
+
+    def start_timer(self, boundary):
+        """Start a timer that fires when the given boundary is reached.
+        When it fires the boundary is recalculated which invalidates the
+        cached listings and the ``after-scheduled-posts-published`` event
+        is emitted.
+        """
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if boundary == NOTHING_SCHEDULED:
+                return
+            delta = boundary - datetime.utcnow()
+            seconds = max(0, delta.days * 86400 + delta.seconds +
+                          delta.microseconds / 1e6)
+            self._timer = Timer(seconds, self._on_boundary, (boundary,))
+            self._timer.setDaemon(True)
+            self._timer.start()
+        finally:
+            self._lock.release()
+
+    def _on_boundary(self, boundary):
+        from zine.application import emit_event
+        from zine.database import cleanup_session
+        from zine.utils import log
+        try:
+            try:
+                self.invalidate()
+                self.get_next()
+                #! emitted from the scheduler thread after the publication
+                #! date of a scheduled post was reached and the cached
+                #! listings were invalidated.  The boundary is passed.
+                emit_event('after-scheduled-posts-published', boundary)
+            except Exception:
+                log.exception('Error in the publication scheduler',
+                              'scheduler')
+        finally:
+            cleanup_session()
+
+    def stop_timer(self):
+        """Stop the publication timer if running."""
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        finally:
+            self._lock.release()
+
+
+def get_cutoff():
+    """Return the visibility cutoff for the active application."""
+    from zine.application import get_application
+    return get_application().publication_schedule.get_cutoff()
@@ -105,6 +105,8 @@ def make_urls(app):
         Rule('/system/import/<int:id>', endpoint='admin/inspect_import'),
         Rule('/system/import/<int:id>/delete', endpoint='admin/delete_import'),
         Rule('/system/export', endpoint='admin/export'),
+        Rule('/system/jobs', endpoint='admin/jobs'),
+        Rule('/system/pool.json', endpoint='admin/pool_metrics'),
         Rule('/system/about', endpoint='admin/about_zine'),
         Rule('/system/help/', endpoint='admin/help'),
         Rule('/system/help/<path:page>', endpoint='admin/help'),
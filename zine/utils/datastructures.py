@@ -307,3 +307,87 @@ class OrderedDict(dict):
 
     __copy__ = copy
     __iter__ = iterkeys
+
+
+class MutationDict(dict):
+    """A dict that remembers if it was changed.  The database uses it for
+    the parser data and the extra column so that unchanged values don't
+    have to be copied and compared on every flush:
+
+    >>> d = MutationDict({'parser': 'zeml'})
+    >>> d.changed
+    False
+    >>> d['body'] = u'...'
+    >>> d.changed
+    True
+
+    Only the dict itself is tracked.  If a value stored in the dict is
+    modified in place, set `changed` to `True` by hand:
+
+    >>> d.changed = False
+    >>> d.setdefault('body', u'ignored')
+    u'...'
+    >>> d.changed
+    False
+    """
+    changed = False
+
+    def _mutating(name):
+        method = getattr(dict, name)
+        def mutate(self, *args, **kwargs):
+            self.changed = True
+            return method(self, *args, **kwargs)
+        mutate.__name__ = name
+        mutate.__doc__ = method.__doc__
+        return mutate
+
+    __setitem__ = _mutating('__setitem__')
+    __delitem__ = _mutating('__delitem__')
+    clear = _mutating('clear')
+    pop = _mutating('pop')
+    popitem = _mutating('popitem')
+    update = _mutating('update')
+    del _mutating
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def copy(self):
+        return MutationDict(self)
+
+    def __reduce__(self):
+        return MutationDict, (dict(self),)
+
+
+class RawMutationDict(MutationDict):
+    """A :class:`MutationDict` that was decoded from `raw`.  As long as
+    the dict is not changed `raw` is the value it was decoded from, so it
+    can be stored again without encoding it:
+
+    >>> d = RawMutationDict({'a': '42'}, 'a=42')
+    >>> d.raw
+    'a=42'
+    >>> d['a'] = '23'
+    >>> d.raw is None
+    True
+
+    If a value stored in the dict is modified in place and `changed` is
+    set by hand `raw` is forgotten as well.
+    """
+
+    def __init__(self, values, raw):
+        MutationDict.__init__(self, values)
+        self.raw = raw
+
+    def _get_changed(self):
+        return self.__dict__.get('changed', False)
+
+    def _set_changed(self, value):
+        if value:
+            self.raw = None
+        self.__dict__['changed'] = value
+
+    changed = property(_get_changed, _set_changed)
+    del _get_changed, _set_changed
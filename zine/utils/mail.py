@@ -12,7 +12,6 @@ from email.MIMEText import MIMEText
 from smtplib import SMTP, SMTPException
 from urlparse import urlparse
 
-from zine.utils import local
 from zine.utils.validators import is_valid_email, check
 
 
@@ -37,19 +36,39 @@ def split_email(s):
     return p1, None
 
 
-def send_email(subject, text, to_addrs, quiet=True):
-    """Send a mail using the `EMail` class."""
+def send_email(subject, text, to_addrs, quiet=True, background=False):
+    """Send a mail using the `EMail` class.  If `background` is `True` the
+    mail is sent by the job queue instead which retries on failures.
+    Don't forget to commit the transaction in that case.
+    """
+    if background:
+        from zine.application import get_application
+        if isinstance(to_addrs, basestring):
+            to_addrs = [to_addrs]
+        get_application().enqueue_job('zine/send_email', {
+            'subject':  subject,
+            'text':     text,
+            'to_addrs': list(to_addrs)
+        })
+        return
     e = EMail(subject, text, to_addrs)
     if quiet:
         return e.send_quiet()
     return e.send()
 
 
+def send_email_job(job):
+    """Job handler for mails sent by `send_email` in the background."""
+    EMail(job.payload['subject'], job.payload['text'],
+          job.payload['to_addrs']).send()
+
+
 class EMail(object):
     """Represents one E-Mail message that can be sent."""
 
     def __init__(self, subject=None, text='', to_addrs=None):
-        self.app = app = local.application
+        from zine.application import get_application
+        self.app = app = get_application()
         self.subject = u' '.join(subject.splitlines())
         self.text = text
         from_addr = app.cfg['blog_email']
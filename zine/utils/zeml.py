@@ -18,19 +18,21 @@ import cPickle as pickle
 from copy import deepcopy
 from cStringIO import StringIO
 from operator import itemgetter
+from itertools import izip
 from urlparse import urlparse
+from UserDict import DictMixin
 
-from werkzeug import escape
+from werkzeug import escape, import_string
 
 from zine.i18n import _
 from zine.utils import log
-from zine.utils.datastructures import OrderedDict
 
 
 _tag_name_re = re.compile(r'([\w.-]+)\b(?u)')
 _attribute_re = re.compile(r'\s*([\w.-]+)(?:\s*=\s*(".*?"|'
                            "'.*?'|[^\s>]*))?(?us)")
 _tag_end_re = re.compile(r'\s*>(?u)')
+_tag_start_re = re.compile(r'(/)|(!--)|([\w.-]+)\b(?u)')
 _entity_re = re.compile(r'&([^;]+);')
 _entity_re = re.compile(r'&([^;]+);')
 _paragraph_re = re.compile(r'(\s*?\n){2,}')
@@ -232,7 +234,7 @@ def dump(obj, stream):
             stream.write('E')
             _serialize(obj.name)
             _serialize(obj.children)
-            _serialize(obj.attributes)
+            _serialize(obj._attributes)
             _serialize(obj.text)
             _serialize(obj.tail)
         elif isinstance(obj, DynamicElement):
@@ -287,7 +289,7 @@ def load(stream):
             rv = object.__new__(Element)
             rv.name = _load()
             rv.children = _load(rv)
-            rv.attributes = _load()
+            rv._attributes = _load() or _empty_attributes
             rv.text = _load()
             rv.tail = _load()
             rv.parent = parent
@@ -307,27 +309,522 @@ def load(stream):
     return _load()
 
 
-def dump_parser_data(parser_data):
-    out = StringIO()
-    dump(len(parser_data), out)
-    for key, value in parser_data.iteritems():
+#: the header of the version 2 format.  Version 1 data starts with the
+#: integer opcode of the number of keys.
+_v2_header = 'ZEML\x02'
+
+
+def _dump_varint(value):
+    """Encode a non negative integer as varint."""
+    rv = []
+    while value > 0x7f:
+        rv.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    rv.append(chr(value))
+    return ''.join(rv)
+
+
+class _V2Writer(object):
+    """Dumps values in the version 2 format.  Tag names, attribute keys and
+    the class names of dynamic elements go into the string table that is
+    shared by all values of a document.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+
+    def ref(self, string):
+        string = unicode(string)
+        rv = self.string_ids.get(string)
+        if rv is None:
+            rv = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return rv
+
+    def dump(self, obj, write):
+        if obj is None:
+            write('N')
+        elif isinstance(obj, (int, long)):
+            # zigzag encoding so that negative numbers stay short
+            if obj >= 0:
+                write('I' + _dump_varint(obj << 1))
+            else:
+                write('I' + _dump_varint(((-obj) << 1) - 1))
+        elif isinstance(obj, basestring):
+            obj = unicode(obj).encode('utf-8')
+            write('S' + _dump_varint(len(obj)) + obj)
+        elif type(obj) is list:
+            write('L' + _dump_varint(len(obj)))
+            for item in obj:
+                self.dump(item, write)
+        elif type(obj) is Attributes:
+            write('M' + _dump_varint(len(obj)))
+            for key, value in obj.iteritems():
+                write(_dump_varint(self.ref(key)))
+                self.dump(value, write)
+        elif type(obj) is RootElement:
+            write('R')
+            self.dump(obj.text, write)
+            self.dump(obj.children, write)
+        elif type(obj) is Element:
+            write('E' + _dump_varint(self.ref(obj.name)))
+            self.dump(obj.children, write)
+            self.dump(obj._attributes, write)
+            self.dump(obj.text, write)
+            self.dump(obj.tail, write)
+        elif isinstance(obj, DynamicElement) and \
+             _dynamic_elements.get(obj.codec_id) is obj.__class__:
+            fields = obj.encode()
+            write('C' + _dump_varint(self.ref(obj.codec_id)) +
+                  _dump_varint(len(fields)))
+            self.dump(obj.tail, write)
+            for value in fields:
+                self.dump(value, write)
+        elif isinstance(obj, DynamicElement):
+            # elements without codec are pickled
+            pickled = pickle.dumps(obj, 2)
+            write('D' + _dump_varint(self.ref('%s.%s' % (
+                obj.__class__.__module__,
+                obj.__class__.__name__
+            ))) + _dump_varint(len(pickled)) + pickled)
+        else:
+            raise TypeError('unsupported object %r' % type(obj).__name__)
+
+    def get_string_table(self):
+        rv = [_dump_varint(len(self.strings))]
+        for string in self.strings:
+            string = string.encode('utf-8')
+            rv.append(_dump_varint(len(string)) + string)
+        return ''.join(rv)
+
+
+class _V2Reader(object):
+    """Loads values in the version 2 format from a string."""
+
+    def __init__(self, data, pos=len(_v2_header)):
+        self.data = data
+        self.pos = pos
+        self.strings = [self.read_string() for x
+                        in xrange(self.read_varint())]
+
+    def read_varint(self):
+        data = self.data
+        pos = self.pos
+        result = ord(data[pos])
+        if result < 0x80:
+            self.pos = pos + 1
+            return result
+        result = shift = 0
+        while 1:
+            byte = ord(data[pos])
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                self.pos = pos
+                return result
+            shift += 7
+
+    def read_bytes(self):
+        length = self.read_varint()
+        pos = self.pos
+        rv = self.data[pos:pos + length]
+        if len(rv) != length:
+            raise ValueError('format error')
+        self.pos = pos + length
+        return rv
+
+    def read_string(self):
+        return unicode(self.read_bytes(), 'utf-8')
+
+    def read_entries(self):
+        """Read a section of length prefixed entries and return a dict of
+        ``(start, end)`` offsets by key without decoding the entries.
+        """
+        result = {}
+        for x in xrange(self.read_varint()):
+            key = self.strings[self.read_varint()]
+            length = self.read_varint()
+            start = self.pos
+            end = start + length
+            if end > len(self.data):
+                raise ValueError('format error')
+            result[key] = (start, end)
+            self.pos = end
+        return result
+
+    def load(self, parent=None):
+        data = self.data
+        pos = self.pos
+        char = data[pos]
+        self.pos = pos = pos + 1
+        if char == 'S':
+            # inlined read_string() for strings shorter than 128 bytes
+            length = ord(data[pos])
+            if length >= 0x80:
+                return self.read_string()
+            pos += 1
+            end = pos + length
+            if end > len(data):
+                raise ValueError('format error')
+            self.pos = end
+            return unicode(data[pos:end], 'utf-8')
+        elif char == 'E':
+            load = self.load
+            rv = object.__new__(Element)
+            rv.name = self.strings[self.read_varint()]
+            rv.children = load(rv)
+            rv._attributes = load() or _empty_attributes
+            rv.text = load()
+            rv.tail = load()
+            rv.parent = parent
+            return rv
+        elif char == 'C':
+            codec_id = self.strings[self.read_varint()]
+            count = self.read_varint()
+            load = self.load
+            tail = load()
+            fields = [load() for x in xrange(count)]
+            try:
+                rv = _dynamic_elements[codec_id].decode(fields)
+            except Exception, e:
+                log.exception(_(u'Error when loading dynamic ZEML element. '
+                                u'The system ignored the element.  Maybe a '
+                                u'disabled plugin caused the problem.'))
+                return BrokenElement(codec_id, e)
+            if tail:
+                rv.tail = tail
+            rv.parent = parent
+            return rv
+        elif char == 'L':
+            load = self.load
+            return [load(parent) for x in xrange(self.read_varint())]
+        elif char == 'M':
+            load = self.load
+            read_varint = self.read_varint
+            strings = self.strings
+            # the keys were dumped from a mapping, no need to check them
+            items = []
+            for x in xrange(read_varint()):
+                items.append(strings[read_varint()])
+                items.append(load())
+            rv = object.__new__(Attributes)
+            rv._items = tuple(items)
+            return rv
+        elif char == 'N':
+            return None
+        elif char == 'I':
+            value = self.read_varint()
+            if value & 1:
+                return -((value + 1) >> 1)
+            return value >> 1
+        elif char == 'R':
+            rv = object.__new__(RootElement)
+            rv.text = self.load()
+            rv.children = self.load(rv)
+            return rv
+        elif char == 'D':
+            obj_name = self.strings[self.read_varint()]
+            pickled = self.read_bytes()
+            try:
+                rv = pickle.loads(pickled)
+            except Exception, e:
+                log.exception(_(u'Error when loading dynamic ZEML element. '
+                                u'The system ignored the element.  Maybe a '
+                                u'disabled plugin caused the problem.'))
+                return BrokenElement(obj_name, e)
+            rv.parent = parent
+            return rv
+        raise ValueError('format error')
+
+
+def _is_static(element):
+    """`True` if the element has no dynamic elements below it, so its HTML
+    does not depend on the current state of the application.
+    """
+    for node in element.walk():
+        if node.is_dynamic and node is not element and \
+           not getattr(node, 'static_html', False):
+            return False
+    return True
+
+
+def dump_parser_data(parser_data, version=2, store_html=True):
+    """Dump the parser data of a post or comment.  Version 1 is the old
+    format without string table, old Zine versions can only load that.
+
+    In version 2 the rendered HTML of elements without dynamic elements is
+    stored after the entries if `store_html` is true, so that it can be
+    sliced out without loading the element (see :class:`ParserData`).
+    """
+    if version == 1:
+        out = StringIO()
+        dump(len(parser_data), out)
+        for key, value in parser_data.iteritems():
+            assert isinstance(key, basestring), 'keys must be strings'
+            dump(key, out)
+            dump(value, out)
+        return out.getvalue()
+
+    writer = _V2Writer()
+    entries = []
+    html = []
+    # sorted so that equal parser data is dumped to equal strings
+    for key, value in sorted(parser_data.iteritems()):
         assert isinstance(key, basestring), 'keys must be strings'
-        dump(key, out)
-        dump(value, out)
-    return out.getvalue()
+        buffer = []
+        writer.dump(value, buffer.append)
+        value_data = ''.join(buffer)
+        entries.append(_dump_varint(writer.ref(key)) +
+                       _dump_varint(len(value_data)) + value_data)
+        if store_html and isinstance(value, _BaseElement) and \
+           _is_static(value):
+            value_data = value.to_html().encode('utf-8')
+            html.append(_dump_varint(writer.ref(key)) +
+                        _dump_varint(len(value_data)) + value_data)
+    result = [_v2_header, writer.get_string_table(),
+              _dump_varint(len(entries))] + entries
+    # the html section is optional, data without it loads fine
+    if html:
+        result.append(_dump_varint(len(html)))
+        result.extend(html)
+    return ''.join(result)
+
+
+def get_parser_data_version(value):
+    """Return the format version of dumped parser data."""
+    if str(value[:len(_v2_header)]) == _v2_header:
+        return 2
+    return 1
 
 
 def load_parser_data(value):
+    """Load parser data dumped with :func:`dump_parser_data`.  Both format
+    versions are supported, the version is detected from the header:
+
+    >>> data = {'parser': u'zeml', 'count': -1}
+    >>> get_parser_data_version(dump_parser_data(data, version=1))
+    1
+    >>> load_parser_data(dump_parser_data(data, version=1)) == data
+    True
+    >>> get_parser_data_version(dump_parser_data(data))
+    2
+    >>> load_parser_data(dump_parser_data(data)) == data
+    True
+
+    The return value is a :class:`ParserData` object.
+    """
     if value is None:
         return
     # the extra str() call is for databases like postgres that
     # insist on using buffers for binary data.
-    in_ = StringIO(str(value))
-    result = {}
-    for x in xrange(load(in_)):
-        key = load(in_)
-        result[key] = load(in_)
-    return result
+    value = str(value)
+    if get_parser_data_version(value) == 1:
+        result = ParserData()
+        in_ = StringIO(value)
+        for x in xrange(load(in_)):
+            key = load(in_)
+            result._data[key] = load(in_)
+        return result
+
+    try:
+        reader = _V2Reader(value)
+        entries = reader.read_entries()
+        html = {}
+        if reader.pos < len(value):
+            html = reader.read_entries()
+        if reader.pos != len(value):
+            raise ValueError('format error')
+    except IndexError:
+        raise ValueError('format error')
+    return ParserData(reader=reader, entries=entries, html=html)
+
+
+class ParserData(DictMixin, object):
+    """The parser data of a post or comment.  If loaded from the version 2
+    format the entries are only decoded on first access, so a page that
+    only shows the intro of a post never builds the tree of the body:
+
+    >>> data = load_parser_data(dump_parser_data({
+    ...     'intro': parse_zeml(u'<p>Intro</p>'),
+    ...     'body':  parse_zeml(u'<p>Body</p>')
+    ... }))
+    >>> data.pending
+    [u'body', u'intro']
+    >>> data['intro'].to_html()
+    u'<p>Intro</p>'
+    >>> data.pending
+    [u'body']
+
+    The HTML of elements without dynamic elements is stored next to the
+    elements, :meth:`get_html` returns it without loading the element:
+
+    >>> data.get_html('body')
+    u'<p>Body</p>'
+    >>> data.pending
+    [u'body']
+
+    It's a mapping but not a dict, so that nothing can skip the pending
+    entries.  Converting it to a dict decodes them:
+
+    >>> dict(data)['body'].to_html()
+    u'<p>Body</p>'
+    >>> data.pending
+    []
+
+    Like a :class:`~zine.utils.datastructures.MutationDict` it remembers
+    if it was changed.
+    """
+    changed = False
+
+    def __init__(self, values=(), reader=None, entries=None, html=None):
+        self._data = dict(values)
+        self._reader = reader
+        self._entries = entries or {}
+        self._html = html or {}
+        self._raw = reader is not None and reader.data or None
+
+    @property
+    def raw(self):
+        """The dumped data this object was loaded from or `None` if the
+        object was modified since.  Unmodified data can be stored again
+        without dumping it.
+        """
+        return self._raw
+
+    @property
+    def pending(self):
+        """A sorted list of the keys that were not decoded yet."""
+        return sorted(self._entries)
+
+    def _decode(self, key):
+        start, end = self._entries.pop(key)
+        reader = self._reader
+        try:
+            reader.pos = start
+            try:
+                value = reader.load()
+            except IndexError:
+                raise ValueError('format error')
+            if reader.pos != end:
+                raise ValueError('format error')
+        except ValueError:
+            log.exception(_(u'Error when loading the parser data entry '
+                            u'%r.  The entry was ignored.') % key)
+            value = None
+        self._data[key] = value
+        return value
+
+    def _modified(self):
+        self._html.clear()
+        self._raw = None
+        self.changed = True
+
+    def load(self):
+        """Decode all entries that were not decoded yet."""
+        for key in self._entries.keys():
+            self._decode(key)
+
+    def get_html(self, key):
+        """Return the HTML of the element stored as `key` or `None` if it
+        does not exist.  If the HTML was stored and the data was not changed
+        since it was loaded, the element is not loaded.
+        """
+        span = self._html.get(key)
+        if span is not None and not self.changed:
+            return unicode(self._reader.data[span[0]:span[1]], 'utf-8')
+        value = self.get(key)
+        if value is not None:
+            return value.to_html()
+
+    def __getitem__(self, key):
+        if key in self._entries:
+            return self._decode(key)
+        return self._data[key]
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            return self._decode(key)
+        return self._data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._data
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._entries) + len(self._data)
+
+    def keys(self):
+        return self._entries.keys() + self._data.keys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+    __iter__ = iterkeys
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._data[key] = value
+        self._modified()
+
+    def __delitem__(self, key):
+        if self._entries.pop(key, None) is None:
+            del self._data[key]
+        self._modified()
+
+    def clear(self):
+        self._entries.clear()
+        self._data.clear()
+        self._modified()
+
+    def __eq__(self, other):
+        self.load()
+        if isinstance(other, ParserData):
+            other.load()
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        self.load()
+        return repr(self._data)
+
+    def copy(self):
+        self.load()
+        return ParserData(self._data)
+
+    def __reduce__(self):
+        self.load()
+        return ParserData, (self._data,)
+
+
+def _resolve_entity(match):
+    name = match.group(1)
+    if name in _entities:
+        return _entities[name]
+    try:
+        if name[:2] in ('#x', '#X'):
+            return unichr(int(name[2:], 16))
+        elif name.startswith('#'):
+            return unichr(int(name[1:]))
+    except ValueError:
+        pass
+    return match.group(0)
+
+
+def _append_text(element, fragments):
+    """Joins the text fragments and appends them to the tail of the last
+    child of the element or to the text of the element if it has no
+    children.  The list of fragments is emptied.
+    """
+    if fragments:
+        text = u''.join(fragments)
+        del fragments[:]
+        if element.children:
+            element.children[-1].tail += text
+        else:
+            element.text += text
 
 
 def attach_parents(element):
@@ -340,53 +837,116 @@ def attach_parents(element):
 
 
 def _iter_all(elements):
-    for element in elements:
-        yield element
-        for child in _iter_all(element.children):
-            yield child
+    # iterative to not hit the recursion limit on deeply nested trees
+    stack = [iter(elements)]
+    while stack:
+        for element in stack[-1]:
+            yield element
+            if element.children:
+                stack.append(iter(element.children))
+                break
+        else:
+            stack.pop()
 
 
-def _query(elements, expr):
-    if expr.startswith('/'):
-        expr = expr[1:]
-    else:
-        elements = _iter_all(elements)
-    parts = expr.split('/', 1)
-    part = parts.pop(0)
-    rest = parts and parts.pop() or None
-
-    test = None
-    if part.endswith(']'):
-        idx = part.index('[')
-        expr = part[idx + 1:-1]
-        part = part[:idx]
+class _Selector(object):
+    """A compiled query expression.  Selectors are cached, use
+    :func:`compile_selector` to get one.
+    """
+    __slots__ = ('descendants', 'name', 'test', 'rest')
+
+    def __init__(self, expr):
+        self.descendants = not expr.startswith('/')
+        if not self.descendants:
+            expr = expr[1:]
+        parts = expr.split('/', 1)
+        part = parts.pop(0)
+        self.rest = parts and parts[0] and compile_selector(parts[0]) or None
+        self.name = None
+        self.test = None
+
+        if part.endswith(']'):
+            idx = part.index('[')
+            self.test = self._make_test(part[idx + 1:-1])
+            part = part[:idx]
+            if part and part != '*':
+                self.name = part
+        elif part[:1] == '#':
+            value = part[1:]
+            self.test = lambda x: x._attributes.get('id') == value
+        elif part != '*':
+            self.name = part
+
+    @staticmethod
+    def _make_test(expr):
         if '!=' in expr:
             key, value = expr.split('!=', 1)
-            test = lambda x: x.attributes.get(key) != value
+            return lambda x: x._attributes.get(key) != value
         elif '~=' in expr:
             key, value = expr.split('~=', 1)
-            test = lambda x: value in x.attributes.get(key).split()
+            return lambda x: value in (x._attributes.get(key) or u'').split()
         elif '=' in expr:
             key, value = expr.split('=', 1)
-            test = lambda x: x.attributes.get(key) == value
+            return lambda x: x._attributes.get(key) == value
+        return lambda x: expr in x._attributes
+
+    def select(self, elements, index=None):
+        """Iterate over the matching elements.  If the elements are the
+        children of an element with a tag index it can be passed as `index`.
+        """
+        if not self.descendants:
+            candidates = elements
+        elif index is not None and self.name is not None:
+            candidates = index.get(self.name, ())
         else:
-            test = lambda x: expr in x.attributes
-    elif part[:1] == '#':
-        elements = (x for x in elements if x.attributes.get('id') == part[1:])
-    elif part != '*':
-        elements = (x for x in elements if x.name == part)
-
-    if test is not None:
-        elements = (x for x in elements if test(x))
-
-    def traverse():
-        for element in elements:
-            if rest:
-                for n in element.query(rest):
-                    yield n
-            else:
+            candidates = _iter_all(elements)
+        name = self.name
+        test = self.test
+        rest = self.rest
+        for element in candidates:
+            if name is not None and element.name != name:
+                continue
+            if test is not None and not test(element):
+                continue
+            if rest is None:
                 yield element
-    return QueryResult(traverse())
+            else:
+                for match in rest.select(element.children):
+                    yield match
+
+
+#: compiled selectors by expression.  the cache is cleared if it grows
+#: larger than `_selector_cache_size` selectors.
+_selector_cache = {}
+_selector_cache_size = 200
+
+#: the lazily built tag indexes of elements (see `_BaseElement.query`)
+_tag_indexes = weakref.WeakKeyDictionary()
+
+
+def compile_selector(expr):
+    """Compile a query expression.  The compiled selectors are cached."""
+    rv = _selector_cache.get(expr)
+    if rv is None:
+        rv = _Selector(expr)
+        if len(_selector_cache) >= _selector_cache_size:
+            _selector_cache.clear()
+        _selector_cache[expr] = rv
+    return rv
+
+
+def _get_tag_index(element):
+    index = _tag_indexes.get(element)
+    if index is None:
+        index = {}
+        for child in _iter_all(element.children):
+            index.setdefault(child.name, []).append(child)
+        _tag_indexes[element] = index
+    return index
+
+
+def _query(elements, expr, index=None):
+    return QueryResult(compile_selector(expr).select(elements, index))
 
 
 class QueryResult(object):
@@ -463,8 +1023,91 @@ class QueryResult(object):
         )
 
 
-class Attributes(OrderedDict):
-    """An ordered dict for attributes."""
+class Attributes(object):
+    """An ordered mapping for attributes.  Elements rarely have more than a
+    few attributes, so instead of a dict and a list of keys the attributes
+    are stored as one tuple of alternating keys and values:
+
+    >>> attributes = Attributes([('href', u'/'), ('title', u'Index')])
+    >>> attributes['class'] = u'link'
+    >>> attributes['href'] = u'/index'
+    >>> attributes
+    Attributes([('href', u'/index'), ('title', u'Index'), ('class', u'link')])
+    >>> del attributes['title']
+    >>> attributes.keys()
+    ['href', 'class']
+    >>> attributes == {'href': u'/index', 'class': u'link'}
+    True
+
+    Elements without attributes share an empty instance until their
+    attributes are accessed.
+    """
+    __slots__ = ('_items',)
+    __hash__ = None
+
+    def __init__(self, *args, **kwargs):
+        self._items = ()
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def _index(self, key):
+        try:
+            return self._items[::2].index(key) * 2
+        except ValueError:
+            return -1
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._items[index + 1]
+
+    def __setitem__(self, key, value):
+        items = self._items
+        index = self._index(key)
+        if index < 0:
+            self._items = items + (key, value)
+        else:
+            self._items = items[:index + 1] + (value,) + items[index + 2:]
+
+    def __delitem__(self, key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        self._items = self._items[:index] + self._items[index + 2:]
+
+    def __contains__(self, key):
+        return key in self._items[::2]
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._items) // 2
+
+    def __iter__(self):
+        return iter(self._items[::2])
+
+    iterkeys = __iter__
+
+    def __eq__(self, other):
+        if isinstance(other, Attributes):
+            other = dict(other.iteritems())
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        return Attributes, (self.items(),)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        if index < 0:
+            return default
+        return self._items[index + 1]
 
     def get_int(self, key, default=None):
         """Returns an attribute as integer."""
@@ -473,6 +1116,74 @@ class Attributes(OrderedDict):
         except (KeyError, ValueError, TypeError):
             return default
 
+    def keys(self):
+        return list(self._items[::2])
+
+    def values(self):
+        return list(self._items[1::2])
+
+    def items(self):
+        items = self._items
+        return zip(items[::2], items[1::2])
+
+    def itervalues(self):
+        return iter(self._items[1::2])
+
+    def iteritems(self):
+        items = self._items
+        return izip(items[::2], items[1::2])
+
+    def byindex(self, index):
+        """Return the key/value pair for an index."""
+        index *= 2
+        return self._items[index], self._items[index + 1]
+
+    def setdefault(self, key, default=None):
+        index = self._index(key)
+        if index < 0:
+            self[key] = default
+            return default
+        return self._items[index + 1]
+
+    def pop(self, key, *args):
+        index = self._index(key)
+        if index < 0:
+            if args:
+                return args[0]
+            raise KeyError(key)
+        value = self._items[index + 1]
+        self._items = self._items[:index] + self._items[index + 2:]
+        return value
+
+    def update(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError('expected at most one positional argument')
+        if args:
+            mapping = args[0]
+            if hasattr(mapping, 'iteritems'):
+                mapping = mapping.iteritems()
+            elif hasattr(mapping, 'keys'):
+                mapping = ((key, mapping[key]) for key in mapping.keys())
+            for key, value in mapping:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def clear(self):
+        self._items = ()
+
+    def copy(self):
+        rv = object.__new__(self.__class__)
+        rv._items = self._items
+        return rv
+
+    __copy__ = copy
+
+
+#: the attributes of elements without attributes.  Never modified, the
+#: `attributes` property of the elements replaces it on access.
+_empty_attributes = Attributes()
+
 
 class _BaseElement(object):
     """Baseclass for all elements."""
@@ -497,6 +1208,7 @@ class _BaseElement(object):
 
     children = property(lambda x: [])
     attributes = property(lambda x: Attributes())
+    _attributes = _empty_attributes
     parent = None
 
     def __unicode__(self):
@@ -507,12 +1219,12 @@ class _BaseElement(object):
 
     def __nonzero__(self):
         return bool(self.children or self.text or self.tail or
-                    self.attributes)
+                    self._attributes)
 
     def __eq__(self, other):
         if self.__class__ is not other.__class__:
             return False
-        for key in 'name', 'children', 'attributes', 'text', 'tail':
+        for key in 'name', 'children', '_attributes', 'text', 'tail':
             if getattr(self, key, _missing) != \
                getattr(other, key, _missing):
                 return False
@@ -524,10 +1236,24 @@ class _BaseElement(object):
     @property
     def non_blank(self):
         return bool(self.children or self.text.strip() or
-                    self.tail.strip() or self.attributes)
+                    self.tail.strip() or self._attributes)
+
+    def query(self, expr, indexed=False):
+        """Query the descendants of this element with an expression like
+        ``'a[href]'``.  If `indexed` is true an index of the elements by
+        tag name is built on the first query and reused for further indexed
+        queries.  That's useful if many queries are executed on a tree, but
+        :meth:`invalidate_index` has to be called after the tree is
+        modified.
+        """
+        index = None
+        if indexed:
+            index = _get_tag_index(self)
+        return _query(self.children, expr, index)
 
-    def query(self, expr):
-        return _query(self.children, expr)
+    def invalidate_index(self):
+        """Forget the tag index built by indexed queries."""
+        _tag_indexes.pop(self, None)
 
     def copy(self):
         return deepcopy(self)
@@ -553,9 +1279,10 @@ class Element(_BaseElement):
         A regular liest of `Element` or `DynamicElement` objects.
 
     `attributes`
-        an ordered dict of attributes this element has.  If the parser detects
-        an element without value (as in ``<option selected>``) it stores
-        `None` as value for that key.
+        an ordered mapping of attributes this element has (an
+        :class:`Attributes` object).  If the parser detects an element
+        without value (as in ``<option selected>``) it stores `None` as
+        value for that key.
 
     `text`
         The text of the element.
@@ -572,20 +1299,33 @@ class Element(_BaseElement):
         >>> root.children[0].tail
         u' 3'
     """
-    __slots__ = ('name', 'children', 'text', 'tail', 'attributes', 'parent')
+    __slots__ = ('name', 'children', 'text', 'tail', '_attributes', 'parent')
 
     def __init__(self, name):
         self.name = name
         self.children = []
-        self.attributes = Attributes()
+        self._attributes = _empty_attributes
         self.text = u''
         self.tail = u''
         self.parent = None
 
+    def _get_attributes(self):
+        attributes = self._attributes
+        if attributes is _empty_attributes:
+            attributes = self._attributes = Attributes()
+        return attributes
+
+    def _set_attributes(self, value):
+        self._attributes = value
+
+    attributes = property(_get_attributes, _set_attributes)
+    del _get_attributes, _set_attributes
+
     def __deepcopy__(self, memo):
         rv = Element(self.name)
         rv.children = deepcopy(self.children, memo)
-        rv.attributes = deepcopy(self.attributes, memo)
+        if self._attributes is not _empty_attributes:
+            rv._attributes = deepcopy(self._attributes, memo)
         rv.text = self.text
         rv.tail = self.tail
         rv.parent = deepcopy(self.parent, memo)
@@ -620,10 +1360,41 @@ class DynamicElement(_BaseElement):
     The serializer calls the `to_html` method when it wants to display the
     element but subclasses have to override `render()` to not break the tail
     rendering.
+
+    Dynamic elements are pickled when the parser data is stored unless the
+    class provides a codec: a unique `codec_id` and the names of the
+    attributes to store as `codec_fields`.  The values can be strings,
+    numbers, `None`, lists or elements.  Classes that need more control
+    can override `encode` and `decode`.  Classes with codec have to be
+    registered with :func:`register_dynamic_element`.
     """
 
     is_dynamic = True
 
+    #: the id of the codec or `None` if the element is pickled.
+    codec_id = None
+
+    #: the names of the attributes the codec stores.
+    codec_fields = ()
+
+    #: `True` if the HTML of the element does not depend on the state of
+    #: the application.  The HTML of such elements is stored together with
+    #: the parser data.
+    static_html = False
+
+    def encode(self):
+        """Return a list with the values of the codec fields."""
+        return [getattr(self, name) for name in self.codec_fields]
+
+    @classmethod
+    def decode(cls, fields):
+        """Create an element from the values returned by `encode` without
+        calling the constructor.
+        """
+        rv = object.__new__(cls)
+        rv.__dict__.update(izip(cls.codec_fields, fields))
+        return rv
+
     def render(self):
         """Classes have to overide the render method to output something."""
         raise NotImplementedError()
@@ -659,6 +1430,9 @@ class BrokenElement(DynamicElement):
         self.obj_name = obj_name
         self.message = message
 
+    codec_id = 'broken'
+    codec_fields = ('obj_name', 'message')
+
     def render(self):
         return u'<div class="error"><strong>%s</strong>: %s</div>' % (
             _('Error loading dynamic element %s') % self.obj_name,
@@ -669,6 +1443,10 @@ class BrokenElement(DynamicElement):
 class HTMLElement(DynamicElement):
     """An element that stores HTML data."""
 
+    codec_id = 'html'
+    codec_fields = ('value',)
+    static_html = True
+
     def __init__(self, value):
         self.value = value
 
@@ -676,6 +1454,64 @@ class HTMLElement(DynamicElement):
         return self.value
 
 
+#: the classes of the dynamic elements with codec by codec id
+_dynamic_elements = {}
+
+
+def register_dynamic_element(cls):
+    """Register a dynamic element class with codec so that it's stored
+    without pickle.  Plugins should register their classes when the module
+    is imported, otherwise stored elements can't be loaded before the plugin
+    is set up::
+
+        class Video(DynamicElement):
+            codec_id = 'my_plugin.video'
+            codec_fields = ('url',)
+
+            def __init__(self, url):
+                self.url = url
+
+            def render(self):
+                ...
+
+        register_dynamic_element(Video)
+
+    If a stored element has an unknown codec id, for example because the
+    plugin was disabled, it's loaded as :class:`BrokenElement`.  The class
+    is returned so that the function can be used as class decorator.
+    """
+    if not cls.codec_id:
+        raise TypeError('%s has no codec id' % cls.__name__)
+    other = _dynamic_elements.get(cls.codec_id)
+    if other is not None and \
+       (other.__module__, other.__name__) != (cls.__module__, cls.__name__):
+        raise ValueError('codec id %r is already used by %s.%s' % (
+            cls.codec_id, other.__module__, other.__name__))
+    _dynamic_elements[cls.codec_id] = cls
+    return cls
+
+
+register_dynamic_element(HTMLElement)
+register_dynamic_element(BrokenElement)
+
+
+class _TagInfo(object):
+    """Precomputed serialization details of one tag."""
+    __slots__ = ('start', 'open', 'close', 'void', 'rcdata', 'cdata',
+                 'boolean_attributes')
+
+    def __init__(self, serializer, name):
+        self.start = u'<' + name
+        self.open = self.start + u'>'
+        self.close = u'</%s>' % name
+        self.void = name in serializer.void_elements
+        self.rcdata = name in serializer.rcdata_elements
+        self.cdata = name in serializer.cdata_elements
+        self.boolean_attributes = frozenset(
+            serializer.boolean_attributes[None] |
+            serializer.boolean_attributes.get(name, _empty_set))
+
+
 class _HTMLSerializer(object):
     """This class can serialize ZEML trees into fragmentary HTML4/5.  The
     output should be compatible to both of the standards but not XHTML!
@@ -683,7 +1519,11 @@ class _HTMLSerializer(object):
     is completely undefined but won't cause errors that abort the
     serilization.
 
-    Like the loading system it's heavily optimized for performance.
+    Like the loading system it's heavily optimized for performance.  The
+    tree is walked with an explicit stack so that deeply nested trees don't
+    hit the recursion limit, and the details of a tag are only looked up
+    once per tag name.  If the tag sets below are modified at runtime
+    :meth:`clear_cache` has to be called.
     """
 
     # elements that must not have a body
@@ -720,48 +1560,98 @@ class _HTMLSerializer(object):
         'output':       set(['disabled', 'readonly'])
     }
 
-    def serialize_body(self, element, write):
-        if not element.is_root:
-            rcdata = element.name in self.rcdata_elements
-            cdata = element.name in self.cdata_elements
-            if rcdata or cdata:
-                value = element.text
-                if cdata:
-                    value = escape(value)
-                write(value)
-                return
-        if element.text:
-            write(escape(element.text))
-        for child in element.children:
-            self.serialize(child, write)
+    #: the number of tag names the serializer remembers details for.
+    #: posts can contain arbitrary tags, so the cache is bounded.
+    tag_cache_size = 500
+
+    def __init__(self):
+        self._tags = {}
+
+    def clear_cache(self):
+        """Forget the precomputed tag details."""
+        self._tags.clear()
+
+    def get_tag_info(self, name):
+        """Return the precomputed details for a tag name."""
+        rv = self._tags.get(name)
+        if rv is None:
+            rv = _TagInfo(self, name)
+            if len(self._tags) < self.tag_cache_size:
+                self._tags[name] = rv
+        return rv
 
     def serialize(self, element, write):
-        if element.is_root:
-            self.serialize_body(element, write)
-        elif element.is_dynamic:
-            write(element.to_html())
-        else:
-            write(u'<' + element.name)
-            if element.attributes:
-                boolean_attributes = \
-                    self.boolean_attributes[None] | \
-                    self.boolean_attributes.get(element.name, _empty_set)
-                for key, value in element.attributes.iteritems():
-                    if key in boolean_attributes:
-                        write(u' ' + key)
-                    else:
-                        if value is None:
-                            value = u''
+        tags = self._tags
+        get_tag_info = self.get_tag_info
+        # the stack holds elements that still have to be serialized and
+        # strings (end tag and tail) that are written once reached.
+        stack = [element]
+        push = stack.append
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            element = pop()
+            if element.__class__ is unicode:
+                write(element)
+                continue
+            if element.is_root:
+                pass
+            elif element.is_dynamic:
+                write(element.to_html())
+                continue
+            else:
+                info = tags.get(element.name) or get_tag_info(element.name)
+                if not element._attributes:
+                    write(info.open)
+                else:
+                    buffer = [info.start]
+                    boolean_attributes = info.boolean_attributes
+                    for key, value in element._attributes.iteritems():
+                        if key in boolean_attributes:
+                            buffer.append(u' ' + key)
+                        elif value is None:
+                            buffer.append(u' %s=""' % key)
                         else:
-                            value = escape(value, quote=True)
-                        write(u' %s="%s"' % (key, value))
-            write(u'>')
+                            buffer.append(u' %s="%s"' %
+                                          (key, escape(value, quote=True)))
+                    buffer.append(u'>')
+                    write(u''.join(buffer))
+
+                tail = element.tail
+                if tail:
+                    # inlined escape() for the common case of plain text
+                    if tail.__class__ is unicode:
+                        tail = tail.replace(u'&', u'&amp;') \
+                                   .replace(u'<', u'&lt;') \
+                                   .replace(u'>', u'&gt;')
+                    else:
+                        tail = escape(tail)
+                if info.void:
+                    if tail:
+                        write(tail)
+                    continue
+                if tail:
+                    push(info.close + tail)
+                else:
+                    push(info.close)
+                if info.rcdata:
+                    write(element.text)
+                    continue
+                if info.cdata:
+                    write(escape(element.text))
+                    continue
 
-            if element.name not in self.void_elements:
-                self.serialize_body(element, write)
-                write(u'</%s>' % element.name)
-            if element.tail:
-                write(escape(element.tail))
+            text = element.text
+            if text:
+                if text.__class__ is unicode:
+                    write(text.replace(u'&', u'&amp;')
+                              .replace(u'<', u'&lt;')
+                              .replace(u'>', u'&gt;'))
+                else:
+                    write(escape(text))
+            children = element.children
+            if children:
+                extend(children[::-1])
 
 
 html_serializer = _HTMLSerializer()
@@ -774,18 +1664,19 @@ def parse_html(string):
             result = RootElement()
         else:
             result = Element(element.name)
-            result.attributes.update(element.attributes)
+            if element.attributes:
+                result.attributes.update(element.attributes)
+        text = []
         for child in element.childNodes:
             if child.type == 4:
-                if result.children:
-                    result.children[-1].tail += child.value
-                else:
-                    result.text += child.value
+                text.append(child.value)
             # node type 6 are comments, skip them
             elif child.type != 6:
+                _append_text(result, text)
                 new_child = _convert(child)
                 new_child.parent = result
                 result.children.append(new_child)
+        _append_text(result, text)
         return result
 
     from html5lib import HTMLParser
@@ -800,9 +1691,23 @@ def parse_zeml(string, element_handlers=None):
     return p.result
 
 
-def sanitize(tree):
-    """Sanitizes the tree and returns it."""
-    return Sanitizer().sanitize(tree)
+def resolve_entities(string):
+    """Resolves the known HTML5 entities and numerical entities in a string
+    into characters.  Unknown entities are returned as they were defined:
+
+    >>> resolve_entities(u'&lt;p&gt; &amp;&#x41;&#66; &unknown;')
+    u'<p> &AB &unknown;'
+    """
+    if u'&' not in string:
+        return string
+    return _entity_re.sub(_resolve_entity, string)
+
+
+def sanitize(tree, report=None):
+    """Sanitizes the tree and returns it.  If a :class:`SanitizerReport` is
+    passed it's filled with what was removed.
+    """
+    return html_sanitizer.sanitize(tree, report)
 
 
 def split_intro(tree):
@@ -927,6 +1832,38 @@ class ElementHandler(object):
         return element
 
 
+class LazyElementHandler(ElementHandler):
+    """Stands in for an element handler that is imported when the first
+    element is processed.  The parser has to know how to treat the tag
+    before that, so the tag and the flags of the handler are passed as
+    keyword arguments.  `import_name` is the import string of the handler
+    class (``'module:Class'``).
+    """
+
+    def __init__(self, app, import_name, tag, is_void=False,
+                 is_isolated=False, is_semi_isolated=False,
+                 is_block_level=False, broken_by=None):
+        ElementHandler.__init__(self, app)
+        self.import_name = import_name
+        self.tag = tag
+        self.is_void = is_void
+        self.is_isolated = is_isolated
+        self.is_semi_isolated = is_semi_isolated
+        self.is_block_level = is_block_level
+        self.broken_by = broken_by
+        self._handler = None
+
+    @property
+    def handler(self):
+        """The real element handler.  The first access imports it."""
+        if self._handler is None:
+            self._handler = import_string(self.import_name)(self.app)
+        return self._handler
+
+    def process(self, element):
+        return self.handler.process(element)
+
+
 class Parser(object):
     """The ZEML parser.  This parser is able to parse the ZEML syntax which is
     heavily influenced by a mixture of real-world and on-the-paper HTML to get
@@ -1019,6 +1956,10 @@ class Parser(object):
         self.result = RootElement()
         self.state = 'data'
         self.stack = [self.result]
+        # text is collected here and added to the tree before the tree
+        # changes.  that way long texts are joined once and not piece by
+        # piece which would be quadratic.
+        self.text_buffer = []
 
         self.isolated_elements = self.isolated_elements.copy()
         self.semi_isolated_elements = self.semi_isolated_elements.copy()
@@ -1067,19 +2008,7 @@ class Parser(object):
         entities into characters and returns unknown entities as they were
         defined.
         """
-        def handle_match(m):
-            name = m.group(1)
-            if name in _entities:
-                return _entities[name]
-            try:
-                if name[:2] in ('#x', '#X'):
-                    return unichr(int(name[2:], 16))
-                elif name.startswith('#'):
-                    return unichr(int(name[1:]))
-            except ValueError:
-                pass
-            return m.group(0)
-        return _entity_re.sub(handle_match, string)
+        return resolve_entities(string)
 
     def is_breaking(self, tag, element):
         """When given a tag and an element object it checks if the tag is
@@ -1105,6 +2034,7 @@ class Parser(object):
         """Enters the given tag.  This will automatically leave the current
         element if the tag given can break it.
         """
+        self.flush_text()
         # if the tag is not nestable and we are directly inside a tag with
         # the same name we pop.
         if self.is_breaking(tag, self.current):
@@ -1133,6 +2063,7 @@ class Parser(object):
         Otherwise it leaves no element at all.  If an element is left the
         element handler for that tag is called and can replace it.
         """
+        self.flush_text()
         # if no tag is given or the name of the innermost is given, left
         # the last opened on.
         if not tag or tag == self.current.name:
@@ -1204,11 +2135,16 @@ class Parser(object):
         self.write_raw_text(self.resolve_entities(text))
 
     def write_raw_text(self, text):
-        """Writes text to the current element."""
-        if self.current.children:
-            self.current.children[-1].tail += text
-        else:
-            self.current.text += text
+        """Writes text to the current element.  The text is buffered until
+        :meth:`flush_text` is called.
+        """
+        self.text_buffer.append(text)
+
+    def flush_text(self):
+        """Adds the buffered text to the current element.  This is called
+        automatically before elements are entered or left.
+        """
+        _append_text(self.current, self.text_buffer)
 
     def parse(self):
         """Parses the whole string into a element tree."""
@@ -1216,6 +2152,7 @@ class Parser(object):
             self.state = getattr(self, 'parse_' + self.state)()
         while not self.in_root_tag:
             self.leave(None)
+        self.flush_text()
 
     def parse_data(self):
         """Parses everything up to the next tag."""
@@ -1234,7 +2171,8 @@ class Parser(object):
         """Parses a start tag or jumps to the comment/end_tag or data
         parsing function.
         """
-        if self.peek_char() == u'/':
+        match = _tag_start_re.match(self.string, self.pos)
+        if match is not None and match.group(1):
             self.pos += 1
             return 'end_tag'
 
@@ -1243,15 +2181,14 @@ class Parser(object):
             self.write_raw_text(u'<')
             return 'data'
 
-        if self.test_string(u'!--'):
-            return 'comment'
-
-        match = self.match(_tag_name_re)
         if match is None:
             self.write_raw_text(u'<')
             return 'data'
+        if match.group(2):
+            return 'comment'
 
-        element = self.enter(match.group(1))
+        self.pos = match.end()
+        element = self.enter(match.group(3))
         while 1:
             match = self.match(_attribute_re)
             if match is None:
@@ -1301,8 +2238,55 @@ class Parser(object):
         return 'data'
 
 
+class SanitizerReport(object):
+    """Collects what the :class:`Sanitizer` removed from a tree so that
+    moderation tools don't have to parse the text again:
+
+    >>> report = SanitizerReport()
+    >>> tree = sanitize(parse_zeml(u'<script>x</script><a href="javascript:'
+    ...                            u'alert(1)" onclick="y">z</a>'), report)
+    >>> tree.to_html()
+    u'x<a>z</a>'
+    >>> report.elements
+    [u'script']
+    >>> report.attributes
+    [(u'a', u'href'), (u'a', u'onclick')]
+    >>> report.uris
+    [u'javascript:alert(1)']
+    """
+
+    def __init__(self):
+        #: the names of the elements that were removed.  the contents of
+        #: removed elements are kept.
+        self.elements = []
+        #: ``(element, attribute)`` tuples of the removed attributes
+        self.attributes = []
+        #: the URIs that were removed because of the scheme
+        self.uris = []
+        #: ``(old, new)`` tuples of the style attributes that were changed
+        self.styles = []
+
+    def __nonzero__(self):
+        return bool(self.elements or self.attributes or self.uris or
+                    self.styles)
+
+    def __repr__(self):
+        return '<%s elements=%r attributes=%r uris=%r styles=%r>' % (
+            self.__class__.__name__,
+            self.elements,
+            self.attributes,
+            self.uris,
+            self.styles
+        )
+
+
 class Sanitizer(object):
-    """A helper that sanitizes untrusted ZEML trees."""
+    """A helper that sanitizes untrusted ZEML trees.  The tables of the
+    allowed attributes per element and the scheme check are computed when
+    the sanitizer is created, so the sets below must be changed before
+    that.  Use the :func:`sanitize` function or the `html_sanitizer`
+    object unless you need a sanitizer with different rules.
+    """
 
     acceptable_elements = set([
         'a', 'abbr', 'acronym', 'address', 'area', 'b', 'big', 'blockquote',
@@ -1379,10 +2363,32 @@ class Sanitizer(object):
         )$
     ''')
 
+    #: the number of style attributes the sanitizer remembers the clean
+    #: value for.
+    css_cache_size = 500
+
+    def __init__(self):
+        self._attributes = dict((tag, (
+            frozenset(self.acceptable_attributes),
+            frozenset(self.acceptable_attributes & self.uri_attributes)
+        )) for tag in self.acceptable_elements)
+        self._uri_scheme_re = re.compile(r'(?:%s):(?i)' % '|'.join(
+            re.escape(x) for x in sorted(self.acceptable_protocols)))
+        self._css_cache = {}
+
     def is_allowed_uri(self, uri):
-        return urlparse(uri).scheme in self.acceptable_protocols
+        return self._uri_scheme_re.match(uri) is not None
 
     def clean_css(self, css):
+        rv = self._css_cache.get(css)
+        if rv is None:
+            rv = self._clean_css(css)
+            if len(self._css_cache) >= self.css_cache_size:
+                self._css_cache.clear()
+            self._css_cache[css] = rv
+        return rv
+
+    def _clean_css(self, css):
         css = self._css_url_re.sub(u' ', css)
         if self._css_sanity_check_re.match(css) is None:
             return u''
@@ -1404,39 +2410,71 @@ class Sanitizer(object):
 
         return u'; '.join(clean)
 
-    def sanitize(self, element):
-        previous_child = None
-
-        def write_text(text):
-            if previous_child:
-                previous_child.tail += text
+    def clean_attributes(self, element, report=None):
+        """Removes the attributes that are not allowed from an element."""
+        allowed, uri_attributes = self._attributes[element.name]
+        attributes = element.attributes
+        for key, value in attributes.items():
+            if key not in allowed:
+                del attributes[key]
+            elif key in uri_attributes and \
+                 (value is None or not self.is_allowed_uri(value)):
+                del attributes[key]
+                if report is not None and value is not None:
+                    report.uris.append(value)
             else:
-                element.text += text
-
-        iterator = enumerate(element.children)
-        element.children = []
-        for idx, child in iterator:
-            child = self.sanitize(child)
-            if child.name not in self.acceptable_elements:
-                if child.text:
-                    write_text(child.text)
-                element.children.extend(child.children)
-                if child.tail:
-                    write_text(child.tail)
-                if child.children:
-                    previous_child = child.children[-1]
+                continue
+            if report is not None:
+                report.attributes.append((element.name, key))
+        style = attributes.get('style')
+        if style:
+            clean = self.clean_css(style)
+            if clean != style:
+                attributes['style'] = clean
+                if report is not None:
+                    report.styles.append((style, clean))
+
+    def sanitize(self, element, report=None):
+        """Sanitizes a tree in place and returns it.  Elements that are not
+        allowed are replaced with their contents.
+        """
+        acceptable_elements = self.acceptable_elements
+        pending = [element]
+        while pending:
+            parent = pending.pop()
+            children = []
+
+            def add_text(text):
+                if children:
+                    children[-1].tail += text
                 else:
-                    previous_child = element
-            else:
-                for key, value in child.attributes.items():
-                    if key not in self.acceptable_attributes or \
-                       (key in self.uri_attributes and
-                        not self.is_allowed_uri(value)):
-                        del child.attributes[key]
-                style = child.attributes.get('style')
-                if style:
-                    child.attributes['style'] = self.clean_css(style)
-                previous_child = child
-                element.children.append(child)
-
+                    parent.text += text
+
+            # iterators over the children of the parent and of the removed
+            # elements in it.  the tails of removed elements are added as
+            # strings after their children.
+            stack = [iter(parent.children)]
+            while stack:
+                for child in stack[-1]:
+                    if isinstance(child, basestring):
+                        if child:
+                            add_text(child)
+                    elif child.name in acceptable_elements:
+                        if child._attributes:
+                            self.clean_attributes(child, report)
+                        children.append(child)
+                        pending.append(child)
+                    else:
+                        if report is not None:
+                            report.elements.append(child.name)
+                        if child.text:
+                            add_text(child.text)
+                        stack.append(iter(child.children + [child.tail]))
+                        break
+                else:
+                    stack.pop()
+            parent.children = children
         return element
+
+
+html_sanitizer = Sanitizer()
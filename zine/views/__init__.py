@@ -77,7 +77,9 @@ all_views = {
     'admin/inspect_import':     admin.inspect_import,
     'admin/delete_import':      admin.delete_import,
     'admin/export':             admin.export,
+    'admin/jobs':               admin.jobs,
     'admin/information':        admin.information,
+    'admin/pool_metrics':       admin.pool_metrics,
     'admin/log':                admin.log,
     'admin/about_zine':         admin.about_zine,
     'admin/change_password':    admin.change_password,
@@ -24,7 +24,7 @@ from zine.privileges import assert_privilege, require_privilege, \
      MANAGE_CATEGORIES, BLOG_ADMIN
 from zine.i18n import _, ngettext
 from zine.application import get_request, url_for, emit_event, \
-     render_response, get_application
+     render_response, get_application, Response
 from zine.models import User, Group, Post, Category, Comment, \
      STATUS_DRAFT, STATUS_PUBLISHED, COMMENT_MODERATED, COMMENT_UNMODERATED, \
      COMMENT_BLOCKED_USER, COMMENT_BLOCKED_SPAM
@@ -51,7 +51,8 @@ from zine.forms import LoginForm, ChangePasswordForm, PluginForm, \
      DeleteCategoryForm, EditUserForm, DeleteUserForm, \
      CommentMassModerateForm, CacheOptionsForm, EditGroupForm, \
      DeleteGroupForm, ThemeOptionsForm, DeleteImportForm, ExportForm, \
-     MaintenanceModeForm, MarkCommentForm, make_config_form, make_import_form
+     MaintenanceModeForm, MarkCommentForm, JobQueueForm, make_config_form, \
+     make_import_form
 
 
 #: how many posts / comments should be displayed per page?
@@ -130,6 +131,7 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
              _(u'Maintenance')),
             ('import', url_for('admin/import'), _(u'Import')),
             ('export', url_for('admin/export'), _(u'Export')),
+            ('jobs', url_for('admin/jobs'), _(u'Job Queue')),
             ('log', url_for('admin/log'), _('Log')),
             ('configuration', url_for('admin/configuration'),
              _(u'Configuration Editor'))
@@ -225,6 +227,20 @@ def ping_post_links(form):
     elif form.post.parser_missing:
         flash(_(u'Could not ping URLs because the parser for the '
                 u'post is not available any longer.'), 'error')
+    elif form.request.app.jobs.enabled:
+        this_url = url_for(form.post, _external=True)
+        queued = 0
+        for url in form.find_new_links():
+            form.request.app.enqueue_job('zine/pingback', {
+                'source':   this_url,
+                'target':   url
+            })
+            queued += 1
+        db.commit()
+        if queued:
+            flash(ngettext(u'One link will be pinged in the background.',
+                           u'%d links will be pinged in the background.',
+                           queued) % queued)
     else:
         this_url = url_for(form.post, _external=True)
         for url in form.find_new_links():
@@ -1145,10 +1161,20 @@ def configuration(request):
 
 @require_admin_privilege(BLOG_ADMIN)
 def maintenance(request):
-    """Enable / Disable maintenance mode."""
+    """Enable / Disable maintenance mode and render the posts and
+    comments again.
+    """
     cfg = request.app.cfg
     form = MaintenanceModeForm()
     if request.method == 'POST' and form.validate(request.form):
+        if 'rerender' in request.form:
+            if not request.app.jobs.enabled:
+                raise BadRequest()
+            request.app.enqueue_job('zine/rerender')
+            db.commit()
+            flash(_(u'The posts and comments are rendered again in the '
+                    u'background.'), 'configure')
+            return redirect_to('admin/maintenance')
         cfg.change_single('maintenance_mode', not cfg['maintenance_mode'])
         if not cfg['maintenance_mode']:
             flash(_(u'Maintenance mode disabled.  The blog is now '
@@ -1158,6 +1184,7 @@ def maintenance(request):
     return render_admin_response('admin/maintenance.html',
                                  'system.maintenance',
         maintenance_mode=cfg['maintenance_mode'],
+        jobs_enabled=request.app.jobs.enabled,
         form=form.as_widget()
     )
 
@@ -1186,6 +1213,15 @@ def inspect_import(request, id):
             return redirect_to('admin/maintenance')
         elif 'delete' in request.form:
             return redirect_to('admin/delete_import', id=id)
+        elif 'enqueue' in request.form and request.app.jobs.enabled:
+            if form.validate(request.form):
+                request.app.enqueue_job('zine/import', {
+                    'dump_id':  id,
+                    'data':     form.data
+                }, max_attempts=1)
+                db.commit()
+                flash(_(u'The import was added to the job queue.'))
+                return redirect_to('admin/jobs')
         elif form.validate(request.form):
             return render_admin_response('admin/perform_import.html',
                                          'system.import',
@@ -1195,7 +1231,8 @@ def inspect_import(request, id):
 
     return render_admin_response('admin/inspect_import.html',
                                  'system.import', blog=blog,
-                                 form=form.as_widget(), dump_id=id)
+                                 form=form.as_widget(), dump_id=id,
+                                 can_enqueue=request.app.jobs.enabled)
 
 
 @require_admin_privilege(BLOG_ADMIN)
@@ -1240,6 +1277,34 @@ def export(request):
     )
 
 
+def _get_pool_information(app):
+    """Return the pool metrics and, in advisory mode, the suggested pool
+    settings of an application.
+    """
+    engine = app.database_engine
+    rv = {'stats': engine.pool_metrics.get_stats(engine.pool),
+          'advice': None}
+    if app.cfg['database_pool_advisor']:
+        rv['advice'] = engine.pool_metrics.get_advice(engine.pool)
+    return rv
+
+
+def _get_event_profile(app):
+    """Return the recorded calls of the event listeners, the slowest
+    first, or `None` if the events are not profiled.
+    """
+    profile = app._event_manager.get_profile()
+    if profile is None:
+        return
+    return [{
+        'event':        x.event,
+        'listener':     get_object_name(x.callback),
+        'calls':        x.calls,
+        'time':         x.time,
+        'average':      x.average
+    } for x in profile]
+
+
 @require_admin_privilege(BLOG_ADMIN)
 def information(request):
     """Shows some details about this Zine installation.  It's useful for
@@ -1285,13 +1350,15 @@ def information(request):
             in request.app.views.iteritems()], key=lambda x: x['endpoint']),
         zeml_element_handlers=[{
             'tag':          handler.tag,
-            'name':         get_object_name(handler)
+            'name':         get_object_name(getattr(handler, 'import_name',
+                                                    handler))
         } for handler in sorted(request.app.zeml_element_handlers,
                                 key=lambda x: x.tag)],
         parsers=[{
             'key':          key,
             'name':         parser.name,
-            'id':           get_object_name(parser)
+            'id':           get_object_name(getattr(parser, 'import_name',
+                                                    parser))
         } for key, parser in request.app.parsers.iteritems()],
         absolute_url_handlers=[get_object_name(handler) for handler
                                in request.app._absolute_url_handlers],
@@ -1322,6 +1389,8 @@ def information(request):
                           if name not in DEFAULT_FILTERS],
         instance_path=request.app.instance_folder,
         database_uri=database_uri,
+        pool=_get_pool_information(request.app),
+        event_profile=_get_event_profile(request.app),
         platform=platform(),
         export=export
     )
@@ -1333,6 +1402,39 @@ def information(request):
     return response
 
 
+@require_admin_privilege(BLOG_ADMIN)
+def pool_metrics(request):
+    """The pool metrics as JSON for monitoring tools."""
+    return Response(dump_json(_get_pool_information(request.app)),
+                    mimetype='application/json')
+
+
+@require_admin_privilege(BLOG_ADMIN)
+def jobs(request):
+    """Show the job queue with the failed jobs and allow retrying or
+    removing them.
+    """
+    form = JobQueueForm()
+
+    if request.method == 'POST' and form.validate(request.form):
+        try:
+            if 'retry' in request.form:
+                request.app.jobs.retry(int(request.form['retry']))
+                flash(_(u'The job was rescheduled.'), 'configure')
+            elif 'remove' in request.form:
+                request.app.jobs.remove(int(request.form['remove']))
+                flash(_(u'The job was removed.'), 'remove')
+        except ValueError:
+            raise BadRequest()
+        db.commit()
+        return redirect_to('admin/jobs')
+
+    return render_admin_response('admin/jobs.html', 'system.jobs',
+                                 enabled=request.app.jobs.enabled,
+                                 stats=request.app.jobs.get_stats(),
+                                 form=form.as_widget())
+
+
 @require_admin_privilege(BLOG_ADMIN)
 def log(request, page):
     page = request.app.log.view().get_page(page)
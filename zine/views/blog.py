@@ -18,7 +18,7 @@ from zine.i18n import _
 from zine.database import db
 from zine.application import add_link, url_for, render_response, emit_event, \
      iter_listeners, Response, get_application
-from zine.models import Post, Category, User, Comment, Tag
+from zine.models import Post, User, Comment, Tag
 from zine.utils import dump_json, ClosingIterator, log
 from zine.utils.text import build_tag_uri
 from zine.utils.validators import is_valid_email, is_valid_url, check
@@ -36,7 +36,8 @@ def index(req, page=1):
     Available template variables:
 
         `posts`:
-            a list of post objects we want to display
+            a list of post objects we want to display.  Depending on the
+            theme settings these are read-only post rows.
 
         `pagination`:
             a pagination object to render a pagination
@@ -44,8 +45,8 @@ def index(req, page=1):
     :Template name: ``index.html``
     :URL endpoint: ``blog/index``
     """
-    data = Post.query.published().for_index().get_list(endpoint='blog/index',
-                                                       page=page)
+    data = Post.query.published().for_index() \
+               .get_theme_list('index', endpoint='blog/index', page=page)
 
     add_link('alternate', url_for('blog/atom_feed'), 'application/atom+xml',
              _(u'Recent Posts Feed'))
@@ -58,7 +59,8 @@ def archive(req, year=None, month=None, day=None, page=1):
     Available template variables:
 
         `posts`:
-            a list of post objects we want to display
+            a list of post objects we want to display.  Depending on the
+            theme settings these are read-only post rows.
 
         `pagination`:
             a pagination object to render a pagination
@@ -76,10 +78,10 @@ def archive(req, year=None, month=None, day=None, page=1):
 
     url_args = dict(year=year, month=month, day=day)
     per_page = req.app.theme.settings['archive.per_page']
-    data = Post.query.theme_lightweight('archive_overview') \
-               .published().for_index().date_filter(year, month, day) \
-               .get_list(page=page, endpoint='blog/archive',
-                         url_args=url_args, per_page=per_page)
+    data = Post.query.published().for_index() \
+               .date_filter(year, month, day) \
+               .get_theme_list('archive', page=page, endpoint='blog/archive',
+                               url_args=url_args, per_page=per_page)
 
     add_link('alternate', url_for('blog/atom_feed', **url_args),
              'application/atom+xml', _(u'Recent Posts Feed'))
@@ -95,23 +97,27 @@ def show_category(req, slug, page=1):
     Available template variables:
 
         `posts`:
-            a list of post objects we want to display
+            a list of post objects we want to display.  Depending on the
+            theme settings these are read-only post rows.
 
         `pagination`:
             a pagination object to render a pagination
 
         `category`
-            the category object for this page.
+            the category object for this page.  If the entity cache is
+            enabled this is a read-only category row.
 
     :Template name: ``show_category.html``
     :URL endpoint: ``blog/show_category``
     """
-    category = Category.query.filter_by(slug=slug).first(True)
+    category = req.app.entity_cache.lookup('category', slug)
+    if category is None:
+        raise NotFound()
     per_page = req.app.theme.settings['category.per_page']
-    data = category.posts.theme_lightweight('category') \
-                   .published().get_list(page=page, per_page=per_page,
-                                         endpoint='blog/show_category',
-                                         url_args=dict(slug=slug))
+    data = Post.query.in_category(category).published() \
+                   .get_theme_list('category', page=page, per_page=per_page,
+                                   endpoint='blog/show_category',
+                                   url_args=dict(slug=slug))
 
     add_link('alternate', url_for('blog/atom_feed', category=slug),
              'application/atom+xml', _(u'All posts in category %s') % category.name)
@@ -124,23 +130,27 @@ def show_tag(req, slug, page=1):
     Available template variables:
 
         `posts`:
-            a list of post objects we want to display
+            a list of post objects we want to display.  Depending on the
+            theme settings these are read-only post rows.
 
         `pagination`:
             a pagination object to render a pagination
 
         `tag`
-            the tag object for this page.
+            the tag object for this page.  If the entity cache is
+            enabled this is a read-only tag row.
 
     :Template name: ``show_tag.html``
     :URL endpoint: ``blog/show_tag``
     """
-    tag = Tag.query.filter_by(slug=slug).first(True)
+    tag = req.app.entity_cache.lookup('tag', slug)
+    if tag is None:
+        raise NotFound()
     per_page = req.app.theme.settings['tag.per_page']
-    data = tag.posts.theme_lightweight('tag') \
-                    .published().get_list(page=page, endpoint='blog/show_tag',
-                                          per_page=per_page,
-                                          url_args=dict(slug=slug))
+    data = Post.query.tagged(tag).published() \
+                    .get_theme_list('tag', page=page, endpoint='blog/show_tag',
+                                    per_page=per_page,
+                                    url_args=dict(slug=slug))
 
     add_link('alternate', url_for('blog/atom_feed', tag=slug),
              'application/atom+xml', _(u'All posts tagged %s') % tag.name)
@@ -177,20 +187,21 @@ def show_author(req, username, page=1):
             a pagination object to render a pagination
 
         `user`
-            The user object for this author
+            The user object for this author.  If the entity cache is
+            enabled this is a read-only user row.
 
     :Template name: ``show_author.html``
     :URL endpoint: ``blog/show_author``
     """
-    user = User.query.filter_by(username=username).first()
+    user = req.app.entity_cache.lookup('user', username)
     if user is None or not user.is_author:
         raise NotFound()
 
     per_page = req.app.theme.settings['author.per_page']
-    data = user.posts.theme_lightweight('author').published() \
-                     .get_list(page=page, per_page=per_page,
-                               endpoint='blog/show_author',
-                               url_args=dict(username=user.username))
+    data = Post.query.filter_by(author_id=user.id).published() \
+                     .get_theme_list('author', page=page, per_page=per_page,
+                                     endpoint='blog/show_author',
+                                     url_args=dict(username=user.username))
 
     add_link('alternate', url_for('blog/atom_feed', author=user.username),
              'application/atom+xml', _(u'All posts written by %s') %
@@ -210,7 +221,12 @@ def authors(req):
     :Template name: ``authors.html``
     :URL endpoint: ``blog/authors``
     """
-    return render_response('authors.html', authors=User.query.authors().all())
+    if req.app.entity_cache.enabled:
+        authors = [x for x in req.app.entity_cache.get_all('user')
+                   if x.is_author]
+    else:
+        authors = User.query.authors().all()
+    return render_response('authors.html', authors=authors)
 
 
 @cache.response(vary=('user',))
@@ -351,18 +367,24 @@ def atom_feed(req, author=None, year=None, month=None, day=None,
 
     # feed for a category
     if category is not None:
-        category = Category.query.filter_by(slug=category).first(True)
-        query = query.filter(Post.categories.contains(category))
+        category = req.app.entity_cache.lookup('category', category)
+        if category is None:
+            raise NotFound()
+        query = query.in_category(category)
 
     # feed for a tag
     if tag is not None:
-        tag = Tag.query.filter_by(slug=tag).first(True)
-        query = query.filter(Post.tags.contains(tag))
+        tag = req.app.entity_cache.lookup('tag', tag)
+        if tag is None:
+            raise NotFound()
+        query = query.tagged(tag)
 
     # feed for an author
     if author is not None:
-        author = User.query.filter_by(username=author).first(True)
-        query = query.filter(Post.author == author)
+        author = req.app.entity_cache.lookup('user', author)
+        if author is None:
+            raise NotFound()
+        query = query.filter_by(author_id=author.id)
 
     # feed for dates
     if year is not None:
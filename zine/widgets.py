@@ -16,7 +16,9 @@
     :copyright: (c) 2009 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from zine.application import render_template
+from werkzeug import import_string
+
+from zine.application import render_template, get_application
 from zine.models import Post, Category, Tag, Comment
 
 
@@ -41,6 +43,31 @@ class Widget(object):
         return unicode(self).encode('utf-8')
 
 
+class LazyWidget(object):
+    """Stands in for a widget class that is imported when the widget is
+    used for the first time.  `import_name` is the import string of the
+    widget class (``'module:Class'``), `name` the name of the widget.
+    """
+
+    def __init__(self, import_name, name):
+        self.import_name = import_name
+        self.name = name
+        self._widget = None
+
+    @property
+    def widget(self):
+        """The real widget class.  The first access imports it."""
+        if self._widget is None:
+            self._widget = import_string(self.import_name)
+        return self._widget
+
+    def __call__(self, *args, **kwargs):
+        return self.widget(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.widget, name)
+
+
 class PostArchiveSummary(Widget):
     """Show the last n months/years/days with posts."""
 
@@ -97,7 +124,8 @@ class CategoryList(Widget):
     template = 'widgets/category_list.html'
 
     def __init__(self, show_title=False):
-        self.categories = Category.query.all()
+        self.categories = get_application().entity_cache.lookup_all(
+            'category')
         self.show_title = show_title
 
 
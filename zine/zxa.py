@@ -140,7 +140,8 @@ class Writer(object):
 
     def _generate(self):
         now = datetime.utcnow()
-        posts = iter(Post.query.order_by(Post.last_update.desc()))
+        posts = iter(Post.query.options(db.undefer('extra'))
+                         .order_by(Post.last_update.desc()))
         try:
             first_post = posts.next()
             last_update = first_post.last_update
@@ -182,7 +183,7 @@ class Writer(object):
 
         # look up all the users and add them as dependencies if they
         # have written a comment or created a post.
-        for user in User.query.all():
+        for user in User.query.options(db.undefer('extra')).all():
             if user.posts.count() > 0 or user.comments.count() > 0:
                 self._register_user(user)
 